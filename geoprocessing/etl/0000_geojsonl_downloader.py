@@ -1,29 +1,35 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import sys
-import json
+import time
 import requests
 from datetime import datetime
-from threading import Thread, Lock
-from tkinter import Tk
-from tkinter.filedialog import askdirectory
 import traceback
 
-print("""
-========================================
-GeoJSON (line-delimited) Downloader
-========================================
-""")
+from arcgis_client import (PROFILES, AdaptiveLimiter, get_edit_date_field, get_layer_info, get_max_edit_date,
+                           get_object_id_field, get_object_id_range, get_object_ids, make_session,
+                           query_params, request_json, run_tasks)
+from checkpoint_journal import CheckpointJournal, committed_total, recover
+from delta_refresh import load_manifest, refresh_layer, write_manifest
+from feature_sinks import SINKS, open_sinks
+from http_cache import session_cache
+from oid_index import dedup_merge, extract_oid
+import json_backend
+import metrics
 
 # Config
-THREADS = 2
 REPORT_INTERVAL = 100_000
-
-# Global progress tracking
-progress = {}
-progress_lock = Lock()
+CONCURRENCY = 16       # initial number of page requests in flight (shared by all workers)
+MAX_CONCURRENCY = 64   # ceiling the adaptive limiter may grow to; also the number of worker threads
+PASSTHROUGH = True     # write each feature's original bytes (needs msgspec; falls back to re-encoding)
+HTTP_CACHE = ".http_cache"  # response cache folder inside the download folder, see http_cache.py
+USE_HTTP_CACHE = False # cache responses there (opt-in: --http-cache)
+PROFILE = "full"       # download profile (arcgis_client.PROFILES): fields and geometry precision / generalization
 
 def choose_folder_dialog():
+    from tkinter import Tk  # only the interactive mode needs a display
+    from tkinter.filedialog import askdirectory
     root = Tk(); root.withdraw()
     folder = askdirectory(title="Select Download Folder")
     root.destroy()
@@ -36,219 +42,424 @@ def prompt(msg, default=None):
     v = input(msg + (" " if default is None else f"[{default}] ")).strip()
     return v or default
 
-def get_max_record_count(api_url):
-    r = requests.get(api_url + "?f=json", timeout=30)
+def get_max_record_count(api_url, session=None):
+    r = (session or requests).get(api_url + "?f=json", timeout=30)
     r.raise_for_status()
     return int(r.json().get("maxRecordCount", 500))
 
-def get_total_count(api_url):
-    r = requests.get(api_url + "/query", params={
+def get_total_count(api_url, session=None):
+    r = (session or requests).get(api_url + "/query", params={
         "where": "1=1", "returnCountOnly": "true", "f": "json"
     }, timeout=30)
     r.raise_for_status()
     return int(r.json().get("count", 0))
 
-def save_progress(progress_path, tid, offset, downloaded):
-    with progress_lock:
-        progress[tid] = {"offset": offset, "downloaded": downloaded}
-        with open(progress_path, "w", encoding="utf-8") as pf:
-            json.dump(progress, pf, indent=2)
-
-def download_thread(api_url, start, end, page_size, out_file, ckpt_file, tid, start_time, folder, basename):
-    # checkpoint resume
-    if os.path.exists(ckpt_file):
-        with open(ckpt_file) as f:
-            offset = int(f.read())
-        mode = "a"
-        print(f"[T{tid}] Resuming at offset {offset}")
-    else:
-        offset = start
-        mode = "w"
-        if os.path.exists(out_file):
-            os.remove(out_file)
-
-    downloaded = offset - start
-    next_report = REPORT_INTERVAL
-    progress_path = os.path.join(folder, f"{basename}_progress.json")
-
-    with open(out_file, mode, encoding="utf-8") as f:
-        while offset <= end:
-            params = {
-                "where": "1=1",
-                "outFields": "*",
-                "f": "geojson",
-                "orderByFields": "OBJECTID ASC",  # ensure stable order
-                "resultOffset": offset,
-                "resultRecordCount": page_size
-            }
-
-            # auto retry up to 3 times
-            for attempt in range(3):
-                try:
-                    r = requests.get(api_url + "/query", params=params, timeout=60)
-                    r.raise_for_status()
-                    break
-                except Exception as e:
-                    print(f"[T{tid}] Retry {attempt+1}/3 failed at offset {offset}: {e}")
-                    if attempt == 2:
-                        print(f"[T{tid}] Aborting after 3 failed attempts.")
-                        save_progress(progress_path, tid, offset, downloaded)
-                        return
-
-            data = r.json()
-            feats = data.get("features", [])
-
+def plan_offset_pages(total, page_size):
+    """resultOffset paging: page i covers rows [i*page_size, (i+1)*page_size) of the sorted layer.
+    The last page is open-ended: rows deleted since the count only make it shorter."""
+    return [{"offset": o, "start": o, "stop": min(o + page_size, total), "count": min(page_size, total - o),
+             "last": o + page_size >= total}
+            for o in range(0, total, page_size)]
+
+def plan_keyset_pages(oids, page_size):
+    """Keyset paging from a sorted OBJECTID array: each page is the closed ID range
+    [first, last] of page_size consecutive IDs, so it returns exactly page_size rows
+    and costs the same index lookup wherever it sits in the layer."""
+    pages = []
+    for i in range(0, len(oids), page_size):
+        lo, hi = int(oids[i]), int(oids[min(i + page_size, len(oids)) - 1])
+        pages.append({"lo": lo, "hi": hi, "start": lo, "stop": hi + 1, "count": min(page_size, len(oids) - i)})
+    return pages
+
+def plan_range_pages(min_oid, max_oid, page_size):
+    """Keyset paging without an ID list: equal-width OBJECTID ranges. Gaps in the IDs
+    make some pages short, but none of them needs an offset scan."""
+    return [{"lo": lo, "hi": min(lo + page_size - 1, max_oid), "start": lo,
+             "stop": min(lo + page_size, max_oid + 1), "count": None}
+            for lo in range(min_oid, max_oid + 1, page_size)]
+
+def feature_oid(feat, oid_field):
+    if isinstance(feat, bytes):
+        return extract_oid(feat, (oid_field,))
+    oid = feat.get("properties", {}).get(oid_field)
+    return feat.get("id") if oid is None else oid
+
+def feature_line(feat):
+    """GeoJSONL bytes for a feature: raw passthrough slice or a decoded dict."""
+    return json_backend.raw_line(feat) if isinstance(feat, bytes) else json_backend.dumps_line(feat)
+
+class IncompletePageError(Exception):
+    """A page came back with fewer features than planned; run_tasks retries it and
+    finally reports it as failed, so it is never committed as done."""
+
+def fetch_page(session, limiter, api_url, page, oid_field, query=None):
+    """Fetch one planned page, following exceededTransferLimit when the server caps a
+    response below the requested size. With passthrough the features come back as
+    raw bytes rather than dicts. query holds the download profile's parameters
+    (arcgis_client.query_params); None requests every field at full precision.
+    Raises IncompletePageError when a page with a planned count (other than the
+    open-ended last offset page) comes back short or empty. A short or empty ID range
+    is checked against the server's current count for it: IDs deleted since the plan
+    are a real gap, anything else a failed response."""
+    passthrough = PASSTHROUGH and json_backend.PASSTHROUGH_AVAILABLE
+    decode = lambda content: json_backend.decode_page(content, passthrough)
+    feats = []
+    while True:
+        params = {
+            **(query or {"outFields": "*"}),
+            "f": "geojson",
+            "orderByFields": f"{oid_field} ASC",  # ensure stable order
+        }
+        if "offset" in page:
+            remaining = page["count"] - len(feats)
+            if remaining <= 0:
+                break
+            params.update({"where": "1=1", "resultOffset": page["offset"] + len(feats),
+                           "resultRecordCount": remaining})
+        else:
+            # continue after the last ID we got rather than re-reading the range
+            lo = page["lo"] if not feats else feature_oid(feats[-1], oid_field) + 1
+            params["where"] = f"{oid_field} BETWEEN {lo} AND {page['hi']}"
+        data = request_json(session, limiter, api_url + "/query", params=params,
+                            label=f"[page {page['start']}] ", decode=decode)
+        batch = data.get("features", [])
+        feats.extend(batch)
+        truncated = data.get("exceededTransferLimit") or data.get("properties", {}).get("exceededTransferLimit")
+        if not batch or not truncated:
+            break
+    if "lo" in page and len(feats) < (page.get("count") or 1):
+        where = f"{oid_field} BETWEEN {page['lo']} AND {page['hi']}"
+        body = request_json(session, limiter, api_url + "/query", label=f"[page {page['start']}] ",
+                            params={"where": where, "returnCountOnly": "true", "f": "json"})
+        if body.get("count", 0) > len(feats):
+            raise IncompletePageError(f"page {page['start']}: got {len(feats)} of the {body['count']} "
+                                      f"features the server has in {where}")
+    elif page.get("count") and len(feats) < page["count"] and not page.get("last"):
+        raise IncompletePageError(f"page {page['start']}: got {len(feats)} of {page['count']} features")
+    return feats
+
+def load_plan(plan_path):
+    if os.path.exists(plan_path):
+        with open(plan_path, "rb") as pf:
+            return json_backend.loads(pf.read())
+    return None
+
+def save_plan(plan_path, plan):
+    tmp = plan_path + ".tmp"
+    with open(tmp, "wb") as pf:
+        pf.write(json_backend.dumps_line(plan))
+    os.replace(tmp, plan_path)
+
+def download_pages(api_url, pages, out_file, journal_file, start_time, session, limiter, workers, oid_field,
+                   query=None):
+    """Download every planned page into one part file; returns the pages that failed.
+
+    Pages sit in one shared queue that all workers take from (arcgis_client.run_tasks),
+    and each finished page is appended and journaled as it completes. The journal is
+    the resume manifest: pages whose start key it records are skipped on the next run,
+    whatever the number of workers then.
+    """
+    downloaded = 0
+    done = set()
+    if os.path.exists(journal_file):
+        # cut the part file back to the last committed page (see checkpoint_journal.py)
+        records = recover(out_file, journal_file)
+        done = {r["start"] for r in records}
+        downloaded = records[-1]["total"] if records else 0
+        if records:
+            print(f"Resuming: {len(done):,} pages ({downloaded:,} features) already committed")
+    elif os.path.exists(out_file):
+        os.remove(out_file)
+
+    todo = [p for p in pages if p["start"] not in done]
+    expected = downloaded + sum(p["count"] or 0 for p in todo)
+    state = {"downloaded": downloaded, "next_report": downloaded + REPORT_INTERVAL}
+
+    with open(out_file, "ab") as f, CheckpointJournal(journal_file, f) as journal:
+        def on_result(page, feats):
+            # called under run_tasks' lock, so pages are appended one at a time
             if not feats:
-                # Empty page: skip ahead
-                print(f"[T{tid}] Empty page at offset {offset}, skipping ahead.")
-                offset += page_size
-                continue
-
-            for feat in feats:
-                f.write(json.dumps(feat, ensure_ascii=False) + "\n")
-
-            count = len(feats)
-            downloaded += count
-            offset += count
-            with open(ckpt_file, "w") as c:
-                c.write(str(offset))
-
-            # periodic progress save
-            if downloaded >= next_report:
-                pct = downloaded / (end - start + 1)
-                elapsed = datetime.now() - start_time
-                print(f"[T{tid}] Downloaded {downloaded:,}/{end-start+1:,} ({pct:.1%}), elapsed {elapsed}")
-                save_progress(progress_path, tid, offset, downloaded)
-                next_report += REPORT_INTERVAL
-
-    print(f"[T{tid}] Finished at offset {offset}, total {downloaded:,}")
-
-def merge_geojsonl(folder, basename):
-    import hashlib
-    
-    def get_oid(feature):
-        props = feature.get("properties", {})
-        return props.get("OBJECTID") or props.get("FID") or None
-
-    in_paths = [os.path.join(folder, f"{basename}_t{tid}.geojsonl") for tid in range(1, THREADS+1)]
-    out_path = os.path.join(folder, f"{basename}.geojsonl")
-
-    seen = set()
-    kept = 0
-    dupes = 0
-
-    with open(out_path, "w", encoding="utf-8") as fout:
-        for p in in_paths:
-            with open(p, "r", encoding="utf-8") as fin:
-                for line in fin:
-                    try:
-                        feat = json.loads(line)
-                        oid = get_oid(feat)
-                        if oid is not None:
-                            if oid in seen:
-                                dupes += 1
-                                continue
-                            seen.add(oid)
-                        else:
-                            # fallback to hashing the geometry+props
-                            sig = hashlib.md5(line.encode()).hexdigest()
-                            if sig in seen:
-                                dupes += 1
-                                continue
-                            seen.add(sig)
-                        fout.write(json.dumps(feat, ensure_ascii=False) + "\n")
-                        kept += 1
-                    except Exception as e:
-                        print(f"Warning: Error reading line from {p}: {e}")
+                # only real gaps in the IDs (or the open-ended last offset page) get here empty
+                print(f"Empty page at {page['start']}, skipping ahead.")
+            with metrics.timed("download_serialize_seconds"):
+                data = b"".join(feature_line(feat) for feat in feats)
+            offset = f.tell()
+            started = time.perf_counter()
+            try:
+                f.write(data)
+            except Exception:
+                f.seek(offset)
+                f.truncate()  # never leave half a page in front of the next one
+                raise
+            state["downloaded"] += len(feats)
+            journal.add(page, data, len(feats), state["downloaded"])
+            metrics.observe("download_write_seconds", time.perf_counter() - started)
+            metrics.count("download_pages_total")
+            metrics.count("download_features_total", len(feats))
+            metrics.count("download_bytes_out_total", len(data))
+            if state["downloaded"] >= state["next_report"]:
+                pct = state["downloaded"] / (expected or 1)
+                print(f"Downloaded {state['downloaded']:,}/{expected:,} ({pct:.1%}), "
+                      f"elapsed {datetime.now() - start_time}, concurrency {limiter.limit}")
+                state["next_report"] += REPORT_INTERVAL
+
+        fetch = lambda page: fetch_page(session, limiter, api_url, page, oid_field, query)
+        failures = run_tasks(todo, fetch, on_result, workers)
+
+    for page, e in failures:
+        print(f"Page {page['start']}-{page['stop']} failed: {e}")
+    print(f"Finished {len(todo) - len(failures):,}/{len(todo):,} pages, total {state['downloaded']:,} features"
+          + (f"; {len(failures)} failed pages will be retried on the next run" if failures else ""))
+    return [page for page, _ in failures]
+
+def merge_geojsonl(folder, basename, formats=("geojsonl",), oid_field="OBJECTID"):
+    """Merge the downloaded part file, dropping repeated OIDs, into every output format.
+
+    oid_field is the layer's object ID field (the plan's / manifest's), so a legacy
+    non-unique OBJECTID attribute never decides what is a duplicate.
+    Lines are copied through as raw bytes and only the OID token is parsed; see
+    oid_index.dedup_merge for the bitmap / external-sort dedup. All formats (see
+    feature_sinks.SINKS) are written in this one pass; the part file, its journal and
+    the page plan are removed afterwards.
+    """
+    part = os.path.join(folder, f"{basename}_part")
+    in_paths = [p for p in [part + ".geojsonl"] if os.path.exists(p)]
+
+    with metrics.stage("merge"), open_sinks(os.path.join(folder, basename), formats) as sink:
+        kept, dupes, bad = dedup_merge(in_paths, sink, fields=(oid_field,), tmp_dir=folder)
+    metrics.count("merge_features_total", kept)
+    metrics.count("merge_duplicates_total", dupes)
+    metrics.count("merge_bytes_in_total", sum(os.path.getsize(p) for p in in_paths))
+    metrics.count("merge_bytes_out_total", sum(os.path.getsize(p) for p in sink.paths if os.path.exists(p)))
+    for p in in_paths + [part + ".journal", os.path.join(folder, f"{basename}_plan.json")]:
+        if os.path.exists(p):
             os.remove(p)
 
-    print(f"Merged into {out_path}, kept: {kept}, removed duplicates: {dupes}")
-    return out_path
-
-def to_featurecollection(in_geojsonl, out_geojson, total):
-    print(f"Wrapping lines to FeatureCollection: {out_geojson}")
-    with open(in_geojsonl, "r", encoding="utf-8") as fin, \
-         open(out_geojson, "w", encoding="utf-8") as fout:
-        fout.write('{"type":"FeatureCollection","features":[\n')
-        first = True
-        count = 0
-        for line in fin:
-            if not first:
-                fout.write(",\n")
-            fout.write(line.strip())
-            first = False
-            count += 1
-            if count % (total//10 or 1) == 0:
-                print(f"  wrap progress {count/total:.0%}")
-        fout.write("\n]}")
-    print("Wrap done.")
-
-def main():
-    print("Please select a folder to start download")
-    folder = choose_folder_dialog()
-    basename = prompt("2) Enter output base name (no extension):")
-    api_url = prompt("3) Enter API service URL:")
-    only_l = prompt("4) Only output geojsonl? (y/n):", "n").lower().startswith("y")
-
+    print(f"Merged into {', '.join(sink.paths)}, kept: {kept}, removed duplicates: {dupes}"
+          + (f", skipped malformed lines: {bad}" if bad else ""))
+    return sink.paths
+
+def download_layer(api_url, folder, basename, concurrency=CONCURRENCY, paging="keyset",
+                   session=None, limiter=None, profile=PROFILE, fields=None, http_cache=USE_HTTP_CACHE):
+    """Plan and download one layer into {basename}_part.geojsonl (resuming if possible).
+
+    session / limiter default to a fresh pooled session and AdaptiveLimiter; the batch
+    orchestrator passes a limiter that also draws from shared per-host / global budgets.
+    profile / fields select what the server sends (see arcgis_client.query_params).
+    http_cache caches the fresh session's responses in {folder}/HTTP_CACHE.
+    Returns a summary dict (total, downloaded, failed_pages, oid_field, edit_field,
+    edit_max, query, start_time); edit_max is the server's latest edit date when the plan
+    was made, the starting point for a later incremental refresh (see delta_refresh.py),
+    and query the profile's parameters, which the patcher and refresh reuse.
+    """
     start_time = datetime.now()
     print(f"\n>>> Start download @ {start_time} <<<\n")
-
-    total = get_total_count(api_url)
-    page_size = get_max_record_count(api_url)
-    print(f"Total features: {total:,}, page size: {page_size}\n")
-
-    per = total // THREADS
-    threads = []
-    for i in range(THREADS):
-        s = i * per
-        e = (i+1) * per - 1 if i < THREADS-1 else total - 1
-        out_file = os.path.join(folder, f"{basename}_t{i+1}.geojsonl")
-        ckpt_file = os.path.join(folder, f"{basename}_t{i+1}.chk")
-        t = Thread(target=download_thread,
-                   args=(api_url, s, e, page_size, out_file, ckpt_file, i+1, start_time, folder, basename))
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-
-    confirm = input("\nAll threads finished. Merge now? (y/n): ").lower()
-    if confirm != "y":
-        print("Skipping merge. You can inspect geojsonl shards manually.")
-        return
-
-    geojsonl = merge_geojsonl(folder, basename)
-    final = geojsonl
-    if not only_l:
-        out_fc = os.path.join(folder, f"{basename}.geojson")
-        to_featurecollection(geojsonl, out_fc, total)
-        final = out_fc
-
-    # Write log file (includes actual downloaded count)
+    passthrough = PASSTHROUGH and json_backend.PASSTHROUGH_AVAILABLE
+    print(f"JSON backend: {json_backend.BACKEND}, raw feature passthrough: {'on' if passthrough else 'off'}")
+
+    # One pooled session and one limiter for all workers: the limiter owns the global
+    # in-flight budget and backs off when the server starts answering 429/5xx.
+    max_concurrency = max(concurrency, MAX_CONCURRENCY) if limiter is None else limiter.maximum
+    session = session or make_session(max_concurrency, cache_dir=os.path.join(folder, HTTP_CACHE) if http_cache else None)
+    limiter = limiter or AdaptiveLimiter(initial=concurrency, maximum=max_concurrency)
+
+    total = get_total_count(api_url, session)
+    page_size = get_max_record_count(api_url, session)
+    print(f"Total features: {total:,}, page size: {page_size}, concurrency: {concurrency}\n")
+
+    # The page plan is saved with the first run and reused on resume, so completed
+    # pages in the journal match the tasks exactly
+    plan_path = os.path.join(folder, f"{basename}_plan.json")
+    part = os.path.join(folder, f"{basename}_part")
+    journal_file = part + ".journal"
+    plan = load_plan(plan_path)
+    if plan and plan.get("api_url") != api_url:
+        print(f"Saved plan is for {plan.get('api_url')}; starting over")
+        plan = None
+    elif plan and plan.get("query", query_params()) != query_params(profile, fields, plan["oid_field"]):
+        # pages fetched with other fields / precision must not end up in the same file
+        print("Saved plan used a different download profile; starting over")
+        plan = None
+    if not plan:
+        # the journal's page keys only mean something for the plan that wrote them
+        for p in (journal_file, part + ".geojsonl"):
+            if os.path.exists(p):
+                os.remove(p)
+    if plan:
+        oid_field, pages = plan["oid_field"], plan["pages"]
+        edit_field, edit_max = plan.get("edit_field"), plan.get("edit_max")
+        print(f"Resuming saved plan: {len(pages):,} pages")
+    else:
+        info = get_layer_info(session, api_url)
+        oid_field = get_object_id_field(info)
+        # read before paging, so edits made during the download are newer than it
+        edit_field = get_edit_date_field(info)
+        edit_max = get_max_edit_date(session, api_url, edit_field) if edit_field else None
+        pages = None
+        if paging.startswith("k"):
+            # Keyset paging: ID ranges instead of resultOffset, so deep pages stay cheap
+            oids = get_object_ids(session, api_url)
+            if oids is not None:
+                pages = plan_keyset_pages(oids, page_size)
+                print(f"Keyset paging over {len(oids):,} {oid_field}s")
+            else:
+                oid_range = get_object_id_range(session, api_url, oid_field)
+                if oid_range:
+                    pages = plan_range_pages(oid_range[0], oid_range[1], page_size)
+                    print(f"Keyset paging over {oid_field} range {oid_range[0]}-{oid_range[1]}")
+        if pages is None:
+            pages = plan_offset_pages(total, page_size)
+            print("Offset paging")
+        save_plan(plan_path, {"api_url": api_url, "oid_field": oid_field, "edit_field": edit_field,
+                              "edit_max": edit_max, "total": total, "pages": pages,
+                              "query": query_params(profile, fields, oid_field)})
+
+    query = query_params(profile, fields, oid_field)
+    if query != query_params():
+        print(f"Download profile: {', '.join(f'{k}={v}' for k, v in query.items())}")
+    with metrics.stage("download"):
+        failed = download_pages(api_url, pages, part + ".geojsonl", journal_file, start_time,
+                                session, limiter, max_concurrency, oid_field, query)
+    if session_cache(session):
+        print(session_cache(session).summary())
+    return {"total": total, "downloaded": committed_total(journal_file), "failed_pages": len(failed),
+            "oid_field": oid_field, "edit_field": edit_field, "edit_max": edit_max, "query": query,
+            "start_time": start_time}
+
+def write_download_log(folder, basename, api_url, final, total, downloaded, start_time, query=None):
+    """Write {basename}_download_log.txt (includes the actual downloaded count); returns its path."""
     log_path = os.path.join(folder, f"{basename}_download_log.txt")
     end_time = datetime.now()
-
-    actual_downloaded = 0
-    progress_path = os.path.join(folder, f"{basename}_progress.json")
-    if os.path.exists(progress_path):
-        with open(progress_path, "r", encoding="utf-8") as pf:
-            progress_data = json.load(pf)
-            actual_downloaded = sum(t["downloaded"] for t in progress_data.values())
-
     with open(log_path, "w", encoding="utf-8") as lg:
         lg.write(f"API URL       : {api_url}\n")
         lg.write(f"Format        : geojsonl\n")
-        lg.write(f"Output file   : {final}\n")
+        lg.write(f"Output files  : {final}\n")
+        if query:
+            lg.write(f"Query params  : {json_backend.dumps_line(query).decode().strip()}\n")
         lg.write(f"Expected total: {total}\n")
-        lg.write(f"Downloaded    : {actual_downloaded}\n")  
+        lg.write(f"Downloaded    : {downloaded}\n")
         lg.write(f"Start time    : {start_time}\n")
         lg.write(f"End time      : {end_time}\n")
         lg.write(f"Elapsed       : {end_time - start_time}\n")
+    return log_path
+
+def interactive():
+    print("""
+========================================
+GeoJSON (line-delimited) Downloader
+========================================
+""")
+    print("Please select a folder to start download")
+    folder = choose_folder_dialog()
+    basename = prompt("2) Enter output base name (no extension):")
+    api_url = prompt("3) Enter API service URL:")
+    only_l = prompt("4) Only output geojsonl? (y/n):", "n").lower().startswith("y")
+    extra = [f.strip().lower() for f in prompt("   Extra output formats (geojsonl.zst,geojsonl.gz,parquet,fgb; blank = none):", "").split(",")]
+    extra = [f for f in extra if f]
+    if any(f not in SINKS for f in extra):
+        print(f"Warning: unknown output format in {extra}, choose from {sorted(SINKS)}")
+        sys.exit(1)
+
+    manifest = load_manifest(folder, basename)
+    if (manifest and manifest.get("api_url") == api_url
+            and os.path.exists(os.path.join(folder, f"{basename}.geojsonl"))):
+        if prompt("   A previous download exists. Refresh it incrementally? (y/n):", "y").lower().startswith("y"):
+            result = refresh_layer(api_url, folder, basename)
+            print(f"\n>>> Done in {datetime.now() - result['start_time']} <<<")
+            return
+
+    concurrency = int(prompt("5) Max concurrent requests:", str(CONCURRENCY)))
+    paging = prompt("6) Paging mode (keyset/offset):", "keyset").lower()
+    profile = prompt(f"7) Download profile ({'/'.join(PROFILES)}):", PROFILE).lower()
+    if profile not in PROFILES:
+        print(f"Warning: unknown download profile {profile}, choose from {', '.join(PROFILES)}")
+        sys.exit(1)
+    fields = [f.strip() for f in prompt("   Fields to keep (comma-separated; blank = profile default):", "").split(",")]
+    fields = [f for f in fields if f]
+
+    result = download_layer(api_url, folder, basename, concurrency, paging, profile=profile, fields=fields)
+    if result["failed_pages"]:
+        print(f"{result['failed_pages']} pages failed; run again with the same folder and name to resume them.")
+        return
+
+    confirm = input("\nDownload finished. Merge now? (y/n): ").lower()
+    if confirm != "y":
+        print("Skipping merge. You can inspect the geojsonl part file manually.")
+        return
 
-    print(f"\n>>> Done in {end_time - start_time}, log: {log_path} <<<")
+    formats = ["geojsonl"] + ([] if only_l else ["geojson"])
+    formats += [f for f in extra if f not in formats]
+    final = ", ".join(merge_geojsonl(folder, basename, formats, result["oid_field"]))
+    write_manifest(folder, basename, api_url=api_url, oid_field=result["oid_field"],
+                   edit_field=result["edit_field"], edit_max=result["edit_max"],
+                   features=result["downloaded"], formats=formats, mode="full", query=result["query"])
+
+    log_path = write_download_log(folder, basename, api_url, final, result["total"], result["downloaded"],
+                                  result["start_time"], result["query"])
+    print(f"\n>>> Done in {datetime.now() - result['start_time']}, log: {log_path} <<<")
+
+def main(argv=None):
+    """Download (or incrementally refresh) one layer without dialogs or prompts; returns
+    the exit code (0 done, 1 failed pages or features that could not be fetched)."""
+    parser = argparse.ArgumentParser(description="Download an ArcGIS FeatureServer layer to GeoJSONL.")
+    parser.add_argument("url", help="layer URL, e.g. .../FeatureServer/0")
+    parser.add_argument("--folder", required=True, help="download folder (parts, journal and outputs)")
+    parser.add_argument("--name", required=True, help="output base name (no extension)")
+    parser.add_argument("--formats", help=f"comma-separated, any of {','.join(sorted(SINKS))} "
+                                           "(default: geojsonl,geojson; a refresh keeps the previous formats)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--paging", choices=["keyset", "offset"], default="keyset")
+    parser.add_argument("--download-profile", choices=list(PROFILES), default=PROFILE,
+                        help="fields and geometry precision / generalization the server sends")
+    parser.add_argument("--fields", help="comma-separated fields to keep (the OBJECTID field is always kept)")
+    parser.add_argument("--no-merge", action="store_true", help="leave the .part file unmerged")
+    parser.add_argument("--http-cache", action=argparse.BooleanOptionalAction, default=USE_HTTP_CACHE,
+                        help=f"cache feature pages and layer info in <folder>/{HTTP_CACHE} for re-runs")
+    parser.add_argument("--incremental", action="store_true",
+                        help="refresh a previous download of the same URL from its manifest when there is one")
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    formats = [f.strip() for f in (args.formats or "").lower().split(",") if f.strip()] or None
+    if formats and "geojsonl" not in formats:
+        formats.insert(0, "geojsonl")  # the merge and the manifest work from the .geojsonl
+    unknown = [f for f in formats or [] if f not in SINKS]
+    if unknown:
+        parser.error(f"unknown format(s): {', '.join(unknown)}")
+    os.makedirs(args.folder, exist_ok=True)
+
+    manifest = load_manifest(args.folder, args.name)
+    if (args.incremental and manifest and manifest.get("api_url") == args.url
+            and os.path.exists(os.path.join(args.folder, f"{args.name}.geojsonl"))):
+        result = refresh_layer(args.url, args.folder, args.name, formats)
+        print(f"\n>>> Done in {datetime.now() - result['start_time']} <<<")
+        return 1 if result["unfetched"] else 0
+
+    fields = [f.strip() for f in (args.fields or "").split(",") if f.strip()]
+    result = download_layer(args.url, args.folder, args.name, args.concurrency, args.paging,
+                            profile=args.download_profile, fields=fields, http_cache=args.http_cache)
+    if result["failed_pages"]:
+        print(f"{result['failed_pages']} pages failed; run again with the same folder and name to resume them.")
+        return 1
+    if args.no_merge:
+        return 0
+
+    formats = formats or ["geojsonl", "geojson"]
+    final = ", ".join(merge_geojsonl(args.folder, args.name, formats, result["oid_field"]))
+    write_manifest(args.folder, args.name, api_url=args.url, oid_field=result["oid_field"],
+                   edit_field=result["edit_field"], edit_max=result["edit_max"],
+                   features=result["downloaded"], formats=formats, mode="full", query=result["query"])
+    log_path = write_download_log(args.folder, args.name, args.url, final, result["total"], result["downloaded"],
+                                  result["start_time"], result["query"])
+    print(f"\n>>> Done in {datetime.now() - result['start_time']}, log: {log_path} <<<")
+    return 0
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Headless CLI: no dialogs, prompts or "Press Enter"
+        sys.exit(main())
     try:
-        main()
+        interactive()
     except Exception:
         print("\nAn unexpected error occurred:\n")
         traceback.print_exc()
@@ -256,4 +467,4 @@ if __name__ == "__main__":
         try:
             input("\nPress Enter to close this window...")
         except EOFError:
-            pass
\ No newline at end of file
+            pass
@@ -0,0 +1,263 @@
+# 0001_batch_download.py
+# Purpose: Headless batch refresh of many ArcGIS layers from one job file.
+# Each layer runs download -> merge -> audit -> patch -> convert with no prompts or
+# dialogs; layers run concurrently, and every request draws from a per-host and a
+# global concurrency budget so the whole batch can use the full bandwidth without
+# overloading any one server. One summary manifest is written for the batch.
+#
+# Usage: python 0001_batch_download.py jobs.json [--metrics batch.jsonl | batch.prom] [--profile sample]
+#
+# Job file (JSON); everything except "jobs" is optional:
+# {
+#   "output_dir": "D:/refresh/2025-06",
+#   "max_jobs": 4,                      # layers running at once
+#   "global_concurrency": 64,           # requests in flight across all layers
+#   "per_host_concurrency": 16,         # requests in flight per server
+#   "defaults": {"paging": "keyset", "concurrency": 8, "formats": ["geojsonl", "parquet"], "patch": true,
+#                "http_cache": false,          # true: cache responses in <layer folder>/.http_cache
+#                "download_profile": "tiles-z10", "fields": ["NAME", "ZONE"]},  # see arcgis_client.PROFILES
+#   "jobs": [
+#     {"name": "nfhl_flood_zones", "url": "https://hazards.fema.gov/.../NFHL/MapServer/28"},
+#     {"name": "nfhl", "service": "https://hazards.fema.gov/.../NFHL/MapServer", "layers": [27, 28]},
+#     {"name": "hud", "service": "https://services.arcgis.com/.../FeatureServer", "layers": "all",
+#      "formats": ["geojsonl", "fgb"]}
+#   ]
+# }
+# A "service" entry expands to one job per layer, named <name>_<layer id>.
+# With "incremental": true, a layer whose folder already holds a finished download
+# (and its _manifest.json) is refreshed with only what changed (see delta_refresh.py).
+# "download_profile" is a PROFILES name or a dict of query parameters, e.g.
+# {"geometryPrecision": 5, "quantizationParameters": {"mode": "view", "tolerance": 0.0001}};
+# the patch and later refreshes fetch with the same parameters as the download.
+
+import argparse
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urlparse
+
+from arcgis_client import (PROFILES, TASK_BACKOFF, TASK_BACKOFF_CAP, BudgetedLimiter, get_object_ids,
+                           get_service_layers, make_session)
+from delta_refresh import load_manifest, refresh_layer, write_manifest
+from feature_sinks import SINKS, convert_geojsonl
+import metrics
+
+downloader = importlib.import_module("0000_geojsonl_downloader")
+patcher = importlib.import_module("000_patch_missing_features")
+
+# Config (defaults; the job file can override each of them)
+MAX_JOBS = 4
+GLOBAL_CONCURRENCY = 64
+PER_HOST_CONCURRENCY = 16
+JOB_RETRIES = 3          # attempts per layer; each retry resumes the download from its journal
+JOB_DEFAULTS = {"paging": "keyset", "concurrency": 8, "formats": ["geojsonl"], "patch": True, "incremental": False,
+                "http_cache": False, "download_profile": "full", "fields": None}
+
+
+def safe_name(name):
+    return re.sub(r"[^\w.-]+", "_", str(name)).strip("_") or "layer"
+
+
+def expand_jobs(spec, session):
+    """Turn the job file's entries into one job dict per layer (defaults applied)."""
+    defaults = {**JOB_DEFAULTS, **spec.get("defaults", {})}
+    jobs = []
+    for entry in spec["jobs"]:
+        entry = {**defaults, **entry}
+        if "service" in entry:
+            service = entry["service"].rstrip("/")
+            layers = entry.get("layers", "all")
+            if layers == "all":
+                layers = [layer_id for layer_id, _ in get_service_layers(session, service)]
+            prefix = entry.get("name") or urlparse(service).path.strip("/").split("/")[-2]
+            for layer_id in layers:
+                jobs.append({**entry, "url": f"{service}/{layer_id}", "name": safe_name(f"{prefix}_{layer_id}")})
+        else:
+            entry["url"] = entry["url"].rstrip("/")
+            entry["name"] = safe_name(entry.get("name") or urlparse(entry["url"]).path.strip("/").replace("/", "_"))
+            jobs.append(entry)
+    names = [job["name"] for job in jobs]
+    dupes = sorted({n for n in names if names.count(n) > 1})
+    if dupes:
+        raise ValueError(f"Job names must be unique (they name the output folders): {dupes}")
+    for job in jobs:
+        unknown = [f for f in job["formats"] if f not in SINKS]
+        if unknown:
+            raise ValueError(f"{job['name']}: unknown output format(s) {unknown}")
+        if isinstance(job["download_profile"], str) and job["download_profile"] not in PROFILES:
+            raise ValueError(f"{job['name']}: unknown download profile {job['download_profile']!r}, "
+                             f"choose from {list(PROFILES)} or give a dict of query parameters")
+    return jobs
+
+
+def run_job(job, output_dir, budgets):
+    """download -> merge -> audit -> patch -> convert for one layer; returns its summary entry.
+
+    A failed attempt (e.g. the server dropping a metadata request) is retried after a
+    jittered backoff. Steps already done are not repeated: the download resumes from
+    its journal, and a finished merge or patch is remembered in `state`.
+    """
+    name, url = job["name"], job["url"]
+    folder = os.path.join(output_dir, name)
+    os.makedirs(folder, exist_ok=True)
+    summary = {"name": name, "url": url, "folder": folder, "status": "failed",
+               "started": datetime.now().isoformat(timespec="seconds")}
+    retries = job.get("retries", JOB_RETRIES)
+    state = {}
+    for attempt in range(retries):
+        summary.pop("error", None)
+        _run_job_once(job, folder, budgets, summary, state)
+        if "error" not in summary or attempt + 1 == retries:
+            break
+        delay = random.uniform(0, min(TASK_BACKOFF_CAP, TASK_BACKOFF * 4 ** (attempt + 1)))
+        print(f"[{name}] attempt {attempt+1}/{retries} failed ({summary['error']}); retrying in {delay:.0f}s")
+        time.sleep(delay)
+    summary["attempts"] = attempt + 1
+    summary["finished"] = datetime.now().isoformat(timespec="seconds")
+    return summary
+
+
+def _run_job_once(job, folder, budgets, summary, state):
+    name, url = job["name"], job["url"]
+    formats = ["geojsonl"] + [f for f in job["formats"] if f != "geojsonl"]
+    geojsonl = os.path.join(folder, f"{name}.geojsonl")
+    try:
+        host_budget, global_budget = budgets(urlparse(url).netloc)
+        limit = min(job.get("max_concurrency", PER_HOST_CONCURRENCY), host_budget.limit)
+        limiter = BudgetedLimiter([host_budget.semaphore, global_budget],
+                                  initial=min(job["concurrency"], limit), maximum=limit)
+        manifest = load_manifest(folder, name)
+        refreshing = job["incremental"] and manifest and os.path.exists(geojsonl) and "result" not in state
+        # a refresh has to see the server's current answers, so it never reads the cache
+        cache = job["http_cache"] and not refreshing
+        session = make_session(limit, cache_dir=os.path.join(folder, downloader.HTTP_CACHE) if cache else None)
+
+        if refreshing:
+            refresh = refresh_layer(url, folder, name, formats, session=session, limiter=limiter)
+            summary.update(mode=refresh["mode"], fetched=refresh["fetched"], removed=refresh["removed"],
+                           unfetched=refresh["unfetched"], features=refresh["features"], outputs=refresh["outputs"],
+                           status="ok" if not refresh["unfetched"] else "partial")
+            return
+
+        if "result" not in state:
+            # 1) download (resumes from the journal if the folder holds an unfinished run)
+            result = downloader.download_layer(url, folder, name, job["concurrency"], job["paging"],
+                                               session=session, limiter=limiter,
+                                               profile=job["download_profile"], fields=job["fields"])
+            summary.update(total=result["total"], downloaded=result["downloaded"])
+            if result["failed_pages"]:
+                # retried by run_job; the next attempt only fetches the failed pages
+                summary.update(status="incomplete", failed_pages=result["failed_pages"],
+                               error=f"{result['failed_pages']} pages failed")
+                return
+
+            # 2) merge: every format in one pass; non-GeoJSONL ones are rebuilt only if patching adds features
+            state["outputs"] = downloader.merge_geojsonl(folder, name, formats, result["oid_field"])
+            state["result"] = result
+        result, outputs = state["result"], state["outputs"]
+
+        # 3) audit against the server's ID list (falls back to 1..total)
+        oid_field = result["oid_field"]
+        expected_ids = get_object_ids(session, url)
+        audit = patcher.audit_objectids(geojsonl, expected_ids,
+                                        None if expected_ids is not None else result["total"], oid_field)
+        duplicates = patcher.find_duplicate_objectids(audit, geojsonl.replace(".geojsonl", "_duplicates.csv"))
+        summary.update(features=int(audit["unique"]), duplicates=len(duplicates), missing=int(len(audit["missing"])))
+
+        # 4) patch missing OBJECTIDs, 5) convert the patched file to the other formats
+        if job["patch"] and len(audit["missing"]) and "patch" not in state:
+            state["patch"] = patcher.patch_missing(url, geojsonl, audit, oid_field, session=session, limiter=limiter,
+                                                   query=result["query"])
+            state["converted"] = not state["patch"]["patched"]
+            summary["features"] += state["patch"]["patched"]
+        if "patch" in state:
+            summary.update(patched=state["patch"]["patched"], unfetched=state["patch"]["unfetched"])
+            if not state["converted"] and len(formats) > 1:
+                convert_geojsonl(geojsonl, os.path.join(folder, name), formats[1:])
+                state["converted"] = True
+
+        downloader.write_download_log(folder, name, url, ", ".join(outputs), result["total"],
+                                      result["downloaded"], result["start_time"], result["query"])
+        write_manifest(folder, name, api_url=url, oid_field=oid_field, edit_field=result["edit_field"],
+                       edit_max=result["edit_max"], features=summary["features"], formats=formats, mode="full",
+                       query=result["query"])
+        summary.pop("failed_pages", None)
+        summary.update(outputs=outputs, status="ok" if not summary.get("unfetched") else "partial")
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+
+
+class _HostBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+
+def run_batch(spec, job_file=None):
+    """Run every job in a parsed job file; returns the summary manifest (also written to disk)."""
+    output_dir = spec.get("output_dir") or os.path.dirname(os.path.abspath(job_file or "."))
+    os.makedirs(output_dir, exist_ok=True)
+    per_host = spec.get("per_host_concurrency", PER_HOST_CONCURRENCY)
+    global_budget = threading.BoundedSemaphore(spec.get("global_concurrency", GLOBAL_CONCURRENCY))
+    hosts = {}
+    hosts_lock = threading.Lock()
+
+    def budgets(host):
+        with hosts_lock:
+            if host not in hosts:
+                hosts[host] = _HostBudget(per_host)
+            return hosts[host], global_budget
+
+    jobs = expand_jobs(spec, make_session(4))
+    manifest_path = os.path.join(output_dir, "batch_summary.json")
+    manifest = {"job_file": job_file, "output_dir": output_dir,
+                "started": datetime.now().isoformat(timespec="seconds"), "jobs": []}
+    print(f"Batch: {len(jobs)} layers, {spec.get('max_jobs', MAX_JOBS)} at a time -> {output_dir}")
+
+    def save():
+        tmp = manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as mf:
+            json.dump(manifest, mf, indent=2)
+        os.replace(tmp, manifest_path)
+
+    with ThreadPoolExecutor(max_workers=spec.get("max_jobs", MAX_JOBS)) as pool:
+        futures = {pool.submit(run_job, job, output_dir, budgets): job for job in jobs}
+        for future in as_completed(futures):
+            entry = future.result()
+            manifest["jobs"].append(entry)
+            save()  # keep the manifest current while the rest of the batch runs
+            print(f"[{entry['name']}] {entry['status']}"
+                  + (f": {entry.get('features', 0):,} features" if entry["status"] != "failed" else f": {entry.get('error')}"))
+
+    manifest["jobs"].sort(key=lambda e: e["name"])
+    manifest["finished"] = datetime.now().isoformat(timespec="seconds")
+    manifest["status"] = {s: sum(e["status"] == s for e in manifest["jobs"])
+                          for s in ("ok", "partial", "incomplete", "failed")}
+    save()
+    print(f"Summary manifest: {manifest_path}")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download, merge, audit, patch and convert many ArcGIS layers.")
+    parser.add_argument("job_file", help="JSON job file (see the header of this script)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    with open(args.job_file, "r", encoding="utf-8") as jf:
+        spec = json.load(jf)
+    manifest = run_batch(spec, args.job_file)
+    return 0 if manifest["status"]["ok"] == len(manifest["jobs"]) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
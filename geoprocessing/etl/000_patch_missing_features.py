@@ -1,141 +1,278 @@
 # patch_missing_features.py
 # Purpose: Inspect a merged .geojsonl, report duplicates, and patch missing OBJECTIDs from an API.
 # Flow:
-# 1) Ask for API URL and select a target .geojsonl file
-# 2) Report duplicate OBJECTIDs (and save a CSV report)
-# 3) Identify missing OBJECTIDs, fetch them from the API, and append to the file
+# 1) Ask for API URL and select a target .geojsonl file (plain, .zst or .gz),
+#    or pass both on the command line (see main)
+# 2) Audit the file in one pass: duplicate OBJECTIDs (saved to a CSV report) and missing OBJECTIDs
+# 3) Fetch the missing OBJECTIDs from the API and append them to the file, with the same
+#    fields and geometry precision as the download (its _manifest.json, or --download-profile)
 
+import argparse
 import json
-import requests
 import os
-from collections import Counter
-from tkinter import Tk
-from tkinter.filedialog import askopenfilename
+import sys
 from datetime import datetime
 
-# Read existing OBJECTIDs from a line-delimited GeoJSON file
-def extract_existing_objectids(geojsonl_path):
-    object_ids = set()
-    with open(geojsonl_path, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                feat = json.loads(line)
-                oid = feat.get("properties", {}).get("OBJECTID")
-                if oid is not None:
-                    object_ids.add(oid)
-            except Exception as e:
-                print(f"Warning: Error reading line: {e}")
-    return object_ids
-
-# Count occurrences of OBJECTIDs and log duplicates to CSV if requested
-def find_duplicate_objectids(geojsonl_path, log_path=None):
-    counter = Counter()
-    with open(geojsonl_path, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                feat = json.loads(line)
-                oid = feat.get("properties", {}).get("OBJECTID")
-                if oid is not None:
-                    counter[oid] += 1
-            except Exception as e:
-                print(f"Warning: Error parsing line: {e}")
-
-    duplicates = {k: v for k, v in counter.items() if v > 1}
-    print(f"\nFound {len(duplicates)} duplicate OBJECTIDs.")
-    for oid, count in sorted(duplicates.items(), key=lambda x: -x[1])[:10]:
-        print(f"  - OBJECTID {oid} appears {count} times")
+import numpy as np
+
+from arcgis_client import (PROFILES, AdaptiveLimiter, fetch_ordered, get_layer_info, get_object_id_field,
+                           get_object_ids, is_transient, make_session, query_params, request_json)
+from compressed_io import open_write, strip_ext
+from http_cache import session_cache
+from oid_index import audit_oids, id_runs
+import json_backend
+import metrics
+
+CHUNK_SIZE = 500    # IDs per request (common ArcGIS maxRecordCount)
+CONCURRENCY = 8     # patch requests in flight
+HTTP_CACHE = ".http_cache"  # response cache folder next to the .geojsonl, see http_cache.py
+USE_HTTP_CACHE = False      # cache responses there (opt-in: --http-cache)
+
+# Single pass over the file: OID count array -> duplicates and missing IDs.
+# expected_ids is the server's real ID list; without it IDs are assumed to be 1..expected_total.
+def audit_objectids(geojsonl_path, expected_ids=None, expected_total=None, oid_field="OBJECTID"):
+    audit = audit_oids(geojsonl_path, expected_ids, expected_total, field=oid_field)
+    print(f"Lines: {audit['lines']:,}, unique OBJECTIDs: {audit['unique']:,}")
+    if audit["without_oid"]:
+        print(f"Warning: {audit['without_oid']:,} lines have no {oid_field}")
+    if audit["unexpected"]:
+        print(f"Warning: {audit['unexpected']:,} OBJECTIDs are not on the server (deleted upstream?)")
+    return audit
+
+# Report duplicate OBJECTIDs from an audit and log them to CSV if requested
+def find_duplicate_objectids(audit, log_path=None):
+    dup_ids, dup_counts = audit["duplicate_ids"], audit["duplicate_counts"]
+    print(f"\nFound {len(dup_ids)} duplicate OBJECTIDs.")
+    for i in np.argsort(-dup_counts, kind="stable")[:10]:
+        print(f"  - OBJECTID {dup_ids[i]} appears {dup_counts[i]} times")
 
     if log_path:
         with open(log_path, "w", encoding="utf-8") as logf:
             logf.write("objectid,count\n")
-            for oid, count in sorted(duplicates.items()):
+            for oid, count in zip(dup_ids.tolist(), dup_counts.tolist()):
                 logf.write(f"{oid},{count}\n")
             print(f"Duplicate report saved to: {log_path}")
 
-    if not duplicates:
+    if not len(dup_ids):
         print("No duplicate OBJECTIDs found.")
-    return duplicates
-
-# Fetch features from the API by a list of OBJECTIDs (batched)
-def fetch_features(api_url, objectid_list):
-    features = []
-    headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    ids = list(objectid_list)
-    chunk_size = 500  # common ArcGIS constraint
-    for i in range(0, len(ids), chunk_size):
-        chunk = ids[i:i+chunk_size]
-        where = f"OBJECTID in ({','.join(map(str, chunk))})"
-        params = {
-            "where": where,
-            "outFields": "*",
-            "f": "geojson"
-        }
-        try:
-            r = requests.get(api_url + "/query", params=params, timeout=60)
-            r.raise_for_status()
-            data = r.json()
-            feats = data.get("features", [])
-            features.extend(feats)
-            print(f"Retrieved {len(feats)} features for OBJECTIDs {chunk[0]}-{chunk[-1]}")
-        except Exception as e:
-            print(f"Failed to fetch chunk {chunk[0]}-{chunk[-1]}: {e}")
-    return features
-
-# Determine missing OBJECTIDs and append fetched features to the file
-def patch_missing(api_url, geojsonl_path, expected_total):
-    existing_ids = extract_existing_objectids(geojsonl_path)
-    print(f"Existing OBJECTIDs: {len(existing_ids)}")
-
-    missing_ids = [i for i in range(1, expected_total+1) if i not in existing_ids]
-    print(f"Missing OBJECTIDs: {len(missing_ids)}")
-
-    if not missing_ids:
+    return dict(zip(dup_ids.tolist(), dup_counts.tolist()))
+
+# Turn sorted ID runs into a compact WHERE clause: BETWEEN for runs, IN for singletons
+def build_where(oid_field, starts, ends):
+    clauses = []
+    singles = []
+    for a, b in zip(starts.tolist(), ends.tolist()):
+        if a == b:
+            singles.append(a)
+        else:
+            clauses.append(f"{oid_field} BETWEEN {a} AND {b}")
+    if singles:
+        clauses.append(f"{oid_field} IN ({','.join(map(str, singles))})")
+    return " OR ".join(clauses)
+
+# Fetch one chunk of IDs; when the server truncates or rejects the request, bisect so one
+# bad feature cannot sink the whole chunk. Overload / network errors (already retried by
+# request_json) fail the whole chunk instead: splitting it would only add load.
+# query is the download profile's parameters (None = every field, full precision).
+# Returns (features, unfetched) where unfetched maps OBJECTID -> reason.
+def fetch_chunk(session, limiter, api_url, ids, universe, oid_field, query=None):
+    starts, ends = id_runs(ids, universe)
+    data = {"where": build_where(oid_field, starts, ends), **(query or {"outFields": "*"}), "f": "geojson"}
+    try:
+        body = request_json(session, limiter, api_url + "/query", data=data, label=f"[{ids[0]}-{ids[-1]}] ")
+        feats = body.get("features", [])
+        truncated = body.get("exceededTransferLimit") or body.get("properties", {}).get("exceededTransferLimit")
+        if truncated and len(ids) > 1:
+            raise ValueError("exceededTransferLimit")
+    except Exception as e:
+        if len(ids) == 1 or is_transient(e):
+            return [], {int(oid): f"failed: {e}" for oid in ids.tolist()}
+        half = len(ids) // 2
+        print(f"Bisecting chunk {ids[0]}-{ids[-1]} after: {e}")
+        left = fetch_chunk(session, limiter, api_url, ids[:half], universe, oid_field, query)
+        right = fetch_chunk(session, limiter, api_url, ids[half:], universe, oid_field, query)
+        return left[0] + right[0], {**left[1], **right[1]}
+
+    # BETWEEN over plain integers can return IDs we already have; keep only the ones asked for
+    wanted = set(ids.tolist())
+    kept = []
+    for feat in feats:
+        oid = feat.get("properties", {}).get(oid_field, feat.get("id"))
+        if oid in wanted:
+            wanted.discard(oid)
+            kept.append(feat)
+    return kept, {oid: "not returned" for oid in wanted}
+
+# Fetch features from the API by OBJECTID, CHUNK_SIZE IDs per POST and up to `concurrency`
+# requests in flight. Yields (features, unfetched) per chunk, in chunk order, as they arrive.
+# session / limiter can be shared with other work (e.g. the batch orchestrator's budgets).
+def fetch_features(api_url, objectid_list, universe=None, oid_field="OBJECTID",
+                   concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE, session=None, limiter=None, query=None):
+    ids = np.asarray(objectid_list, dtype=np.int64)
+    chunks = [ids[i:i+chunk_size] for i in range(0, len(ids), chunk_size)]
+    session = session or make_session(concurrency)
+    limiter = limiter or AdaptiveLimiter(initial=concurrency, maximum=concurrency)
+    fetch = lambda chunk: fetch_chunk(session, limiter, api_url, chunk, universe, oid_field, query)
+    for chunk, (feats, unfetched) in fetch_ordered(chunks, fetch, max_workers=concurrency):
+        print(f"Retrieved {len(feats)} features for OBJECTIDs {chunk[0]}-{chunk[-1]}")
+        yield feats, unfetched
+
+# Fetch the audit's missing OBJECTIDs and stream them onto the end of the file.
+# query should match the download's profile (see load_query), so patched rows match the rest.
+# Returns {"requested", "patched", "unfetched"} counts.
+def patch_missing(api_url, geojsonl_path, audit, oid_field="OBJECTID", session=None, limiter=None, query=None):
+    missing_ids = audit["missing"]
+    starts, ends = audit["missing_runs"]
+    print(f"Missing OBJECTIDs: {len(missing_ids)} in {len(starts)} ranges")
+
+    if not len(missing_ids):
         print("No missing OBJECTIDs. Your data is complete.")
-        return
+        return {"requested": 0, "patched": 0, "unfetched": 0}
 
-    patch_feats = fetch_features(api_url, missing_ids)
-    with open(geojsonl_path, "a", encoding="utf-8") as fout:
-        for feat in patch_feats:
-            fout.write(json.dumps(feat, ensure_ascii=False) + "\n")
-    print(f"Patched {len(patch_feats)} missing features.")
+    patched_ids = []
+    unfetched = {}
+    with metrics.stage("patch"), open_write(geojsonl_path, append=True) as fout:  # .zst / .gz get new frames / members
+        for feats, failed in fetch_features(api_url, missing_ids, audit["expected_ids"], oid_field,
+                                            session=session, limiter=limiter, query=query):
+            data = b"".join(json_backend.dumps_line(feat) for feat in feats)
+            fout.write(data)
+            patched_ids.extend(feat.get("properties", {}).get(oid_field, feat.get("id")) for feat in feats)
+            fout.flush()
+            metrics.count("patch_features_total", len(feats))
+            metrics.count("patch_bytes_out_total", len(data))
+            unfetched.update(failed)
+    print(f"Patched {len(patched_ids)} missing features.")
 
     # Write patch log (summary of appended features)
-    patch_log = geojsonl_path.replace(".geojsonl", "_patch_log.txt")
+    patch_log = strip_ext(geojsonl_path) + "_patch_log.txt"
     with open(patch_log, "w", encoding="utf-8") as logf:
-        logf.write(f"Patched {len(patch_feats)} features\n")
-        logf.write(f"OBJECTIDs: {[f.get('properties', {}).get('OBJECTID') for f in patch_feats]}\n")
+        logf.write(f"Patched {len(patched_ids)} features\n")
+        logf.write(f"OBJECTIDs: {patched_ids}\n")
     print(f"Patch log saved to: {patch_log}")
 
-# CLI entrypoint: collect inputs and run checks/patch
-def main():
-    api_url = input("Please Enter API URL: ").strip()
+    # Machine-readable list of IDs that could not be fetched (input for a later re-run)
+    unfetched_path = strip_ext(geojsonl_path) + "_unfetched.json"
+    with open(unfetched_path, "w", encoding="utf-8") as uf:
+        json.dump({
+            "api_url": api_url,
+            "requested": int(len(missing_ids)),
+            "patched": len(patched_ids),
+            "unfetched": [{"objectid": oid, "reason": reason} for oid, reason in sorted(unfetched.items())],
+        }, uf)
+    if unfetched:
+        print(f"Warning: {len(unfetched)} OBJECTIDs could not be fetched, see: {unfetched_path}")
+    return {"requested": int(len(missing_ids)), "patched": len(patched_ids), "unfetched": len(unfetched)}
+
+# Query parameters the file was downloaded with, from its _manifest.json (None if unknown)
+def load_query(geojsonl_path):
+    path = strip_ext(geojsonl_path) + "_manifest.json"
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as mf:
+        return json_backend.loads(mf.read()).get("query")
+
+def audit_and_patch(api_url, geojsonl_path, expected_total=None, patch=True, session=None,
+                    profile=None, fields=None, http_cache=USE_HTTP_CACHE):
+    """Audit a .geojsonl against the server's OBJECTIDs, report duplicates and (with
+    patch=True) append the missing features. expected_total is only needed when the
+    server cannot list its IDs; raises ValueError when it is needed and missing.
+    Missing features are fetched like the download was (its manifest), unless a
+    profile / fields are given (see arcgis_client.query_params). http_cache caches the
+    fresh session's responses next to the file; the ID list is always asked for anew.
+    Returns {"audit", "duplicates", "patch"} (patch is None when not patching)."""
+    if session is None:
+        cache_dir = os.path.join(os.path.dirname(geojsonl_path), HTTP_CACHE) if http_cache else None
+        session = make_session(CONCURRENCY, cache_dir=cache_dir)
+    # Prefer the server's real ID list; fall back to assuming IDs run 1..N
+    oid_field = get_object_id_field(get_layer_info(session, api_url))
+    expected_ids = get_object_ids(session, api_url)
+    if expected_ids is not None:
+        print(f"Server reports {len(expected_ids):,} OBJECTIDs")
+        expected_total = None
+    elif expected_total is None:
+        raise ValueError("The server does not list its OBJECTIDs; the expected total number of features is needed")
+
+    print("\nAuditing OBJECTIDs...")
+    audit = audit_objectids(geojsonl_path, expected_ids, expected_total, oid_field)
+    dup_log_path = strip_ext(geojsonl_path) + "_duplicates.csv"
+    duplicates = find_duplicate_objectids(audit, log_path=dup_log_path)
+
+    result = None
+    if patch:
+        print("\nPatching missing features...")
+        if profile or fields:
+            query = query_params(profile or "full", fields, oid_field)
+        else:
+            query = load_query(geojsonl_path)
+        result = patch_missing(api_url, geojsonl_path, audit, oid_field, session=session, query=query)
+    if session_cache(session):
+        print(session_cache(session).summary())
+    return {"audit": audit, "duplicates": duplicates, "patch": result}
+
+# Interactive entrypoint: collect inputs and run checks/patch
+def interactive():
+    from tkinter import Tk  # only the interactive mode needs a display
+    from tkinter.filedialog import askopenfilename
+    api_url = input("Please Enter API URL: ").strip().rstrip("/")
 
     # Select target merged .geojsonl via file dialog
     root = Tk()
     root.withdraw()
-    geojsonl_path = askopenfilename(title="选择合并后的 .geojsonl 文件", filetypes=[("GeoJSONL", "*.geojsonl")])
+    geojsonl_path = askopenfilename(title="选择合并后的 .geojsonl 文件", filetypes=[("GeoJSONL", "*.geojsonl *.geojsonl.zst *.geojsonl.gz")])
     root.destroy()
 
     if not geojsonl_path:
         print("No file selected, exitting...")
         return
 
-    expected_total = int(input("Enter expected total number of features: ").strip())
-
     if not os.path.exists(geojsonl_path):
         print("Provided .geojsonl file does not exist.")
         return
 
-    print("\nChecking for duplicates...")
-    dup_log_path = geojsonl_path.replace(".geojsonl", "_duplicates.csv")
-    find_duplicate_objectids(geojsonl_path, log_path=dup_log_path)
+    try:
+        audit_and_patch(api_url, geojsonl_path)
+    except ValueError as e:
+        print(e)
+        expected_total = int(input("Enter expected total number of features: ").strip())
+        audit_and_patch(api_url, geojsonl_path, expected_total)
 
-    print("\nChecking and patching missing features...")
-    patch_missing(api_url, geojsonl_path, expected_total)
+# Headless entrypoint
+def main(argv=None):
+    """Audit / patch without dialogs or prompts; returns the exit code
+    (0 complete, 1 missing IDs left unpatched or could not be fetched)."""
+    parser = argparse.ArgumentParser(description="Audit a merged .geojsonl against an ArcGIS layer and patch missing OBJECTIDs.")
+    parser.add_argument("url", help="layer URL, e.g. .../FeatureServer/0")
+    parser.add_argument("geojsonl", help="merged .geojsonl (plain, .zst or .gz)")
+    parser.add_argument("--expected-total", type=int,
+                        help="number of features, for servers that cannot list their OBJECTIDs")
+    parser.add_argument("--no-patch", action="store_true", help="only audit and report")
+    parser.add_argument("--download-profile", choices=list(PROFILES),
+                        help="fields and geometry precision to fetch with (default: as the download, from its manifest)")
+    parser.add_argument("--fields", help="comma-separated fields to fetch (the OBJECTID field is always kept)")
+    parser.add_argument("--http-cache", action=argparse.BooleanOptionalAction, default=USE_HTTP_CACHE,
+                        help=f"cache layer info and feature responses in {HTTP_CACHE} next to the file")
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    if not os.path.exists(args.geojsonl):
+        parser.error(f"{args.geojsonl} does not exist")
+    try:
+        fields = [f.strip() for f in (args.fields or "").split(",") if f.strip()]
+        result = audit_and_patch(args.url.rstrip("/"), args.geojsonl, args.expected_total, not args.no_patch,
+                                 profile=args.download_profile, fields=fields, http_cache=args.http_cache)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 1
+    if result["patch"] is None:
+        return 1 if len(result["audit"]["missing"]) else 0
+    return 1 if result["patch"]["unfetched"] else 0
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        # Headless CLI: no dialogs, prompts or "Press Enter"
+        sys.exit(main())
     try:
-        main()
+        interactive()
     except Exception:
         print("\nAn unexpected error occurred:\n")
         import traceback
@@ -144,4 +281,4 @@ if __name__ == "__main__":
         try:
             input("\nPress Enter to close this window...")
         except EOFError:
-            pass
\ No newline at end of file
+            pass
@@ -1,23 +1,34 @@
 import geopandas as gpd
+import json
+import numpy as np
 import os
-import threading
-from tkinter import Tk, filedialog
+import shapely
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from math import ceil
+import argparse
 import sys
+import time
 import traceback
 
-print("""
-========================================
-Large Data Splitter (FEMA)
-========================================
+from geometry_repair import format_stats, repair_geometries
+from gpkg_index import get_fid_column, get_geometry_column, get_rtree_table, plan_fid_ranges
+from spatial_sort import hilbert_keys, zorder_keys
+import metrics
 
-Select a GeoPackage to split into shards...
-""")
+# Config
+SHARDS = 10                        # default target; max features / max MB per shard can raise it
+BATCH_ROWS = 200_000               # rows a worker holds in memory at once
+WORKERS = min(SHARDS, os.cpu_count() or 1)
+PARTITION = "hilbert"              # rows (FID ranges) | hilbert | zorder
+REPAIR_GEOMETRY = False            # make_valid invalid geometries while writing shards (geometry_repair.py)
 
 # --- File selection dialog helper ---
 def select_file():
     """Open a file dialog to pick a .gpkg and return its path."""
     try:
+        from tkinter import Tk, filedialog  # only the interactive mode needs a display
         root = Tk()
         root.withdraw()
         file_path = filedialog.askopenfilename(
@@ -32,113 +43,324 @@ def select_file():
         input("Press Enter to exit...")
         sys.exit(1)
 
-# --- Writer for a chunk into a single-layer GPKG ---
-def save_chunk_to_single_layer_gpkg(gdf_chunk, out_path, layer_name, thread_idx):
-    """Write a GeoDataFrame chunk into a GPKG layer; runs in a thread."""
-    try:
-        total = len(gdf_chunk)
-        if total == 0:
-            print(f"[Thread {thread_idx}] No features to write for {out_path}")
-            return
-
-        print(f"[Thread {thread_idx}] Writing {total} features to {out_path} (layer: {layer_name})")
-        gdf_chunk.to_file(out_path, driver='GPKG', layer=layer_name)
-        print(f"[Thread {thread_idx}] Completed {out_path}")
+# --- Shard planning straight from the GeoPackage's SQLite tables ---
+def read_feature_bounds(gpkg_path, layer_name, fid_col, batch_rows=BATCH_ROWS * 5):
+    """Return (fids, bounds[n, 4]) for every feature, bounds as minx, miny, maxx, maxy.
 
-    except Exception as e:
-        # Log and surface errors (also attempt a GUI message if possible)
-        print(f"ERROR: Failed saving chunk to {out_path}: {e}")
-        traceback.print_exc()
+    Reads the R-tree's stored extents when the layer has one (no geometry is decoded);
+    otherwise falls back to reading geometries in FID batches.
+    """
+    geom_col = get_geometry_column(gpkg_path, layer_name)
+    rtree = get_rtree_table(gpkg_path, layer_name, geom_col)
+    fids, bounds = [], []
+    if rtree:
+        con = sqlite3.connect(gpkg_path)
         try:
-            from tkinter import messagebox
-            messagebox.showerror("Save Error", f"Error saving chunk to {out_path}:\n{e}")
-        except:
-            pass
-        input("Press Enter to exit...")
-        os._exit(1)  # Force exit all threads
+            cur = con.execute(f'SELECT id, minx, miny, maxx, maxy FROM "{rtree}"')
+            while True:
+                rows = cur.fetchmany(batch_rows)
+                if not rows:
+                    break
+                arr = np.array(rows, dtype=np.float64)
+                fids.append(arr[:, 0].astype(np.int64))
+                bounds.append(arr[:, 1:])
+        finally:
+            con.close()
+    else:
+        print("No R-tree index found; reading geometries for extents (run 01_create_space_index_for_gpkg.bat to speed this up)")
+        for lo, hi, _ in plan_fid_ranges(gpkg_path, layer_name, fid_col, SHARDS * 10):
+            gdf = gpd.read_file(gpkg_path, layer=layer_name, columns=[], fid_as_index=True,
+                                where=f'"{fid_col}" BETWEEN {lo} AND {hi}')
+            gdf = gdf[~gdf.geometry.is_empty & gdf.geometry.notna()]
+            fids.append(gdf.index.to_numpy(dtype=np.int64))
+            bounds.append(gdf.geometry.bounds.to_numpy())
+    if not fids:
+        return np.empty(0, dtype=np.int64), np.empty((0, 4))
+    return np.concatenate(fids), np.concatenate(bounds)
+
+def read_feature_weights(gpkg_path, layer_name, fid_col):
+    """Return (fids, weights) in FID order, weight = stored geometry blob size in bytes.
 
-# --- Main pipeline ---
-def main():
+    The GPKG blob is a header plus ~16 bytes per 2D vertex, so its length is a cheap
+    proxy for both shard byte size and vertex count; SQLite's length() reads it without
+    decoding the geometry.
+    """
+    geom_col = get_geometry_column(gpkg_path, layer_name)
+    con = sqlite3.connect(gpkg_path)
     try:
-        # 1) Input selection
-        print("Please select the .gpkg file")
-        input_path = select_file()
-        if not input_path:
-            print("No file selected. Exiting.")
-            input("Press Enter to exit...")
-            return
+        cur = con.execute(f'SELECT "{fid_col}", COALESCE(length("{geom_col}"), 0) FROM "{layer_name}" '
+                          f'ORDER BY "{fid_col}"')
+        fids, weights = [], []
+        while True:
+            rows = cur.fetchmany(BATCH_ROWS * 5)
+            if not rows:
+                break
+            arr = np.array(rows, dtype=np.int64)
+            fids.append(arr[:, 0])
+            weights.append(arr[:, 1])
+    finally:
+        con.close()
+    if not fids:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(fids), np.concatenate(weights)
 
-        # 2) List layers and pick the first one
-        print(f"Reading GeoPackage: {input_path}")
-        import fiona
-        try:
-            layers = fiona.listlayers(input_path)
-        except Exception as e:
-            print(f"ERROR: Failed reading layers: {e}")
-            traceback.print_exc()
-            input("Press Enter to exit...")
-            return
+def cut_balanced(weights, shards=None, max_features=None, max_bytes=None):
+    """Cut an ordered weight array into contiguous runs of roughly equal cost.
+
+    Each feature costs the largest of its share of a 1/shards weight slice,
+    weight / max_bytes and 1 / max_features, so a run costing <= 1 is balanced and
+    respects both limits. The shard count is max(shards, ceil(total cost)), raised
+    until every run fits (a single feature heavier than max_bytes gets its own shard).
+    Returns boundary indexes [0, ..., n].
+    """
+    n = len(weights)
+    if n == 0:
+        return np.array([0])
+    weights = weights.astype(np.float64)
+    cost = weights / max(weights.sum(), 1.0) * (shards or 1)
+    if max_bytes:
+        cost = np.maximum(cost, weights / max_bytes)
+    if max_features:
+        cost = np.maximum(cost, 1.0 / max_features)
+    cum = np.cumsum(cost)
+    cum_w = np.cumsum(weights)
+    k = max(shards or 1, ceil(cum[-1] - 1e-9))
+    while True:
+        k = min(k, n)
+        cuts = np.searchsorted(cum, cum[-1] * np.arange(1, k) / k, side="right")
+        bounds = np.unique(np.concatenate(([0], cuts, [n])))
+        sizes = np.diff(bounds)
+        run_weight = np.diff(np.concatenate(([0.0], cum_w[bounds[1:] - 1])))
+        too_many = max_features and sizes.max() > max_features
+        too_heavy = max_bytes and (run_weight[sizes > 1] > max_bytes).any()
+        if k >= n or not (too_many or too_heavy):
+            return bounds
+        k += 1
+
+def plan_shards(gpkg_path, layer_name, fid_col, partition=PARTITION, shards=SHARDS,
+                max_features=None, max_bytes=None):
+    """Plan shards balanced by geometry bytes.
+
+    rows: contiguous FID ranges. hilbert/zorder: features sorted along a space-filling
+    curve, so each shard is spatially compact with a tight bbox and downstream tiling
+    or bbox queries on one shard touch only its own region.
+    Returns a list of dicts with either lo/hi (FID range) or fids (sorted array),
+    plus count, weight and the planned bbox (None when unknown).
+    """
+    fids, weights = read_feature_weights(gpkg_path, layer_name, fid_col)
+    if len(fids) == 0:
+        return []
+    if partition == "rows":
+        bounds = cut_balanced(weights, shards, max_features, max_bytes)
+        return [{"lo": int(fids[a]), "hi": int(fids[b - 1]), "count": int(b - a),
+                 "weight": int(weights[a:b].sum()), "bbox": None}
+                for a, b in zip(bounds[:-1], bounds[1:])]
+
+    box_fids, boxes = read_feature_bounds(gpkg_path, layer_name, fid_col)
+    live = np.isin(box_fids, fids)  # a stale R-tree may still list deleted rows
+    box_fids, boxes = box_fids[live], boxes[live]
+    keys = hilbert_keys(boxes) if partition == "hilbert" else zorder_keys(boxes)
+    order = np.argsort(keys, kind="stable")
+    box_fids, boxes = box_fids[order], boxes[order]
+    pos = np.searchsorted(fids, box_fids)
+    ordered_weights = weights[np.clip(pos, 0, len(fids) - 1)]
+    bounds = cut_balanced(ordered_weights, shards, max_features, max_bytes)
+    plan = []
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        box = boxes[a:b]
+        plan.append({"fids": np.sort(box_fids[a:b]), "count": int(b - a),
+                     "weight": int(ordered_weights[a:b].sum()),
+                     "bbox": [float(box[:, 0].min()), float(box[:, 1].min()),
+                              float(box[:, 2].max()), float(box[:, 3].max())]})
+
+    # NULL/empty geometries have no extent (no R-tree row), so they get a shard of their own
+    unplaced = np.setdiff1d(fids, box_fids)
+    if len(unplaced):
+        print(f"{len(unplaced)} features without a geometry extent go to a separate shard")
+        plan.append({"fids": unplaced, "count": int(len(unplaced)),
+                     "weight": int(weights[np.searchsorted(fids, unplaced)].sum()), "bbox": None})
+    planned = sum(shard["count"] for shard in plan)
+    if planned != len(fids):
+        raise ValueError(f"Shard plan covers {planned} features but layer {layer_name} has {len(fids)}")
+    return plan
+
+# --- Worker: copy one planned shard into a single-layer GPKG ---
+def write_shard(input_path, layer_name, fid_col, shard, out_path, out_layer, batch_rows=BATCH_ROWS, repair=None):
+    """Runs in a worker process: copy one shard's features into out_path in batches.
+
+    Each worker opens the source itself and never holds more than one batch, so peak
+    memory is about one batch per worker whatever the layer size. FID ranges are read
+    with "fid BETWEEN", FID lists with "fid IN (...)" (rowid lookups in SQLite).
+    `repair` is None or keyword arguments for repair_geometries, run on each batch.
+    Returns the shard's manifest entry (counts, bbox, vertices, bytes, repair stats).
+    """
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    if "fids_path" in shard:
+        fids = np.load(shard["fids_path"])
+        batch_rows = min(batch_rows, 20_000)
+        wheres = (f'"{fid_col}" IN ({",".join(map(str, fids[i:i + batch_rows].tolist()))})'
+                  for i in range(0, len(fids), batch_rows))
+    else:
+        wheres = (f'"{fid_col}" BETWEEN {a} AND {min(a + batch_rows - 1, shard["hi"])}'
+                  for a in range(shard["lo"], shard["hi"] + 1, batch_rows))
+
+    written = vertices = 0
+    stats = Counter()
+    bbox = [np.inf, np.inf, -np.inf, -np.inf]
+    for where in wheres:
+        gdf = gpd.read_file(input_path, layer=layer_name, where=where)
+        if len(gdf) == 0:
+            continue
+        if repair is not None:
+            geoms, batch_stats = repair_geometries(gdf.geometry.values, **repair)
+            gdf = gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs))
+            stats.update(batch_stats)
+        gdf.to_file(out_path, driver='GPKG', layer=out_layer, mode="a" if written else "w")
+        written += len(gdf)
+        vertices += int(shapely.get_num_coordinates(gdf.geometry.values).sum())
+        minx, miny, maxx, maxy = gdf.total_bounds
+        if np.isfinite(minx):  # NaN when the batch has only NULL/empty geometries
+            bbox = [min(bbox[0], minx), min(bbox[1], miny), max(bbox[2], maxx), max(bbox[3], maxy)]
 
+    if "fids_path" in shard:
+        os.remove(shard["fids_path"])
+    return {
+        "index": shard["index"],
+        "path": out_path,
+        "layer": out_layer,
+        "features": written,
+        "vertices": vertices,
+        "bbox": [float(v) for v in bbox] if np.isfinite(bbox[0]) else None,
+        "bytes": os.path.getsize(out_path) if written else 0,
+        "planned_weight": shard["weight"],
+        "repair": dict(stats) if repair is not None else None,
+    }
+
+def write_manifest(output_dir, input_path, layer_name, partition, entries):
+    manifest_path = os.path.join(output_dir, "shards_manifest.json")
+    with open(manifest_path, "w", encoding="utf-8") as mf:
+        json.dump({
+            "source": input_path,
+            "layer": layer_name,
+            "partition": partition,
+            "features": sum(e["features"] for e in entries),
+            "shards": sorted(entries, key=lambda e: e["index"]),
+        }, mf, indent=2)
+    return manifest_path
+
+def prompt_number(msg, default=None):
+    v = input(msg + (" " if default is None else f"[{default}] ")).strip()
+    return float(v) if v else default
+
+# --- Library entry point ---
+def split_gpkg(input_path, layer_name=None, partition=PARTITION, shards=SHARDS, max_features=None,
+               max_bytes=None, repair=None, output_dir=None, workers=WORKERS):
+    """Split one layer of a GeoPackage into balanced single-layer shard GPKGs.
+
+    layer_name defaults to the first layer; output_dir to <stem>_split_<n>parts next to
+    the input. `repair` is None or keyword arguments for repair_geometries.
+    Returns {"output_dir", "manifest", "features", "shards", "failed"} (failed lists the
+    shard paths that could not be written); raises ValueError for an empty input.
+    """
+    import fiona
+    start_time = time.time()
+    if layer_name is None:
+        layers = fiona.listlayers(input_path)
         if not layers:
-            print("ERROR: No layers found.")
-            input("Press Enter to exit...")
-            return
+            raise ValueError(f"No layers found in {input_path}")
         layer_name = layers[0]
         print(f"Using first layer: {layer_name}")
 
-        # 3) Read the chosen layer into memory (timed)
-        import time
-        try:
-            start_time = time.time()
-            gdf = gpd.read_file(input_path, layer=layer_name)
-            elapsed = time.time() - start_time
-            print(f"File read completed in {elapsed:.2f} seconds.")
-        except Exception as e:
-            print(f"ERROR: Failed reading file: {e}")
-            traceback.print_exc()
-            input("Press Enter to exit...")
-            return
+    # Plan shards (the layer itself is never loaded here)
+    fid_col = get_fid_column(input_path, layer_name)
+    with metrics.stage("split_plan"):
+        plan = plan_shards(input_path, layer_name, fid_col, partition, shards, max_features, max_bytes)
+    total = sum(shard["count"] for shard in plan)
+    print(f"Total features: {total} in {len(plan)} shards (planned in {time.time() - start_time:.2f} seconds)")
+    if total == 0:
+        raise ValueError(f"No features found in layer {layer_name}")
 
-        # 4) Validate features count
-        total = len(gdf)
-        print(f"Total features: {total}")
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    output_dir = output_dir or os.path.join(os.path.dirname(input_path), f"{stem}_split_{len(plan)}parts")
+    os.makedirs(output_dir, exist_ok=True)
 
-        if total == 0:
-            print("ERROR: No features found in the layer.")
-            input("Press Enter to exit...")
-            return
+    # One task per shard on a process pool; each worker reads only its own FIDs
+    failed = []
+    entries = []
+    with metrics.stage("split"), ProcessPoolExecutor(max_workers=min(workers, len(plan))) as pool:
+        futures = {}
+        for i, shard in enumerate(plan):
+            shard["index"] = i + 1
+            layer = f"{stem}_split_{i+1}"
+            out_file = os.path.join(output_dir, f"{layer}.gpkg")
+            if "fids" in shard:
+                shard["fids_path"] = os.path.join(output_dir, f"{layer}_fids.npy")
+                np.save(shard["fids_path"], shard.pop("fids"))
+                where = ("bbox (" + ", ".join(f"{v:.4f}" for v in shard["bbox"]) + ")"
+                         if shard["bbox"] else "no geometry extent")
+            else:
+                where = f"{fid_col} {shard['lo']} to {shard['hi']}"
+            print(f"Writing {shard['count']} features, {shard['weight'] / 1e6:.1f} MB geometry, "
+                  f"{where} --> {out_file} (layer: {layer})")
+            futures[pool.submit(write_shard, input_path, layer_name, fid_col, shard, out_file, layer,
+                                 BATCH_ROWS, repair)] = out_file
 
-        # 5) Determine chunk size and output directory
-        chunk_size = ceil(total / 10)
-        threads = []
-        output_dir = os.path.join(os.path.dirname(input_path), "floodzone_split_10parts")
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-        except Exception as e:
-            print(f"❌ Error creating output directory: {e}")
-            traceback.print_exc()
+        for future in as_completed(futures):
+            try:
+                entry = future.result()
+                entries.append(entry)
+                metrics.count("split_features_total", entry["features"])
+                metrics.count("split_bytes_out_total", os.path.getsize(entry["path"]))
+                print(f"[Shard {entry['index']}] Completed {entry['path']} ({entry['features']} features, "
+                      f"{entry['vertices']} vertices, {entry['bytes'] / 1e6:.1f} MB)")
+            except Exception as e:
+                print(f"ERROR: Failed saving chunk to {futures[future]}: {e}")
+                failed.append(futures[future])
+
+    # Manifest and report
+    manifest_path = write_manifest(output_dir, input_path, layer_name, partition, entries)
+    print(f"Shard manifest saved to: {manifest_path}")
+    if repair is not None:
+        print("Geometry repair:")
+        print(format_stats(sum((Counter(e["repair"]) for e in entries), Counter())))
+    elapsed = time.time() - start_time
+    if failed:
+        print(f"ERROR: {len(failed)} of {len(futures)} chunks failed: {failed}")
+    else:
+        print(f"All {len(futures)} chunks saved to: {output_dir} in {elapsed:.2f} seconds")
+    return {"output_dir": output_dir, "manifest": manifest_path, "features": sum(e["features"] for e in entries),
+            "shards": len(plan), "failed": failed}
+
+# --- Interactive mode (file dialog + prompts) ---
+def interactive():
+    print("""
+========================================
+Large Data Splitter (FEMA)
+========================================
+
+Select a GeoPackage to split into shards...
+""")
+    try:
+        print("Please select the .gpkg file")
+        input_path = select_file()
+        if not input_path:
+            print("No file selected. Exiting.")
             input("Press Enter to exit...")
             return
 
-        # 6) Create and start threads to write each chunk
-        for i in range(10):
-            start = i * chunk_size
-            end = min((i + 1) * chunk_size, total)
-            gdf_chunk = gdf.iloc[start:end]
-            out_file = os.path.join(output_dir, f"flood_split_{i+1}.gpkg")
-            layer = f"flood_split_{i+1}"
-            print(f"Writing features {start} to {end} --> {out_file} (layer: {layer})")
-
-            t = threading.Thread(target=save_chunk_to_single_layer_gpkg, args=(gdf_chunk, out_file, layer, i+1))
-            t.start()
-            threads.append(t)
-
-        # 7) Wait for all threads to finish
-        for t in threads:
-            t.join()
-
-        # 8) Report completion
-        print(f"All 10 chunks saved to: {output_dir}")
+        print(f"Reading GeoPackage: {input_path}")
+        partition = (input(f"Partition mode (rows/hilbert/zorder) [{PARTITION}]: ").strip().lower()
+                     or PARTITION)
+        shards = int(prompt_number("Target number of shards:", SHARDS))
+        max_features = prompt_number("Max features per shard (blank = no limit):")
+        max_mb = prompt_number("Max MB of geometry per shard (blank = no limit):")
+        max_features = int(max_features) if max_features else None
+        max_bytes = int(max_mb * 1024 * 1024) if max_mb else None
+        repair = input(f"Repair invalid geometries? (y/n) [{'y' if REPAIR_GEOMETRY else 'n'}]: ").strip().lower()
+        repair = {} if (repair == 'y' if repair else REPAIR_GEOMETRY) else None
+
+        split_gpkg(input_path, None, partition, shards, max_features, max_bytes, repair)
         input("Press Enter to exit...")
 
     except Exception as e:
@@ -147,5 +369,33 @@ def main():
         traceback.print_exc()
         input("Press Enter to exit...")
 
+# --- Command line (headless) ---
+def main(argv=None):
+    """Split a GeoPackage without dialogs or prompts; returns the exit code
+    (0 all shards written, 1 some shards failed or nothing to split)."""
+    parser = argparse.ArgumentParser(description="Split one layer of a GeoPackage into balanced shard GPKGs.")
+    parser.add_argument("input", help="input .gpkg")
+    parser.add_argument("--layer", help="layer to split (default: the first one)")
+    parser.add_argument("--partition", choices=["rows", "hilbert", "zorder"], default=PARTITION)
+    parser.add_argument("--shards", type=int, default=SHARDS, help="target number of shards")
+    parser.add_argument("--max-features", type=int, help="max features per shard")
+    parser.add_argument("--max-mb", type=float, help="max MB of geometry per shard")
+    parser.add_argument("--repair", action=argparse.BooleanOptionalAction, default=REPAIR_GEOMETRY,
+                        help="make_valid invalid geometries while writing")
+    parser.add_argument("--output-dir", help="default: <input stem>_split_<n>parts next to the input")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    try:
+        result = split_gpkg(args.input, args.layer, args.partition, args.shards, args.max_features,
+                            int(args.max_mb * 1024 * 1024) if args.max_mb else None,
+                            {} if args.repair else None, args.output_dir, args.workers)
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        return 1
+    return 1 if result["failed"] else 0
+
 if __name__ == "__main__":
-    main()
+    # With arguments: headless CLI; without: the interactive dialog and prompts
+    sys.exit(main()) if len(sys.argv) > 1 else interactive()
@@ -1,92 +1,297 @@
+import argparse
 import fiona
+import math
 import os
-import json
 import pandas as pd
-import numpy as np
-from shapely.geometry import mapping, shape
-from shapely.geometry.base import BaseGeometry
-from shapely import wkt
-from tkinter import Tk, filedialog
+import pyarrow as pa
+import shapely
+import pyogrio
+import queue
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import zip_longest
 from tqdm import tqdm
 
-print("""
-========================================
-GeoPackage to GeoJSON (line-delimited) Convertor 
-========================================
+from columnar_sinks import unify_schemas
+from compressed_io import open_write
+from feature_sinks import BATCH_FORMATS, EXTENSIONS, GEOJSONL_FORMATS, open_sinks
+from geometry_repair import format_stats, repair_geometries
+from gpkg_index import fid_batches, get_fid_column
+import json_backend
+import metrics
 
-Select a GeoPackage to convert into geojsonl...
-""")
+# Config
+BATCH_ROWS = 50_000                      # features per worker task
+WORKERS = os.cpu_count() or 1
+QUEUE_BATCHES = None                     # batches in flight or awaiting the writer; None = 2 per worker
+WRITE_BUFFER = 32 * 1024 * 1024          # bytes of GeoJSONL coalesced per output file before each write
+FORMATS = ("geojsonl",)                  # any of geojsonl, geojsonl.zst, geojsonl.gz, parquet, fgb (see feature_sinks.py)
+REPAIR_GEOMETRY = False                  # run make_valid on invalid geometries (see geometry_repair.py)
+GRID_SIZE = None                         # with repair: snap coordinates to this grid, e.g. 1e-7
+SIMPLIFY_TOLERANCE = None                # with repair: topology-preserving simplify, e.g. 1e-5
+
+def _json_values(column):
+    """One property column as JSON-ready Python values: missing / non-finite -> None,
+    timestamps -> ISO strings, numpy scalars -> int / float (which encode to the
+    shortest text that reads back as the same double)."""
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return [None if pd.isna(v) else v.isoformat() for v in column.tolist()]
+    return [None if v is None or v is pd.NA or (isinstance(v, float) and not math.isfinite(v)) else v
+            for v in column.tolist()]
+
+def _attributes(df, int_fields):
+    """The property columns of a layer read, integer fields back as nullable integers."""
+    attrs = pd.DataFrame(df.drop(columns=df.geometry.name))
+    for name in int_fields:
+        if name in attrs.columns and not pd.api.types.is_integer_dtype(attrs[name]):
+            attrs[name] = attrs[name].astype("Int64")
+    return attrs
+
+def convert_batch(gpkg_path, layer, fid_col, lo, hi, repair=None, formats=FORMATS, int_fields=()):
+    """Runs in a worker process: convert FIDs [lo, hi] of a layer to GeoJSONL bytes.
+
+    Geometries are encoded in one vectorized shapely.to_geojson call; properties are
+    pulled out column by column and each record is encoded with json_backend (nulls ->
+    null, timestamps -> ISO strings), so no per-feature shape()/mapping() runs in Python.
+    int_fields are the layer's integer fields: pyogrio reads them as float64 when they
+    hold nulls, so they are turned back into nullable integers before either output.
+    `repair` is None or keyword arguments for repair_geometries. When GeoParquet or
+    FlatGeobuf output is requested the batch is also returned as a pyarrow table
+    (properties + WKB geometry), built straight from the DataFrame without JSON.
+    Returns (features read, features written, utf-8 bytes, arrow table or None, repair stats,
+    this worker's metrics for metrics.merge).
+    """
+    with metrics.timed("convert_read_seconds"):
+        df = pyogrio.read_dataframe(gpkg_path, layer=layer, where=f'"{fid_col}" BETWEEN {lo} AND {hi}')
+    if len(df) == 0:
+        return 0, 0, b"", None, Counter(), metrics.drain()
+    started = time.perf_counter()
+    geoms = df.geometry.values
+    stats = Counter()
+    if repair is not None:
+        geoms, stats = repair_geometries(geoms, **repair)
+    keep = ~shapely.is_missing(geoms)  # skip features with null geometry
+    attrs = _attributes(df[keep], int_fields)
+    table = None
+    if any(f in BATCH_FORMATS for f in formats):
+        table = pa.Table.from_pandas(attrs, preserve_index=False).append_column(
+            "geometry", pa.array(shapely.to_wkb(geoms[keep]), type=pa.binary()))
+    if not any(f in GEOJSONL_FORMATS for f in formats):
+        metrics.observe("convert_serialize_seconds", time.perf_counter() - started)
+        return len(df), int(keep.sum()), b"", table, stats, metrics.drain()
+    geoms = shapely.to_geojson(geoms[keep])
+    names = list(attrs.columns)
+    rows = zip(*(_json_values(attrs[name]) for name in names)) if names else ([] for _ in geoms)
+    props = [json_backend.dumps_line(dict(zip(names, row))) for row in rows]
+    if len(props) != len(geoms):
+        raise ValueError(f"{layer} FIDs {lo}-{hi}: {len(props)} property records for {len(geoms)} geometries")
+    lines = [b'{"type":"Feature","geometry":' + g.encode("utf-8") + b',"properties":' + p[:-1] + b'}\n'
+             for g, p in zip(geoms, props)]
+    data = b"".join(lines)
+    metrics.observe("convert_serialize_seconds", time.perf_counter() - started)
+    return len(df), len(lines), data, table, stats, metrics.drain()
 
-def convert_all_layers_to_geojsonl(gpkg_path):
+def plan_conversion(gpkg_path, repair_opts=None, formats=FORMATS):
+    """Cut every layer of a GeoPackage into FID batches (SQLite only, no features are read).
+
+    With GeoParquet / FlatGeobuf output, the layers' property schemas are unified here,
+    before anything is written, so layers with different fields share one output
+    (fields a layer lacks are null). Returns the job dict convert_gpkgs threads
+    through its feeder and writer.
+    """
+    layers = fiona.listlayers(gpkg_path)
+    if not layers:
+        raise ValueError("no layers found")
+    tasks, total, schemas = [], 0, []
+    for layer in layers:
+        fid_col = get_fid_column(gpkg_path, layer)
+        n, batches = fid_batches(gpkg_path, layer, fid_col, BATCH_ROWS)
+        total += n
+        info = pyogrio.read_info(gpkg_path, layer=layer)
+        int_fields = tuple(name for name, dtype in zip(info["fields"], info["dtypes"])
+                           if str(dtype).startswith(("int", "uint")))
+        tasks += [(gpkg_path, layer, fid_col, lo, hi, repair_opts, formats, int_fields) for lo, hi in batches]
+        if any(f in BATCH_FORMATS for f in formats):
+            empty = pyogrio.read_dataframe(gpkg_path, layer=layer, max_features=0)
+            schemas.append(pa.Schema.from_pandas(_attributes(empty, int_fields), preserve_index=False))
+    return {"path": gpkg_path, "base": os.path.splitext(gpkg_path)[0], "layers": layers, "tasks": tasks,
+            "total": total, "crs": pyogrio.read_info(gpkg_path, layer=layers[0])["crs"],
+            "schema": unify_schemas(schemas) if schemas else None,
+            "next": 0, "ready": {}, "buffer": [], "buffered": 0,
+            "read": 0, "written": 0, "repair": Counter(), "error": None}
+
+def _flush(job):
+    """Write the job's buffered GeoJSONL bytes in one call per output file."""
+    if not job["buffer"]:
+        return
+    started = time.perf_counter()
+    data = b"".join(job["buffer"])
+    for out_file in job["files"]:
+        out_file.write(data)
+    job["buffer"], job["buffered"] = [], 0
+    metrics.observe("convert_write_seconds", time.perf_counter() - started)
+
+def _finish(job, formats, repair):
+    """Flush and close a job's outputs and print its summary (writer thread).
+
+    Errors from the final flush or from closing an output (e.g. a GeoParquet footer or a
+    full disk) are recorded in job["error"] rather than raised, so they fail only this job.
+    """
     try:
-        out_path = os.path.splitext(gpkg_path)[0] + '.geojsonl'
-        print(f'Merging layers from: {gpkg_path}')
-
-        layers = fiona.listlayers(gpkg_path)
-        if not layers:
-            print(f"No layers found in {gpkg_path}")
-            return False, 0, 0
-
-        output_feature_count = 0
-        input_feature_count = 0
-
-        with open(out_path, 'w', encoding='utf-8') as out_file:
-            for layer in layers:
-                print(f"Reading layer: {layer}")
-                with fiona.open(gpkg_path, layer=layer) as src:
-                    input_feature_count += len(src)
-                    for feat in tqdm(src, total=len(src), desc=f"{os.path.basename(gpkg_path)}:{layer}"):
-                        try:
-                            raw_geometry = feat.get('geometry')
-                            if raw_geometry is None:
-                                continue  # skip features with null geometry
-
-                            # Convert to valid GeoJSON format using shapely
-                            try:
-                                geom = shape(raw_geometry)
-                                geometry = mapping(geom)
-                            except Exception as geom_error:
-                                print(f"Geometry conversion error: {geom_error}")
-                                continue
-
-                            props = {}
-                            for k, v in feat['properties'].items():
-                                if pd.isna(v):
-                                    props[k] = None
-                                elif isinstance(v, (np.generic, pd.Timestamp)):
-                                    props[k] = str(v)
-                                else:
-                                    props[k] = v
-
-                            feature = {
-                                "type": "Feature",
-                                "geometry": geometry,
-                                "properties": props
-                            }
-
-                            out_file.write(json.dumps(feature) + '\n')
-                            output_feature_count += 1
-                        except (TypeError, ValueError) as fe:
-                            print(f'JSON serialization error: {fe}')
-                            continue
-                        except Exception as fe:
-                            print(f'Skipped feature due to error: {fe}')
-                            continue
-
-        print(f'Saved to: {out_path}')
-        print(f'Total features written: {output_feature_count}')
-        if input_feature_count != output_feature_count:
-            print(f'Mismatch: read {input_feature_count}, wrote {output_feature_count}')
-        else:
-            print(f'All features written correctly')
-        return True, input_feature_count, output_feature_count
+        if job["error"] is None:
+            _flush(job)
+    except Exception as e:
+        job["error"] = e
+    try:
+        job["outputs"].close()
+    except Exception as e:
+        if job["error"] is None:
+            job["error"] = e
+    if job["error"] is not None:
+        tqdm.write(f'Failed to convert {job["path"]}: {job["error"]}')
+        return
+    lines = [f'Saved to: {", ".join(job["base"] + EXTENSIONS[f] for f in formats)}',
+             f'Total features written: {job["written"]}']
+    if repair:
+        lines += ['Geometry repair:', format_stats(job["repair"])]
+    if job["read"] != job["written"]:
+        lines.append(f'Mismatch: read {job["read"]}, wrote {job["written"]}')
+    else:
+        lines.append(f'All features written correctly')
+    tqdm.write("\n".join(lines))
+
+def _write_results(jobs, results, slots, bar, formats, repair):
+    """Writer thread: put each job's finished batches back in FID order and write them in
+    WRITE_BUFFER sized chunks. A batch's slot is released once its bytes are buffered, so at
+    most QUEUE_BATCHES results plus one buffer per output file are held in memory."""
+    remaining = sum(len(job["tasks"]) for job in jobs)
+    while remaining:
+        job, seq, future = results.get()
+        remaining -= 1
+        job["ready"][seq] = future
+        metrics.gauge("convert_reorder_depth", sum(len(j["ready"]) for j in jobs))
+        while job["next"] in job["ready"]:
+            future = job["ready"].pop(job["next"])
+            job["next"] += 1
+            try:
+                if future is None or job["error"] is not None:
+                    continue  # the job failed earlier; its remaining batches are dropped
+                n_read, n_written, data, table, stats, worker_metrics = future.result()
+                metrics.merge(worker_metrics)
+                if data:
+                    job["buffer"].append(data)
+                    job["buffered"] += len(data)
+                    if job["buffered"] >= WRITE_BUFFER:
+                        _flush(job)
+                if table is not None:
+                    job["sink"].write_table(table)
+                metrics.count("convert_features_total", n_written)
+                metrics.count("convert_bytes_out_total", len(data))
+                job["repair"].update(stats)
+                job["read"] += n_read
+                job["written"] += n_written
+                bar.update(n_read)
+            except Exception as e:
+                job["error"] = e
+            finally:
+                slots.release()
+            if job["next"] == len(job["tasks"]):
+                try:
+                    _finish(job, formats, repair)
+                except Exception as e:
+                    # keep the writer alive: other jobs' batches still hold slots
+                    job["error"] = job["error"] or e
+                    tqdm.write(f'Failed to convert {job["path"]}: {e}')
 
+def convert_gpkgs(gpkg_paths, workers=WORKERS, repair=REPAIR_GEOMETRY, formats=FORMATS):
+    """Convert every layer of several GeoPackages through one pipeline.
+
+    The feeder (this thread) submits FID batches of all layers and files round-robin to a
+    process pool, which reads and serializes them (convert_batch); a single writer thread
+    restores FID order per output file and writes large coalesced chunks. At most
+    QUEUE_BATCHES batches are in flight or waiting to be written, so memory stays bounded
+    however big the inputs, while reads, transforms and writes overlap.
+    Output is identical whatever the number of workers.
+    Returns {gpkg_path: (success, features read, features written)}.
+    """
+    repair_opts = dict(grid_size=GRID_SIZE, simplify_tolerance=SIMPLIFY_TOLERANCE) if repair else None
+    jobs, failed = [], {}
+    with ExitStack() as stack:
+        stack.enter_context(metrics.stage("convert"))
+        for gpkg_path in gpkg_paths:
+            print(f'Merging layers from: {gpkg_path}')
+            try:
+                job = plan_conversion(gpkg_path, repair_opts, formats)
+                # Each GeoJSONL variant (plain / .zst / .gz, see compressed_io.py) gets the same bytes;
+                # GeoParquet / FlatGeobuf take the columnar batches, with the first layer's CRS
+                outputs = ExitStack()
+                job["outputs"] = stack.enter_context(outputs)
+                job["files"] = [outputs.enter_context(open_write(job["base"] + EXTENSIONS[f]))
+                                for f in formats if f in GEOJSONL_FORMATS]
+                job["sink"] = outputs.enter_context(
+                    open_sinks(job["base"], [f for f in formats if f in BATCH_FORMATS], crs=job["crs"],
+                               schema=job["schema"]))
+            except Exception as e:
+                print(f'Failed to convert {gpkg_path}: {e}')
+                failed[gpkg_path] = (False, 0, 0)
+                continue
+            print(f'Layers: {", ".join(job["layers"])} ({job["total"]:,} features)')
+            jobs.append(job)
+
+        for job in jobs:
+            if not job["tasks"]:
+                _finish(job, formats, repair)
+        queue_batches = QUEUE_BATCHES or 2 * workers
+        slots = threading.BoundedSemaphore(queue_batches)
+        results = queue.Queue()
+        bar = stack.enter_context(tqdm(total=sum(job["total"] for job in jobs), desc="Converting"))
+        writer = threading.Thread(target=_write_results, args=(jobs, results, slots, bar, formats, repair),
+                                  name="convert-writer", daemon=True)
+        writer.start()
+        pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        submitted = 0
+        in_order = zip_longest(*[[(job, seq, task) for seq, task in enumerate(job["tasks"])] for job in jobs])
+        for job, seq, task in (t for batch in in_order for t in batch if t is not None):
+            slots.acquire()
+            submitted += 1
+            metrics.gauge("convert_queue_depth", submitted - sum(job["next"] for job in jobs))
+            if job["error"] is not None:
+                results.put((job, seq, None))
+                continue
+            future = pool.submit(convert_batch, *task)
+            future.add_done_callback(lambda f, job=job, seq=seq: results.put((job, seq, f)))
+        writer.join()
+
+    summary = {job["path"]: (job["error"] is None, job["read"], job["written"]) for job in jobs}
+    return {path: failed.get(path) or summary[path] for path in gpkg_paths}
+
+def convert_all_layers_to_geojsonl(gpkg_path, workers=WORKERS, repair=REPAIR_GEOMETRY, formats=FORMATS):
+    """Convert one GeoPackage; returns (success, features read, features written)."""
+    try:
+        return convert_gpkgs([gpkg_path], workers, repair, formats)[gpkg_path]
     except Exception as e:
         print(f'Failed to convert {gpkg_path}: {e}')
         return False, 0, 0
 
-if __name__ == '__main__':
+def interactive():
+    """Prompt for options, then convert GPKGs picked in a file dialog until the user stops."""
+    from tkinter import Tk, filedialog  # only the interactive mode needs a display
+    print("""
+========================================
+GeoPackage to GeoJSON (line-delimited) Convertor 
+========================================
+
+Select a GeoPackage to convert into geojsonl...
+""")
     try:
+        repair = input(f"Repair invalid geometries? (y/n) [{'y' if REPAIR_GEOMETRY else 'n'}]: ").strip().lower()
+        repair = REPAIR_GEOMETRY if not repair else repair == 'y'
+        formats = input(f"Output formats (geojsonl,geojsonl.zst,geojsonl.gz,parquet,fgb) [{','.join(FORMATS)}]: ").strip().lower()
+        formats = [f.strip() for f in formats.split(",") if f.strip()] or list(FORMATS)
         while True:
             Tk().withdraw()
             file_paths = filedialog.askopenfilenames(
@@ -101,15 +306,15 @@ if __name__ == '__main__':
                     break
                 continue
             else:
-                for gpkg in file_paths:
-                    try:
-                        success, input_count, output_count = convert_all_layers_to_geojsonl(gpkg)
+                try:
+                    results = convert_gpkgs(file_paths, repair=repair, formats=formats)
+                    for gpkg, (success, input_count, output_count) in results.items():
                         if not success:
                             print(f'Conversion failed for {gpkg}')
                         elif input_count != output_count:
                             print(f'Feature count mismatch for {gpkg}: input={input_count}, output={output_count}')
-                    except Exception as e:
-                        print(f'Unexpected error during conversion: {e}')
+                except Exception as e:
+                    print(f'Unexpected error during conversion: {e}')
 
             again = input("Do you want to convert more files? (y/n): ").strip().lower()
             if again != 'y':
@@ -126,4 +331,29 @@ if __name__ == '__main__':
         try:
             input("\nPress Enter to close this window...")
         except (EOFError, KeyboardInterrupt):
-            pass
\ No newline at end of file
+            pass
+
+def main(argv=None):
+    """Convert GeoPackages without dialogs or prompts; returns the exit code
+    (0 all converted with matching counts, 1 otherwise)."""
+    parser = argparse.ArgumentParser(description="Convert every layer of GeoPackages to GeoJSONL (and other formats).")
+    parser.add_argument("gpkg", nargs="+", help="input .gpkg file(s); outputs are written next to each")
+    parser.add_argument("--formats", default=",".join(FORMATS),
+                        help="comma-separated: geojsonl,geojsonl.zst,geojsonl.gz,parquet,fgb")
+    parser.add_argument("--repair", action=argparse.BooleanOptionalAction, default=REPAIR_GEOMETRY,
+                        help="make_valid invalid geometries")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    formats = [f.strip() for f in args.formats.lower().split(",") if f.strip()]
+    unknown = [f for f in formats if f not in EXTENSIONS]
+    if unknown:
+        parser.error(f"unknown format(s): {', '.join(unknown)}")
+    results = convert_gpkgs(args.gpkg, args.workers, args.repair, formats)
+    ok = all(success and input_count == output_count for success, input_count, output_count in results.values())
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    # With arguments: headless CLI; without: the interactive dialog and prompts
+    sys.exit(main()) if len(sys.argv) > 1 else interactive()
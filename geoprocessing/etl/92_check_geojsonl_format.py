@@ -1,64 +1,327 @@
+import argparse
 import json
+import mmap
 import os
-import tkinter as tk
-from tkinter import filedialog, messagebox
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
-print("""
-========================================
-Check GeoJSON (line-delimited) Format
-========================================
+import numpy as np
 
-Select a .geojsonl file to check format...
-""")
+import json_backend
+import metrics
+from compressed_io import codec, open_read, read_range, read_seek_table, seekable_ranges
 
-def check_geojsonl_format(file_path, max_lines=1000):
-    """Validate that a file is line-delimited GeoJSON (GeoJSONL).
+# Config
+WORKERS = os.cpu_count() or 1
+MAX_ERRORS = 1000          # per byte range; keeps the report small on badly broken files
+RANGES_PER_WORKER = 4      # more, smaller ranges even out slow regions
+STREAM_BLOCK = 32 * 1024 * 1024  # .gz / unseekable .zst: decompressed bytes sent to a worker at a time
+LONLAT_BOUNDS = True       # reject coordinates outside lon/lat ranges; off for projected CRSs (05 keeps the source CRS)
 
-    Reads up to max_lines, counting valid Feature lines vs invalid ones.
-    Shows a message box with the summary result.
+# GeoJSON geometry type -> nesting depth of "coordinates" above the position level
+COORD_DEPTH = {
+    "Point": 0,
+    "MultiPoint": 1,
+    "LineString": 1,
+    "MultiLineString": 2,
+    "Polygon": 2,
+    "MultiPolygon": 3,
+}
+
+def split_ranges(file_path, parts):
+    """Cut the file into `parts` byte ranges that start and end on line boundaries.
+
+    For a seekable .zst (compressed_io.py) the ranges are uncompressed offsets at
+    frame boundaries, which are line boundaries too. Returns None for compressed files
+    that cannot be split (.gz, .zst without seek table); those are streamed instead.
     """
-    valid_lines = 0
-    invalid_lines = 0
+    if codec(file_path):
+        frames = read_seek_table(file_path) if codec(file_path) == "zst" else None
+        return seekable_ranges(frames, parts) if frames else None
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, "rb") as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, bounds[-1]))
+            f.readline()  # move to the start of the next line
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _check_positions(coords, depth, arity, lonlat=True):
+    """Validate a coordinates array of the given nesting depth.
 
+    The innermost lists are converted with numpy in one call, so arity (2 or 3 numbers,
+    the same for every position), finiteness and (with lonlat) lon/lat ranges are
+    checked without a Python loop per vertex. Returns (error or None, position arity).
+    """
+    if depth > 1:
+        if not isinstance(coords, list):
+            return "coordinates nesting does not match geometry type", arity
+        for part in coords:
+            err, arity = _check_positions(part, depth - 1, arity, lonlat)
+            if err:
+                return err, arity
+        return None, arity
     try:
-        # Open file and check each non-empty line is a valid GeoJSON Feature
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                if i >= max_lines:
-                    break
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    obj = json.loads(line)
-                    if obj.get("type") != "Feature":
-                        invalid_lines += 1
+        arr = np.asarray(coords if depth == 1 else [coords], dtype=np.float64)
+    except (ValueError, TypeError):
+        return "positions have mixed arity or non-numeric values", arity
+    if arr.size == 0:
+        return None, arity
+    if arr.ndim != 2 or arr.shape[1] not in (2, 3):
+        return f"positions must have 2 or 3 numbers, got shape {arr.shape}", arity
+    if arity is not None and arr.shape[1] != arity:
+        return f"mixed coordinate arity ({arity} and {arr.shape[1]})", arity
+    if not np.isfinite(arr).all():
+        return "non-finite coordinate", arity
+    if lonlat and ((np.abs(arr[:, 0]) > 180).any() or (np.abs(arr[:, 1]) > 90).any()):
+        return "coordinate outside lon/lat bounds (not EPSG:4326? use --no-lonlat-bounds)", arity
+    return None, arr.shape[1]
+
+def check_geometry(geom, lonlat=True):
+    """Return an error string for an invalid GeoJSON geometry, else None.
+    lonlat=False skips the lon/lat range check (coordinates in a projected CRS)."""
+    if not isinstance(geom, dict):
+        return "geometry is not an object"
+    gtype = geom.get("type")
+    if gtype == "GeometryCollection":
+        for part in geom.get("geometries") or []:
+            err = check_geometry(part, lonlat)
+            if err:
+                return f"GeometryCollection member: {err}"
+        return None
+    if gtype not in COORD_DEPTH:
+        return f"unknown geometry type {gtype!r}"
+    coords = geom.get("coordinates")
+    if coords is None:
+        return "missing coordinates"
+    depth = COORD_DEPTH[gtype]
+    err, _ = _check_positions(coords, depth, None, lonlat)
+    if err:
+        return err
+    if gtype == "LineString" and len(coords) < 2:
+        return "LineString with fewer than 2 positions"
+    rings = [coords] if gtype == "Polygon" else coords if gtype == "MultiPolygon" else []
+    for polygon in rings:
+        for ring in polygon:
+            if len(ring) < 4:
+                return "polygon ring with fewer than 4 positions"
+            if ring[0] != ring[-1]:
+                return "polygon ring is not closed"
+    return None
+
+def _value_type(v):
+    if v is None:
+        return "null"
+    if isinstance(v, bool):
+        return "bool"
+    if isinstance(v, (int, float)):
+        return "number"
+    if isinstance(v, str):
+        return "string"
+    return "object" if isinstance(v, dict) else "array"
+
+def validate_range(file_path, start, end, max_errors=MAX_ERRORS, lonlat=LONLAT_BOUNDS):
+    """Runs in a worker process: validate every line in bytes [start, end).
+
+    Returns counts, the first max_errors errors as (byte offset, local line index,
+    message), geometry type counts and a property schema summary
+    {key: {type: [count, first offset]}}. Offsets into a .zst file are uncompressed.
+    """
+    if end <= start:
+        return validate_block(b"", start, max_errors, lonlat)
+    if codec(file_path) == "zst":
+        return validate_block(read_range(file_path, start, end), start, max_errors, lonlat)
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return _validate_lines(mm, start, end, 0, max_errors, lonlat)
+
+def validate_block(block, offset, max_errors=MAX_ERRORS, lonlat=LONLAT_BOUNDS):
+    """Runs in a worker process: validate a block of whole lines that starts at
+    uncompressed byte `offset` of its file (same result as validate_range)."""
+    return _validate_lines(block, 0, len(block), offset, max_errors, lonlat)
+
+def _validate_lines(data, start, end, base, max_errors, lonlat=LONLAT_BOUNDS):
+    # data is an mmap or bytes; reported offsets are base + position in data
+    result = {"start": base + start, "lines": 0, "valid": 0, "invalid": 0, "empty": 0,
+              "null_geometry": 0, "errors": [], "geometry_types": Counter(), "schema": {}}
+    pos = start
+    index = 0
+    while pos < end:
+        nl = data.find(b"\n", pos, end)
+        stop = end if nl == -1 else nl
+        line = data[pos:stop].strip()
+        error = None
+        if not line:
+            result["empty"] += 1
+        else:
+            try:
+                obj = json_backend.loads(line)
+            except ValueError as e:
+                error = f"invalid JSON: {e}"
+            if error is None:
+                if not isinstance(obj, dict) or obj.get("type") != "Feature":
+                    error = "not a GeoJSON Feature"  # also a bare null, number or array
+                else:
+                    geom = obj.get("geometry")
+                    if geom is None:
+                        result["null_geometry"] += 1
                     else:
-                        valid_lines += 1
-                except json.JSONDecodeError:
-                    invalid_lines += 1
+                        error = check_geometry(geom, lonlat)
+                        if not error:
+                            result["geometry_types"][geom.get("type")] += 1
+                    props = obj.get("properties")
+                    if props is not None and not isinstance(props, dict):
+                        error = error or "properties is not an object"
+                    elif props:
+                        for k, v in props.items():
+                            slot = result["schema"].setdefault(k, {}).setdefault(_value_type(v), [0, base + pos])
+                            slot[0] += 1
+            if error:
+                result["invalid"] += 1
+                if len(result["errors"]) < max_errors:
+                    result["errors"].append((base + pos, index, error))
+            else:
+                result["valid"] += 1
+        result["lines"] += 1
+        index += 1
+        pos = stop + 1
+    return result
+
+def merge_reports(file_path, results):
+    """Combine per-range results into one report with global line numbers."""
+    report = {"file": file_path, "bytes": os.path.getsize(file_path), "lines": 0, "valid": 0,
+              "invalid": 0, "empty": 0, "null_geometry": 0, "geometry_types": Counter(), "errors": []}
+    schema = {}
+    for r in sorted(results, key=lambda r: r["start"]):
+        for pos, index, msg in r["errors"]:
+            report["errors"].append({"offset": pos, "line": report["lines"] + index + 1, "error": msg})
+        for key in ("lines", "valid", "invalid", "empty", "null_geometry"):
+            report[key] += r[key]
+        report["geometry_types"].update(r["geometry_types"])
+        for k, types in r["schema"].items():
+            for t, (count, first) in types.items():
+                slot = schema.setdefault(k, {}).setdefault(t, [0, first])
+                slot[0] += count
+                slot[1] = min(slot[1], first)
+
+    # Schema consistency: keys missing from some features, or with more than one
+    # non-null value type (ogr2ogr picks one field type and may coerce the rest)
+    features = report["valid"] + report["invalid"]
+    issues = []
+    for k, types in sorted(schema.items()):
+        seen = sum(count for count, _ in types.values())
+        kinds = {t: {"count": c, "first_offset": first} for t, (c, first) in types.items()}
+        if len([t for t in types if t != "null"]) > 1:
+            issues.append({"property": k, "issue": "mixed value types", "types": kinds})
+        elif seen < features:
+            issues.append({"property": k, "issue": f"missing in {features - seen} features", "types": kinds})
+    report["schema"] = {k: sorted(types) for k, types in sorted(schema.items())}
+    report["schema_issues"] = issues
+    report["geometry_types"] = dict(report["geometry_types"])
+    return report
+
+def _stream_blocks(file_path, block_size=STREAM_BLOCK):
+    """Yield (uncompressed offset, block of whole lines) from any readable file."""
+    offset = 0
+    with open_read(file_path) as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block += f.readline()  # finish the last line
+            yield offset, block
+            offset += len(block)
+
+def check_geojsonl_format(file_path, workers=WORKERS, max_errors=MAX_ERRORS, show_dialog=True,
+                          lonlat=LONLAT_BOUNDS):
+    """Validate a whole line-delimited GeoJSON (GeoJSONL) file.
+
+    The file is cut into newline-aligned byte ranges that worker processes validate in
+    parallel from a read-only mmap: Feature type, geometry type, coordinate nesting and
+    arity, lon/lat bounds, ring closure, and property schema consistency. Writes a JSON
+    report next to the file, shows a summary and returns the report.
+    lonlat=False skips the lon/lat bounds check, for files in a projected CRS (the GPKG
+    converter writes GeoJSONL in the source layer's CRS).
+    A seekable .zst is split by its frames in the same way; a .gz is decompressed here
+    and its blocks handed to the workers.
+    """
+    try:
+        if os.path.getsize(file_path) == 0:
+            results = []
+        else:
+            ranges = split_ranges(file_path, max(1, workers * RANGES_PER_WORKER))
+            with metrics.stage("validate"), ProcessPoolExecutor(max_workers=workers) as pool:
+                if ranges is not None:
+                    futures = [pool.submit(validate_range, file_path, s, e, max_errors, lonlat) for s, e in ranges]
+                    results = [f.result() for f in futures]
+                else:
+                    results, pending = [], deque()
+                    for offset, block in _stream_blocks(file_path):
+                        pending.append(pool.submit(validate_block, block, offset, max_errors, lonlat))
+                        if len(pending) >= 2 * workers:
+                            results.append(pending.popleft().result())
+                    results += [f.result() for f in pending]
     except Exception as e:
         # Show error if the file cannot be opened/read
-        messagebox.showerror("Error", f"Error opening file: {e}")
-        return
+        if show_dialog:
+            from tkinter import messagebox
+            messagebox.showerror("Error", f"Error opening file: {e}")
+        else:
+            print(f"Error opening file: {e}")
+        return None
 
-    summary = f"Valid Feature lines: {valid_lines}\nInvalid or skipped lines: {invalid_lines}\n"
+    report = merge_reports(file_path, results)
+    metrics.count("validate_features_total", report["valid"] + report["invalid"])
+    metrics.count("validate_invalid_total", report["invalid"])
+    metrics.count("validate_bytes_in_total", os.path.getsize(file_path))
+    plain_path = os.path.splitext(file_path)[0] if codec(file_path) else file_path  # drop .zst / .gz
+    report_path = os.path.splitext(plain_path)[0] + "_validation.json"
+    with open(report_path, "w", encoding="utf-8") as rf:
+        json.dump(report, rf, indent=2)
+
+    valid_lines, invalid_lines = report["valid"], report["invalid"]
+    summary = (f"Valid Feature lines: {valid_lines}\nInvalid lines: {invalid_lines}\n"
+               f"Null geometries: {report['null_geometry']}\nSchema issues: {len(report['schema_issues'])}\n")
+    for err in report["errors"][:5]:
+        summary += f"  line {err['line']} (byte {err['offset']}): {err['error']}\n"
+    summary += f"Report: {report_path}\n"
     if valid_lines == 0:
         summary += "ERROR: This file is not a valid GeoJSONL file."
-        messagebox.showerror("Validation Result", summary)
+        level = "error"
     elif invalid_lines > 0:
         summary += "WARNING: Some lines are invalid GeoJSON Features."
-        messagebox.showwarning("Validation Result", summary)
+        level = "warning"
     else:
         summary += "OK: File is a valid GeoJSONL format for ogr2ogr."
-        messagebox.showinfo("Validation Result", summary)
+        level = "info"
+    print(summary)
+    if show_dialog:
+        from tkinter import messagebox  # only the interactive mode needs a display
+        {"error": messagebox.showerror, "warning": messagebox.showwarning,
+         "info": messagebox.showinfo}[level]("Validation Result", summary)
+    return report
 
-if __name__ == "__main__":
+def interactive():
+    """Pick a file in a dialog, validate it and show the result in a message box."""
+    from tkinter import Tk, filedialog  # only the interactive mode needs a display
+    print("""
+========================================
+Check GeoJSON (line-delimited) Format
+========================================
+
+Select a .geojsonl file to check format...
+""")
     try:
         # Prompt user to select a .geojsonl file
-        root = tk.Tk()
+        root = Tk()
         root.withdraw()
-        file_path = filedialog.askopenfilename(title="Select a GeoJSONL file to validate", filetypes=[("GeoJSONL Files", "*.geojsonl"), ("All Files", "*.*")])
+        file_path = filedialog.askopenfilename(title="Select a GeoJSONL file to validate", filetypes=[("GeoJSONL Files", "*.geojsonl *.geojsonl.zst *.geojsonl.gz"), ("All Files", "*.*")])
 
         if file_path and os.path.isfile(file_path):
             # Run validation and show results
@@ -78,3 +341,26 @@ if __name__ == "__main__":
             input("\nPress Enter to close this window...")
         except (EOFError, KeyboardInterrupt):
             pass
+
+def main(argv=None):
+    """Validate GeoJSONL files without dialogs; returns the exit code
+    (0 all valid, 1 invalid lines or unreadable file)."""
+    parser = argparse.ArgumentParser(description="Validate line-delimited GeoJSON (.geojsonl[.zst|.gz]) files.")
+    parser.add_argument("files", nargs="+", help="file(s) to check; a _validation.json report is written next to each")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--max-errors", type=int, default=MAX_ERRORS, help="errors kept per byte range")
+    parser.add_argument("--lonlat-bounds", action=argparse.BooleanOptionalAction, default=LONLAT_BOUNDS,
+                        help="reject coordinates outside lon/lat ranges (--no-lonlat-bounds for projected CRSs)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    metrics.configure(args.metrics, args.profile)
+    ok = True
+    for file_path in args.files:
+        report = check_geojsonl_format(file_path, args.workers, args.max_errors, show_dialog=False,
+                                       lonlat=args.lonlat_bounds)
+        ok = ok and report is not None and report["valid"] > 0 and report["invalid"] == 0
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    # With arguments: headless CLI; without: the interactive dialog
+    sys.exit(main()) if len(sys.argv) > 1 else interactive()
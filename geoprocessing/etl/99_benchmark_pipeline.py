@@ -0,0 +1,395 @@
+# 99_benchmark_pipeline.py
+# Purpose: Reproducible throughput benchmark of the ETL pipeline, so a change to the
+# downloader, the merge, the validator, the splitter or the converter can be measured
+# before it ships.
+# - download: 0000_geojsonl_downloader.download_layer against a local mock FeatureServer
+#   (mock_featureserver.py) with configurable latency, page size, error rate, empty
+#   pages and ID gaps
+# - merge: merge_geojsonl of the downloaded part file
+# - validate: 92_check_geojsonl_format on a synthetic .geojsonl
+# - split / convert: 04_split_gpkg_data_by_index and 05_convert_gpkg_to_geojsonl on a
+#   synthetic GeoPackage
+# Synthetic inputs (synthetic_data.py, 1M-50M features) are generated once per size
+# and reused. Every stage runs in a fresh process, so its peak RSS is its own; the
+# report gives features/s, MB/s, peak RSS and, for the download, p50 / p99 page latency.
+# With a stored baseline (--save-baseline) later runs exit with code 1 when a stage is
+# slower, or uses more memory, than the baseline allows (TOLERANCE).
+#
+# Usage: python 99_benchmark_pipeline.py --features 1000000 [--stages download,merge] [--save-baseline]
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+# Config
+FEATURES = 1_000_000
+GEOMETRY = "polygon"
+STAGES = ("download", "merge", "validate", "split", "convert")
+WORK_DIR = "benchmark_work"
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+TOLERANCE = 0.15          # allowed drop in features/s (and growth of p99 latency) against the baseline
+RSS_TOLERANCE = 0.25      # allowed growth of peak RSS
+WORKERS = os.cpu_count() or 1
+SERVER_PROCESSES = min(4, WORKERS)  # mock server processes
+SHARDS = 4
+SERVER_START_TIMEOUT = 30
+
+# Settings that must match for two runs to be comparable
+CONFIG_KEYS = ("features", "geometry", "page_size", "latency", "jitter", "error_rate", "empty_rate",
+               "gap_every", "max_ids", "server_processes", "concurrency", "paging", "download_profile",
+               "workers", "shards")
+
+
+# --- Synthetic inputs ---
+def data_name(config):
+    gaps = f"_gap{config['gap_every']}" if config["gap_every"] else ""
+    return f"{config['geometry']}_{config['features']}{gaps}"
+
+
+def prepare_inputs(config, stages):
+    """Generate the synthetic .geojsonl / .gpkg the stages need, unless they already exist."""
+    import synthetic_data
+    data_dir = os.path.join(config["work_dir"], "data")
+    os.makedirs(os.path.join(data_dir, "gpkg"), exist_ok=True)
+    args = (config["features"], config["geometry"], config["gap_every"])
+    if {"merge", "validate"} & set(stages) and not os.path.exists(geojsonl_input(config)):
+        print(f"Generating {geojsonl_input(config)} ...")
+        synthetic_data.write_geojsonl(geojsonl_input(config) + ".tmp", *args)
+        os.replace(geojsonl_input(config) + ".tmp", geojsonl_input(config))
+    if {"split", "convert"} & set(stages) and not os.path.exists(gpkg_input(config)):
+        print(f"Generating {gpkg_input(config)} ...")
+        synthetic_data.write_gpkg(gpkg_input(config) + ".tmp", *args, layer=data_name(config))
+        os.replace(gpkg_input(config) + ".tmp", gpkg_input(config))
+
+
+def geojsonl_input(config):
+    return os.path.join(config["work_dir"], "data", data_name(config) + ".geojsonl")
+
+
+def gpkg_input(config):
+    return os.path.join(config["work_dir"], "data", "gpkg", data_name(config) + ".gpkg")
+
+
+# --- Stages (each runs in its own process) ---
+def stage_download(config):
+    downloader = importlib.import_module("0000_geojsonl_downloader")
+    from arcgis_client import make_session
+    folder = os.path.join(config["work_dir"], "download")
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+    latencies, errors = [], [0]
+
+    def on_response(r, *args, **kwargs):
+        if "f=geojson" in (r.request.body or r.request.url or ""):
+            latencies.append(r.elapsed.total_seconds())
+        if r.status_code >= 500:
+            errors[0] += 1
+
+    session = make_session(max(config["concurrency"], downloader.MAX_CONCURRENCY))
+    session.hooks["response"].append(on_response)
+    started = time.perf_counter()
+    result = downloader.download_layer(config["url"], folder, "bench", config["concurrency"], config["paging"],
+                                       session=session, profile=config["download_profile"])
+    seconds = time.perf_counter() - started
+    part = os.path.join(folder, "bench_part.geojsonl")
+    return {"seconds": seconds, "features": result["downloaded"], "bytes": os.path.getsize(part),
+            "expected": result["total"], "failed_pages": result["failed_pages"], "pages": len(latencies),
+            "http_errors": errors[0],
+            "p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies else None,
+            "p99_ms": float(np.percentile(latencies, 99) * 1000) if latencies else None}
+
+
+def stage_merge(config):
+    downloader = importlib.import_module("0000_geojsonl_downloader")
+    folder = os.path.join(config["work_dir"], "download")
+    part = os.path.join(folder, "bench_part.geojsonl")
+    if not os.path.exists(part):
+        # merge on its own: merge the synthetic file as if it had been downloaded
+        os.makedirs(folder, exist_ok=True)
+        shutil.copyfile(geojsonl_input(config), part)
+    size = os.path.getsize(part)
+    started = time.perf_counter()
+    paths = downloader.merge_geojsonl(folder, "bench", ["geojsonl"], "OBJECTID")  # the mock layer's OID field
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "features": count_lines(paths[0]), "bytes": size}
+
+
+def stage_validate(config):
+    validator = importlib.import_module("92_check_geojsonl_format")
+    path = geojsonl_input(config)
+    started = time.perf_counter()
+    report = validator.check_geojsonl_format(path, config["workers"], show_dialog=False)
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "features": report["valid"], "bytes": os.path.getsize(path),
+            "invalid": report["invalid"]}
+
+
+def stage_split(config):
+    splitter = importlib.import_module("04_split_gpkg_data_by_index")
+    output_dir = os.path.join(config["work_dir"], "split")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    path = gpkg_input(config)
+    started = time.perf_counter()
+    result = splitter.split_gpkg(path, shards=config["shards"], output_dir=output_dir, workers=config["workers"])
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "features": result["features"], "bytes": os.path.getsize(path),
+            "failed": len(result["failed"])}
+
+
+def stage_convert(config):
+    converter = importlib.import_module("05_convert_gpkg_to_geojsonl")
+    path = gpkg_input(config)
+    started = time.perf_counter()
+    ok, _, written = converter.convert_all_layers_to_geojsonl(path, config["workers"], formats=["geojsonl"])
+    seconds = time.perf_counter() - started
+    return {"seconds": seconds, "features": written, "bytes": os.path.getsize(path), "ok": ok}
+
+
+STAGE_FUNCTIONS = {"download": stage_download, "merge": stage_merge, "validate": stage_validate,
+                   "split": stage_split, "convert": stage_convert}
+
+
+def count_lines(path, block=64 * 1024 * 1024):
+    n = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(block):
+            n += chunk.count(b"\n")
+    return n
+
+
+def peak_rss_mb():
+    """Peak RSS of this process or of its largest finished child process, in MB."""
+    if resource is None:
+        return None
+    unit = 1024 ** 2 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    try:
+        # Linux keeps ru_maxrss across exec, so a spawned process would report its
+        # parent's peak; VmHWM is the high-water mark of this process's own memory
+        with open("/proc/self/status") as f:
+            own = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    except (OSError, StopIteration):
+        pass
+    return max(own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit)
+
+
+def _stage_process(name, config, results):
+    """Entry point of a stage process: the stage's own output goes to <work_dir>/<name>.log."""
+    log = open(os.path.join(config["work_dir"], f"{name}.log"), "w")
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = log
+    try:
+        metrics = STAGE_FUNCTIONS[name](config)
+        metrics["peak_rss_mb"] = peak_rss_mb()
+        results.put(metrics)
+    except Exception:
+        traceback.print_exc()
+        results.put({"error": traceback.format_exc().strip().splitlines()[-1]})
+    finally:
+        log.flush()
+
+
+def run_stage(name, config):
+    """Run one stage in a fresh (spawned) process and return its metrics."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    process = ctx.Process(target=_stage_process, args=(name, config, results))
+    process.start()
+    metrics = results.get()
+    process.join()
+    if "error" not in metrics:
+        seconds = metrics["seconds"] or 1e-9
+        metrics["features_per_s"] = metrics["features"] / seconds
+        metrics["mb_per_s"] = metrics["bytes"] / 1024 ** 2 / seconds
+    return metrics
+
+
+# --- Mock server ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(config):
+    """Start mock_featureserver.py in its own process (so it does not share the
+    downloader's GIL); returns (process, layer URL)."""
+    from mock_featureserver import SERVICE_PATH
+    port = free_port()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_featureserver.py")
+    log = open(os.path.join(config["work_dir"], "mock_server.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, script, "--port", str(port), "--features", str(config["features"]),
+         "--page-size", str(config["page_size"]), "--latency", str(config["latency"]),
+         "--jitter", str(config["jitter"]), "--error-rate", str(config["error_rate"]),
+         "--empty-rate", str(config["empty_rate"]), "--gap-every", str(config["gap_every"]),
+         "--max-ids", str(config["max_ids"]), "--geometry", config["geometry"],
+         "--processes", str(config["server_processes"])],
+        stdout=log, stderr=subprocess.STDOUT, start_new_session=hasattr(os, "killpg"))
+    url = f"http://127.0.0.1:{port}{SERVICE_PATH}/0"
+    import requests
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            requests.get(url, params={"f": "json"}, timeout=1).raise_for_status()
+            return process, url
+        except requests.RequestException:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    stop_mock_server(process)
+    raise RuntimeError(f"Mock server did not start, see {log.name}")
+
+
+def stop_mock_server(process):
+    if hasattr(os, "killpg"):
+        os.killpg(process.pid, signal.SIGTERM)  # the pre-forked server processes too
+    else:
+        process.terminate()
+    process.wait()
+
+
+# --- Report and baseline ---
+def print_report(results):
+    print(f"\n{'stage':<10}{'features':>12}{'seconds':>10}{'features/s':>13}{'MB/s':>9}{'peak RSS MB':>13}"
+          f"{'p50 ms':>9}{'p99 ms':>9}")
+    for name, m in results.items():
+        if "error" in m:
+            print(f"{name:<10}  ERROR: {m['error']}")
+            continue
+        fmt = lambda v, width, spec: format(v, f">{width}{spec}") if v is not None else "-".rjust(width)
+        print(f"{name:<10}{m['features']:>12,}{m['seconds']:>10.2f}{m['features_per_s']:>13,.0f}"
+              f"{m['mb_per_s']:>9.1f}{fmt(m['peak_rss_mb'], 13, ',.0f')}{fmt(m.get('p50_ms'), 9, '.1f')}"
+              f"{fmt(m.get('p99_ms'), 9, '.1f')}")
+
+
+def compare(results, config, baseline, tolerance=TOLERANCE, rss_tolerance=RSS_TOLERANCE):
+    """Regression messages against a baseline; [] when everything is within tolerance."""
+    differs = [k for k in CONFIG_KEYS if baseline["config"].get(k) != config.get(k)]
+    if differs:
+        print(f"Baseline was recorded with different settings ({', '.join(differs)}); not compared")
+        return []
+    regressions = []
+    for name, m in results.items():
+        base = baseline["stages"].get(name)
+        if base is None:
+            continue
+        if "error" in m:
+            regressions.append(f"{name}: failed ({m['error']})")
+            continue
+        if m["features"] != base["features"]:
+            regressions.append(f"{name}: {m['features']:,} features, baseline {base['features']:,}")
+        if m["features_per_s"] < base["features_per_s"] * (1 - tolerance):
+            regressions.append(f"{name}: {m['features_per_s']:,.0f} features/s, "
+                               f"baseline {base['features_per_s']:,.0f}")
+        if m.get("peak_rss_mb") and base.get("peak_rss_mb") and m["peak_rss_mb"] > base["peak_rss_mb"] * (1 + rss_tolerance):
+            regressions.append(f"{name}: peak RSS {m['peak_rss_mb']:,.0f} MB, baseline {base['peak_rss_mb']:,.0f} MB")
+        if m.get("p99_ms") and base.get("p99_ms") and m["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 page latency {m['p99_ms']:.1f} ms, baseline {base['p99_ms']:.1f} ms")
+    return regressions
+
+
+def run_benchmark(config, stages=STAGES):
+    """Prepare inputs, run the stages in order and return {stage: metrics}."""
+    os.makedirs(config["work_dir"], exist_ok=True)
+    prepare_inputs(config, stages)
+    results = {}
+    server = None
+    try:
+        if "download" in stages:
+            server, config["url"] = start_mock_server(config)
+        for name in stages:
+            print(f"Running {name} ...")
+            results[name] = run_stage(name, config)
+            if name == "download" and server is not None:
+                stop_mock_server(server)
+                server = None
+    finally:
+        if server is not None:
+            stop_mock_server(server)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ETL pipeline on synthetic data.")
+    parser.add_argument("--features", type=int, default=FEATURES)
+    parser.add_argument("--geometry", choices=["polygon", "point"], default=GEOMETRY)
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma-separated subset of {','.join(STAGES)}")
+    parser.add_argument("--work-dir", default=WORK_DIR, help="synthetic inputs, outputs and stage logs")
+    parser.add_argument("--page-size", type=int, default=2000, help="mock server maxRecordCount")
+    parser.add_argument("--latency", type=float, default=0.02, help="mock server seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="mock server extra random seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of page requests that fail")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="share of page requests answered empty")
+    parser.add_argument("--gap-every", type=int, default=0, help="leave out every n-th OBJECTID")
+    parser.add_argument("--max-ids", type=int, default=2_000_000, help="largest returnIdsOnly answer")
+    parser.add_argument("--server-processes", type=int, default=SERVER_PROCESSES)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--paging", choices=["keyset", "offset"], default="keyset")
+    parser.add_argument("--download-profile", default="full", help="arcgis_client.PROFILES name for the download")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="processes for validate / split / convert")
+    parser.add_argument("--shards", type=int, default=SHARDS)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGE_FUNCTIONS]
+    if unknown:
+        parser.error(f"unknown stage(s): {', '.join(unknown)}")
+    if args.gap_every == 1:
+        parser.error("--gap-every must be 0 (no gaps) or at least 2")
+
+    config = {k: getattr(args, k) for k in CONFIG_KEYS}
+    config["work_dir"] = os.path.abspath(args.work_dir)
+    results = run_benchmark(config, stages)
+    print_report(results)
+
+    report_path = os.path.join(config["work_dir"], "benchmark_results.json")
+    record = {"date": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+              "config": {k: config[k] for k in CONFIG_KEYS}, "stages": results}
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+    print(f"\nResults saved to: {report_path} (stage logs in {config['work_dir']})")
+
+    failed = [name for name, m in results.items() if "error" in m]
+    if args.save_baseline:
+        if failed:
+            print(f"ERROR: not saving a baseline with failed stages: {', '.join(failed)}")
+            return 1
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(record, f, indent=2)
+        print(f"Baseline saved to: {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, config, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
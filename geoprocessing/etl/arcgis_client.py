@@ -0,0 +1,426 @@
+# arcgis_client.py
+# Purpose: Shared HTTP plumbing for the scripts that talk to ArcGIS REST FeatureServers.
+# - make_session: one pooled requests.Session shared by all workers, optionally with an
+#   on-disk response cache (http_cache.py)
+# - AdaptiveLimiter: AIMD cap on in-flight requests, driven by latency and 429/5xx responses
+# - BudgetedLimiter: an AdaptiveLimiter that also holds slots of shared (per-host / global) budgets
+# - request_json: one query with retry, backoff and limiter accounting; is_transient tells
+#   overload / network errors from requests the server rejects
+# - fetch_ordered: keeps many requests in flight but yields results in submission order
+# - run_tasks: shared work queue with per-task retry (exponential backoff + full jitter)
+# - get_layer_info / get_object_ids / get_object_id_range: layer metadata for keyset paging
+# - get_edit_date_field / get_max_edit_date: editor tracking, for incremental refresh
+# - get_service_layers: layer list of a MapServer / FeatureServer
+# - PROFILES / query_params: download profiles (field projection, server-side generalization)
+# request_json and run_tasks record request latency, decode time, bytes, retries and
+# queue depth in metrics.py
+
+import heapq
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+import json_backend
+import metrics
+from http_cache import CachingAdapter, HttpCache
+
+# Status codes that mean "slow down / try again" rather than "your request is wrong"
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+TASK_RETRIES = 5          # run_tasks: attempts per task before it is reported as failed
+TASK_BACKOFF = 2.0        # run_tasks: first retry waits up to this many seconds...
+TASK_BACKOFF_CAP = 120.0  # ...doubling per attempt up to this cap
+
+# Download profiles: extra query parameters for every feature request. Coordinates come
+# back in WGS84 (f=geojson), so maxAllowableOffset is in degrees; the tile profiles use
+# about one tile unit (360 / 4096 / 2^z) at their max zoom. A profile given as a dict may
+# also carry outFields (list) and quantizationParameters (dict), see query_params.
+PROFILES = {
+    "full": {},                                                      # every field, full precision
+    "tiles": {"geometryPrecision": 6, "returnZ": False, "returnM": False},  # ~0.1 m
+    "tiles-z14": {"geometryPrecision": 6, "maxAllowableOffset": 5e-6, "returnZ": False, "returnM": False},
+    "tiles-z10": {"geometryPrecision": 5, "maxAllowableOffset": 8e-5, "returnZ": False, "returnM": False},
+    "tiles-z6": {"geometryPrecision": 4, "maxAllowableOffset": 1.3e-3, "returnZ": False, "returnM": False},
+}
+
+
+class ServerBusyError(Exception):
+    """Raised when the server keeps answering 429/5xx (or an ArcGIS error body) after all retries.
+
+    code is the HTTP status or the ArcGIS error code (None when unknown).
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def is_transient(error):
+    """True for errors that mean the server is overloaded or unreachable (429/5xx, network
+    failures), as opposed to a request it will never answer (bad query, URL too long)."""
+    if isinstance(error, ServerBusyError):
+        return error.code is None or error.code in RETRY_STATUS
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS
+    return isinstance(error, requests.RequestException)
+
+
+def make_session(pool_size, cache_dir=None):
+    """Create a requests.Session whose connection pool can serve pool_size concurrent requests.
+
+    With cache_dir, responses are cached on disk there (see http_cache.py).
+    """
+    session = requests.Session()
+    pool = dict(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    adapter = CachingAdapter(HttpCache(cache_dir), **pool) if cache_dir else HTTPAdapter(**pool)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class AdaptiveLimiter:
+    """Additive-increase / multiplicative-decrease limit on concurrent requests.
+
+    The limit grows by one slot after `limit` consecutive fast successes (roughly once
+    per round of requests) and halves on a 429/5xx or when a response is slower than
+    target_latency. Decreases are rate limited by `cooldown` so a single burst of
+    errors does not collapse the limit to the minimum.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, target_latency=10.0, cooldown=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.limit = max(minimum, min(initial, maximum))
+        self.in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            slow = latency is not None and latency > self.target_latency
+            if throttled or slow:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self._last_decrease = now
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.maximum:
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class BudgetedLimiter(AdaptiveLimiter):
+    """AdaptiveLimiter for one layer whose requests also need a slot in shared budgets.
+
+    budgets are semaphores shared between layers (e.g. one per host and one global),
+    so many layers can adapt independently without exceeding what a server, or the
+    machine, is allowed in total. The layer's own slot is taken first, so a layer
+    waiting on a budget never holds a budget slot it cannot use.
+    """
+
+    def __init__(self, budgets, **kwargs):
+        super().__init__(**kwargs)
+        self.budgets = budgets
+
+    def acquire(self):
+        super().acquire()
+        for budget in self.budgets:
+            budget.acquire()
+
+    def release(self, latency=None, throttled=False):
+        for budget in reversed(self.budgets):
+            budget.release()
+        super().release(latency, throttled)
+
+
+def _retry_after(response, default):
+    """Seconds to wait according to a Retry-After header (numeric form only)."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    try:
+        return min(float(value), 120.0)
+    except (TypeError, ValueError):
+        return default
+
+
+def request_json(session, limiter, url, params=None, data=None, timeout=60, retries=3, label="", decode=None):
+    """GET (or POST when data is given) url and return the decoded JSON body.
+
+    decode(bytes) -> dict replaces the default json_backend.loads (e.g. decode_page
+    for raw feature passthrough). Retries network errors, 429/5xx and ArcGIS error bodies (which come back as HTTP 200)
+    with exponential backoff plus jitter. Other 4xx responses raise immediately.
+    """
+    method = "POST" if data is not None else "GET"
+    last_error = None
+    for attempt in range(retries):
+        wait = min(2 ** attempt, 30) * (0.5 + random.random())
+        limiter.acquire()
+        metrics.gauge("http_in_flight", limiter.in_flight)
+        started = time.monotonic()
+        try:
+            r = session.request(method, url, params=params, data=data, timeout=timeout)
+        except requests.RequestException as e:
+            limiter.release(throttled=True)
+            last_error = e
+            metrics.count("http_errors_total", kind="network")
+        else:
+            latency = time.monotonic() - started
+            metrics.observe("http_request_seconds", latency)
+            metrics.count("http_bytes_in_total", len(r.content))
+            if r.status_code in RETRY_STATUS:
+                limiter.release(latency, throttled=True)
+                last_error = ServerBusyError(f"HTTP {r.status_code}", r.status_code)
+                wait = _retry_after(r, wait)
+                metrics.count("http_errors_total", kind=str(r.status_code))
+            else:
+                limiter.release(latency)
+                r.raise_for_status()
+                with metrics.timed("http_decode_seconds"):
+                    body = (decode or json_backend.loads)(r.content)
+                error = body.get("error") if isinstance(body, dict) else None
+                if not error:
+                    return body
+                last_error = ServerBusyError(f"ArcGIS error {error.get('code')}: {error.get('message')}",
+                                             error.get("code"))
+                metrics.count("http_errors_total", kind="arcgis")
+        metrics.count("http_retries_total")
+        print(f"{label}Retry {attempt+1}/{retries} failed: {last_error}")
+        if attempt < retries - 1:
+            time.sleep(wait)
+    raise last_error
+
+
+def fetch_ordered(tasks, fetch, max_workers, window=None):
+    """Run fetch(task) for every task on a thread pool and yield (task, result) in task order.
+
+    Up to max_workers calls run at once (the AdaptiveLimiter inside fetch decides how many
+    actually hit the network); at most `window` finished results are buffered waiting for
+    an earlier, slower task, which keeps memory bounded. An exception from fetch is
+    re-raised when its task reaches the front of the queue; later tasks are cancelled.
+    """
+    window = window or 2 * max_workers
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append((task, pool.submit(fetch, task)))
+            if len(pending) >= window:
+                head, future = pending.popleft()
+                yield head, future.result()
+        while pending:
+            head, future = pending.popleft()
+            yield head, future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class _TaskQueue:
+    """Tasks ordered by the time they may next run; failed tasks re-enter with a delay."""
+
+    def __init__(self, tasks):
+        self._heap = [(0.0, i, task, 0) for i, task in enumerate(tasks)]
+        self._seq = len(self._heap)
+        self._outstanding = len(self._heap)
+        self._cond = threading.Condition()
+
+    def get(self):
+        """Next ready (task, attempt), or None once every task has finished or failed."""
+        with self._cond:
+            while True:
+                if self._outstanding == 0:
+                    return None
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        _, _, task, attempt = heapq.heappop(self._heap)
+                        return task, attempt
+                else:
+                    wait = None  # everything left is running on other workers
+                self._cond.wait(wait)
+
+    def depth(self):
+        """Tasks waiting to run (including retries still backing off)."""
+        return len(self._heap)
+
+    def retry(self, task, attempt, delay):
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, task, attempt))
+            self._seq += 1
+            self._cond.notify()
+
+    def finish(self):
+        with self._cond:
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+
+def run_tasks(tasks, fetch, on_result, workers, retries=TASK_RETRIES, label=""):
+    """Run fetch(task) for every task on `workers` threads sharing one queue.
+
+    Whichever worker is free takes the next task, so a slow stretch of the server only
+    holds the workers currently inside it and the run ends when the last task does.
+    on_result(task, result) is called under a lock as tasks complete (in completion
+    order). A task that raises is re-queued after an exponential backoff with full
+    jitter, without blocking its worker; after `retries` attempts it is given up.
+    Returns the failures as a list of (task, exception).
+    """
+    queue = _TaskQueue(tasks)
+    lock = threading.Lock()
+    failures = []
+
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            task, attempt = item
+            metrics.gauge("task_queue_depth", queue.depth())
+            try:
+                result = fetch(task)
+                with lock:
+                    on_result(task, result)
+            except Exception as e:
+                if attempt + 1 < retries:
+                    delay = random.uniform(0, min(TASK_BACKOFF_CAP, TASK_BACKOFF * 2 ** attempt))
+                    print(f"{label}Task {attempt+1}/{retries} failed ({e}); retrying in {delay:.1f}s")
+                    metrics.count("task_retries_total")
+                    queue.retry(task, attempt + 1, delay)
+                    continue
+                metrics.count("task_failures_total")
+                with lock:
+                    failures.append((task, e))
+            queue.finish()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return failures
+
+
+def get_layer_info(session, api_url):
+    """Return the layer's metadata JSON (maxRecordCount, fields, objectIdField, ...)."""
+    r = session.get(api_url, params={"f": "json"}, timeout=30)
+    r.raise_for_status()
+    return r.json()
+
+
+def get_object_id_field(layer_info):
+    """Name of the layer's OBJECTID field; falls back to "OBJECTID"."""
+    if layer_info.get("objectIdField"):
+        return layer_info["objectIdField"]
+    for field in layer_info.get("fields") or []:
+        if field.get("type") == "esriFieldTypeOID":
+            return field["name"]
+    return "OBJECTID"
+
+
+def get_object_ids(session, api_url, where="1=1", timeout=600):
+    """Return every OBJECTID matching `where` as a sorted int64 array, or None when the
+    server refuses returnIdsOnly (some services time out or cap it on huge layers)."""
+    try:
+        r = session.post(api_url + "/query", data={"where": where, "returnIdsOnly": "true", "f": "json"},
+                         timeout=timeout)
+        r.raise_for_status()
+        body = r.json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"Warning: returnIdsOnly failed: {e}")
+        return None
+    ids = body.get("objectIds")
+    if ids is None:
+        print(f"Warning: returnIdsOnly returned no objectIds: {body.get('error')}")
+        return None
+    return np.sort(np.asarray(ids, dtype=np.int64))
+
+
+def get_object_id_range(session, api_url, oid_field, where="1=1"):
+    """Return (min, max) OBJECTID via outStatistics, or None when the layer is empty."""
+    stats = [
+        {"statisticType": "min", "onStatisticField": oid_field, "outStatisticFieldName": "MINOID"},
+        {"statisticType": "max", "onStatisticField": oid_field, "outStatisticFieldName": "MAXOID"},
+    ]
+    r = session.get(api_url + "/query", params={"where": where, "outStatistics": json.dumps(stats), "f": "json"},
+                    timeout=60)
+    r.raise_for_status()
+    feats = r.json().get("features") or []
+    if not feats:
+        return None
+    # Some servers change the case of outStatisticFieldName
+    attrs = {k.upper(): v for k, v in feats[0].get("attributes", {}).items()}
+    if attrs.get("MINOID") is None:
+        return None
+    return int(attrs["MINOID"]), int(attrs["MAXOID"])
+
+
+def get_edit_date_field(layer_info):
+    """Name of the layer's last-edit date field (editor tracking), or None when tracking is off."""
+    field = (layer_info.get("editFieldsInfo") or {}).get("editDateField")
+    names = {f.get("name") for f in layer_info.get("fields") or []}
+    return field if field and (not names or field in names) else None
+
+
+def get_max_edit_date(session, api_url, edit_field, where="1=1"):
+    """Latest value of the edit date field (epoch milliseconds) via outStatistics, or None."""
+    stats = [{"statisticType": "max", "onStatisticField": edit_field, "outStatisticFieldName": "MAXEDIT"}]
+    r = session.get(api_url + "/query", params={"where": where, "outStatistics": json.dumps(stats), "f": "json"},
+                    timeout=60)
+    r.raise_for_status()
+    feats = r.json().get("features") or []
+    if not feats:
+        return None
+    value = {k.upper(): v for k, v in feats[0].get("attributes", {}).items()}.get("MAXEDIT")
+    return int(value) if value is not None else None
+
+
+def get_service_layers(session, service_url):
+    """[(layer id, name)] of the feature layers of a MapServer / FeatureServer (tables skipped)."""
+    r = session.get(service_url, params={"f": "json"}, timeout=30)
+    r.raise_for_status()
+    info = r.json()
+    return [(l["id"], l.get("name", str(l["id"]))) for l in info.get("layers", [])
+            if not l.get("subLayerIds")]  # group layers hold no features
+
+
+def query_params(profile="full", fields=None, oid_field=None):
+    """Feature query parameters for a download profile (a PROFILES name or a dict of the
+    same keys); `fields` overrides the profile's outFields. The OBJECTID field is always
+    requested, since the audit, merge and refresh steps key on it."""
+    settings = dict(PROFILES[profile] if isinstance(profile, str) else profile or {})
+    if fields:
+        settings["outFields"] = list(fields)
+    out_fields = settings.pop("outFields", "*")
+    if out_fields != "*":
+        out_fields = list(out_fields)
+        if oid_field and oid_field not in out_fields:
+            out_fields.insert(0, oid_field)
+        out_fields = ",".join(out_fields)
+    params = {"outFields": out_fields}
+    for key, value in settings.items():
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(",", ":"))
+        params[key] = value
+    if "maxAllowableOffset" in params:
+        params.setdefault("outSR", 4326)  # keep the offset in the degrees GeoJSON is returned in
+    return params
@@ -0,0 +1,142 @@
+# checkpoint_journal.py
+# Purpose: Crash-consistent resume for append-only .geojsonl downloads.
+# Each data file gets an append-only journal with one JSON line per written page:
+#   {"start", "stop", "count", "offset", "length", "crc32", "total"}
+# Records are buffered and committed in batches: the data file is flushed and fsynced
+# first, then the journal records are appended and fsynced. A committed record is
+# therefore never ahead of the data on disk, and resume truncates the data file to
+# the end of the last committed page, dropping any half-written tail.
+
+import os
+import time
+import zlib
+
+import json_backend
+
+COMMIT_PAGES = 32        # commit after this many pages...
+COMMIT_SECONDS = 5.0     # ...or this many seconds, whichever comes first
+VERIFY_BLOCK = 8 * 1024 * 1024
+
+
+def _read_journal(journal_path):
+    """(complete records, byte size they span); a torn last line (crash mid-append) is ignored."""
+    records, size = [], 0
+    if not os.path.exists(journal_path):
+        return records, size
+    with open(journal_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                records.append(json_backend.loads(line))
+            except ValueError:
+                break
+            size += len(line)
+    return records, size
+
+
+def read_journal(journal_path):
+    return _read_journal(journal_path)[0]
+
+
+def _page_crc(f, offset, length):
+    f.seek(offset)
+    crc = 0
+    while length > 0:
+        block = f.read(min(length, VERIFY_BLOCK))
+        if not block:
+            return None  # file shorter than the record says
+        crc = zlib.crc32(block, crc)
+        length -= len(block)
+    return crc
+
+
+def recover(data_path, journal_path):
+    """Bring data_path and its journal back to the last consistent page; return the records.
+
+    The last record's page is re-hashed against the data; if the data does not match
+    (storage lost a write despite fsync), records are dropped from the end until one
+    does. The data file is truncated to the end of the surviving page and the journal
+    is rewritten when anything was dropped.
+    """
+    records, size = _read_journal(journal_path)
+    kept = len(records)
+    if os.path.exists(data_path):
+        with open(data_path, "r+b") as f:
+            while kept:
+                r = records[kept - 1]
+                if _page_crc(f, r["offset"], r["length"]) == r["crc32"]:
+                    break
+                kept -= 1
+            end = records[kept - 1]["offset"] + records[kept - 1]["length"] if kept else 0
+            f.truncate(end)
+    else:
+        kept = 0
+
+    if kept < len(records):
+        print(f"Warning: {data_path}: dropped {len(records) - kept} journal records that do not match the data")
+        records = records[:kept]
+        tmp = journal_path + ".tmp"
+        with open(tmp, "wb") as jf:
+            jf.write(b"".join(json_backend.dumps_line(r) for r in records))
+            jf.flush()
+            os.fsync(jf.fileno())
+        os.replace(tmp, journal_path)
+    elif os.path.exists(journal_path) and os.path.getsize(journal_path) > size:
+        with open(journal_path, "r+b") as jf:
+            jf.truncate(size)  # torn last line
+    return records
+
+
+def committed_total(journal_path):
+    """Features committed so far according to the journal (0 if none)."""
+    records = read_journal(journal_path)
+    return records[-1]["total"] if records else 0
+
+
+class CheckpointJournal:
+    """Append-only page journal for one open data file (see module notes).
+
+    Call add() right after writing a page's bytes to data_file; records become durable
+    at the next commit (every COMMIT_PAGES pages / COMMIT_SECONDS seconds, and on close).
+    """
+
+    def __init__(self, journal_path, data_file, commit_pages=COMMIT_PAGES, commit_seconds=COMMIT_SECONDS):
+        self.path = journal_path
+        self.data_file = data_file
+        self.commit_pages = commit_pages
+        self.commit_seconds = commit_seconds
+        self._f = open(journal_path, "ab")
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def add(self, page, data, count, total):
+        """Record one page whose bytes `data` were just appended to data_file."""
+        end = self.data_file.tell()
+        self._pending.append({"start": page["start"], "stop": page["stop"], "count": count,
+                              "offset": end - len(data), "length": len(data),
+                              "crc32": zlib.crc32(data), "total": total})
+        if (len(self._pending) >= self.commit_pages
+                or time.monotonic() - self._last_commit >= self.commit_seconds):
+            self.commit()
+
+    def commit(self):
+        if self._pending:
+            # data first: a journal record must never point past durable data
+            self.data_file.flush()
+            os.fsync(self.data_file.fileno())
+            self._f.write(b"".join(json_backend.dumps_line(r) for r in self._pending))
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._pending = []
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        self.commit()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
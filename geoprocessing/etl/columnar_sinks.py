@@ -0,0 +1,295 @@
+# columnar_sinks.py
+# Purpose: GeoParquet and FlatGeobuf outputs for feature_sinks.open_sinks, kept apart
+# so plain GeoJSONL work never imports pyarrow or shapely; open_sinks loads this module
+# only when one of these formats is asked for.
+# - GeoParquetSink / FlatGeobufSink parse lines in batches (shapely.from_geojson for
+#   geometry, one pyarrow table per batch for properties), or take columnar batches
+#   directly; GeoParquet is Hilbert-sorted with per-row-group bbox statistics
+
+import os
+import queue
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute
+import shapely
+
+import json_backend
+from spatial_sort import bbox_centres, hilbert_keys, zorder_keys
+
+BATCH_FEATURES = 50_000         # features parsed per batch
+ROW_GROUP_SIZE = 100_000        # GeoParquet rows per row group (bbox statistics granularity)
+SORT = "hilbert"                # GeoParquet row order: hilbert | zorder | None (arrival order)
+
+
+def _arrow_type(t):
+    # A column that is all null in the first batch fixes no type; keep it as text
+    return pa.string() if pa.types.is_null(t) else t
+
+
+def unify_schemas(schemas):
+    """One properties schema covering several (e.g. every layer of a GeoPackage).
+
+    Fields keep their first-seen order; a field whose types differ is promoted where
+    Arrow can do it losslessly (int32 + int64 -> int64, int + double -> double) and
+    falls back to string otherwise. Fields missing from a batch are written as null.
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types.setdefault(field.name, []).append(field.type)
+    fields = []
+    for name, ts in types.items():
+        ts = [t for t in dict.fromkeys(ts) if not pa.types.is_null(t)]
+        if len(ts) <= 1:
+            fields.append(pa.field(name, ts[0] if ts else pa.string()))
+            continue
+        try:
+            fields.append(pa.unify_schemas([pa.schema([pa.field(name, t)]) for t in ts],
+                                           promote_options="permissive").field(name))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            fields.append(pa.field(name, pa.string()))
+    return pa.schema(fields)
+
+
+def lines_to_table(lines):
+    """Parse GeoJSONL lines into a pyarrow table: property columns plus WKB "geometry"."""
+    feats = [json_backend.loads(line) for line in lines]
+    has_geom = np.array([f.get("geometry") is not None for f in feats], dtype=bool)
+    geoms = np.full(len(lines), None, dtype=object)
+    if has_geom.any():
+        geoms[has_geom] = shapely.from_geojson(np.array(lines, dtype=object)[has_geom])
+    geometry = pa.array(shapely.to_wkb(geoms), type=pa.binary())
+    props = pa.Table.from_pylist([f.get("properties") or {} for f in feats])
+    if props.num_columns == 0:
+        return pa.table({"geometry": geometry})  # no properties at all: from_pylist has no rows
+    return props.append_column("geometry", geometry)
+
+
+class _BatchSink:
+    """Collects features into pyarrow tables (property columns plus a WKB "geometry"
+    column) and hands each batch to _write_batch.
+
+    Lines are parsed in batches of batch_features; callers that already have columnar
+    data (the GPKG converter) pass whole tables to write_table and skip JSON entirely.
+    The properties schema is `schema` when the caller knows it up front (see
+    unify_schemas), otherwise the first batch's.
+    """
+
+    geometry_field = pa.field("geometry", pa.binary())
+
+    def __init__(self, path, batch_features=BATCH_FEATURES, crs=None, schema=None):
+        self.path = path
+        self.crs = crs          # None = OGC:CRS84 / EPSG:4326, as GeoJSON
+        self.count = 0
+        self.schema = None      # properties schema, fixed by the caller or the first batch
+        if schema is not None:
+            self.schema = pa.schema([pa.field(f.name, _arrow_type(f.type)) for f in schema])
+        self._lines = []
+        self._batch_features = batch_features
+
+    def write(self, line):
+        self._lines.append(line)
+        self.count += 1
+        if len(self._lines) >= self._batch_features:
+            self._flush()
+
+    def write_table(self, table):
+        self.count += len(table)
+        self._write_batch(self._align(table))
+
+    def _align(self, table):
+        props = table.drop_columns(["geometry"])
+        if self.schema is None:
+            self.schema = pa.schema([pa.field(f.name, _arrow_type(f.type)) for f in props.schema])
+        # Batches follow the schema's columns (missing -> null). The schema is already in
+        # the file, so a new column or a value the column type cannot hold fails the
+        # sink instead of being dropped, truncated or wrapped.
+        extra = set(props.column_names) - set(self.schema.names)
+        if extra:
+            raise ValueError(f"{self.path}: properties not in the output schema: {sorted(extra)}")
+        columns = []
+        for field in self.schema:
+            if field.name not in props.column_names:
+                columns.append(pa.nulls(len(table), field.type))
+                continue
+            try:
+                columns.append(props[field.name].cast(field.type))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError(f"{self.path}: property {field.name!r} is {field.type} in the output "
+                                 f"but a batch has {props[field.name].type} values: {e}") from e
+        columns.append(table["geometry"])
+        return pa.Table.from_arrays(columns, schema=self.schema.append(self.geometry_field))
+
+    def _flush(self):
+        if self._lines:
+            table = lines_to_table(self._lines)
+            self._lines = []
+            self._write_batch(self._align(table))
+
+    def close(self):
+        self._flush()
+        self._finish()
+
+
+_BBOX_NAMES = ["xmin", "ymin", "xmax", "ymax"]
+_GEOMETRY_TYPES = ["Point", "LineString", "LinearRing", "Polygon", "MultiPoint",
+                   "MultiLineString", "MultiPolygon", "GeometryCollection"]
+
+
+class GeoParquetSink(_BatchSink):
+    """GeoParquet 1.1 file: WKB geometry plus a "bbox" covering column.
+
+    Parquet keeps min/max statistics per row group for the bbox fields, so readers can
+    skip row groups outside a query window. With sort="hilbert" (or "zorder") batches
+    are spilled to a temporary Arrow IPC file and written in curve order at close,
+    which makes every row group cover a compact area; memory stays at one uint64 key
+    per feature plus one row group, the spill being read back through a memory map.
+    """
+
+    def __init__(self, path, batch_features=BATCH_FEATURES, crs=None, schema=None, sort=SORT,
+                 row_group_size=ROW_GROUP_SIZE):
+        super().__init__(path, batch_features, crs, schema)
+        self.sort = sort
+        self.row_group_size = row_group_size
+        self._writer = None
+        self._spill_path = path + ".spill.arrow"
+        self._types = set()
+        self._bbox = np.array([np.inf, np.inf, -np.inf, -np.inf])
+        self._centres = np.array([np.inf, np.inf, -np.inf, -np.inf])
+
+    def _geo_metadata(self, complete):
+        # Types and extent are only known once every batch has been seen (sorted output)
+        column = {"encoding": "WKB", "geometry_types": sorted(self._types) if complete else [],
+                  "covering": {"bbox": {k: ["bbox", k] for k in _BBOX_NAMES}}}
+        if complete and np.isfinite(self._bbox).all():
+            column["bbox"] = self._bbox.tolist()
+        if self.crs is not None:
+            import pyproj
+            column["crs"] = pyproj.CRS.from_user_input(self.crs).to_json_dict()
+        return {"version": "1.1.0", "primary_column": "geometry", "columns": {"geometry": column}}
+
+    def _open_writer(self, schema, complete):
+        import pyarrow.parquet as pq
+        meta = {b"geo": json_backend.dumps_line(self._geo_metadata(complete)).strip()}
+        return pq.ParquetWriter(self.path, schema.with_metadata(meta), compression="zstd")
+
+    def _write_batch(self, table):
+        geoms = shapely.from_wkb(table["geometry"].to_numpy(zero_copy_only=False))
+        bounds = shapely.bounds(geoms)
+        bbox = pa.StructArray.from_arrays([pa.array(bounds[:, i], from_pandas=True) for i in range(4)],
+                                          names=_BBOX_NAMES)
+        table = table.append_column("bbox", bbox)
+        present = ~shapely.is_missing(geoms)
+        if present.any():
+            self._types.update(_GEOMETRY_TYPES[t] for t in np.unique(shapely.get_type_id(geoms[present])))
+            b = bounds[present]
+            self._bbox = np.concatenate([np.minimum(self._bbox[:2], np.nanmin(b[:, :2], axis=0)),
+                                         np.maximum(self._bbox[2:], np.nanmax(b[:, 2:], axis=0))])
+            cx, cy = bbox_centres(b)
+            self._centres = np.array([min(self._centres[0], np.nanmin(cx)), min(self._centres[1], np.nanmin(cy)),
+                                      max(self._centres[2], np.nanmax(cx)), max(self._centres[3], np.nanmax(cy))])
+        if self._writer is None:
+            # Unsorted output streams straight to the file; sorted output is spilled first
+            self._writer = (pa.ipc.new_file(self._spill_path, table.schema) if self.sort
+                            else self._open_writer(table.schema, complete=False))
+        if self.sort:
+            self._writer.write_table(table)
+        else:
+            self._writer.write_table(table, row_group_size=self.row_group_size)
+
+    def _finish(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        if not self.sort:
+            return
+        key_fn = hilbert_keys if self.sort == "hilbert" else zorder_keys
+        with pa.memory_map(self._spill_path) as source:
+            spill = pa.ipc.open_file(source)
+            batches = [spill.get_batch(i) for i in range(spill.num_record_batches)]  # zero-copy views
+            keys = []
+            for batch in batches:
+                bbox = batch.column("bbox")
+                bounds = np.column_stack([bbox.field(k).to_numpy(zero_copy_only=False) for k in _BBOX_NAMES])
+                keys.append(key_fn(bounds, extent=self._centres))
+            order = np.argsort(np.concatenate(keys), kind="stable")
+            offsets = np.cumsum([0] + [b.num_rows for b in batches])
+            writer = self._open_writer(batches[0].schema, complete=True)
+            try:
+                for start in range(0, len(order), self.row_group_size):
+                    rows = order[start:start + self.row_group_size]
+                    chunk = np.searchsorted(offsets, rows, side="right") - 1
+                    parts, positions = [], []
+                    for c in np.unique(chunk):
+                        sel = np.flatnonzero(chunk == c)
+                        parts.append(batches[c].take(pa.array(rows[sel] - offsets[c])))
+                        positions.append(sel)
+                    group = pa.Table.from_batches(parts).take(np.argsort(np.concatenate(positions)))
+                    writer.write_table(group, row_group_size=self.row_group_size)
+            finally:
+                writer.close()
+            del batches
+        os.remove(self._spill_path)
+
+
+class FlatGeobufSink(_BatchSink):
+    """FlatGeobuf file (with its packed R-tree) written by GDAL from a stream of Arrow batches.
+
+    pyogrio.write_arrow pulls from a RecordBatchReader, so it runs on a helper thread
+    fed through a small queue; at most a few batches are held in memory. GDAL sorts
+    the features along a Hilbert curve to build the index. The packed R-tree cannot
+    hold null geometries, so those features are skipped and counted.
+    """
+
+    geometry_field = pa.field("geometry", pa.binary(), metadata={"ARROW:extension:name": "geoarrow.wkb"})
+
+    def __init__(self, path, batch_features=BATCH_FEATURES, crs=None, schema=None):
+        super().__init__(path, batch_features, crs, schema)
+        self._queue = None
+        self._thread = None
+        self._error = None
+        self._drained = False   # the writer thread has taken the end-of-stream sentinel
+        self.skipped = 0
+
+    def _run(self, schema):
+        import pyogrio
+
+        def batches():
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    self._drained = True
+                    return
+                yield batch
+
+        try:
+            reader = pa.RecordBatchReader.from_batches(schema, batches())
+            pyogrio.write_arrow(reader, self.path, driver="FlatGeobuf", geometry_name="geometry",
+                                geometry_type="Unknown", crs=self.crs or "EPSG:4326")
+        except Exception as e:
+            self._error = e
+            while not self._drained and self._queue.get() is not None:  # unblock the producer
+                pass
+
+    def _write_batch(self, table):
+        present = table["geometry"].is_valid()
+        if not pa.compute.all(present).as_py():
+            self.skipped += len(table) - pa.compute.sum(present).as_py()
+            table = table.filter(present)
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=2)
+            self._thread = threading.Thread(target=self._run, args=(table.schema,), daemon=True)
+            self._thread.start()
+        for batch in table.to_batches():
+            self._queue.put(batch)
+
+    def _finish(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if self.skipped:
+            print(f"Warning: {self.path}: skipped {self.skipped} features with null geometry")
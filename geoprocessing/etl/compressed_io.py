@@ -0,0 +1,230 @@
+# compressed_io.py
+# Purpose: Transparent .gz / .zst reading and writing for the GeoJSONL scripts.
+# National GeoJSONL files are tens of GB of very repetitive text; compressed they are
+# several times smaller, and reading them is usually faster than the plain file on
+# storage-bound machines.
+# - open_read / open_write: pick the codec from the file name (.zst, .gz, else plain)
+#   and return a binary stream that iterates by line like a normal file
+# - .zst is written as independent zstd frames that each end on a line boundary,
+#   compressed on a thread pool, followed by a seek table in the zstd "seekable
+#   format" (a skippable frame, so any zstd tool still reads the file). With the seek
+#   table, seekable_ranges / read_range let the validator cut the file into
+#   byte ranges of whole lines and decompress each range in a separate worker
+# - open_write(..., append=True) continues a .zst (or .gz) file, e.g. for patching
+
+import gzip
+import io
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Config
+ZSTD_LEVEL = 3                       # 1-19; 3 is zstd's default speed / ratio balance
+GZIP_LEVEL = 6
+FRAME_SIZE = 4 * 1024 * 1024         # uncompressed bytes per zstd frame (one seek table entry)
+THREADS = os.cpu_count() or 1        # frames compressed in parallel
+IO_BUFFER = 8 * 1024 * 1024
+
+COMPRESSED_EXTENSIONS = (".zst", ".gz")
+_SKIPPABLE_MAGIC = 0x184D2A5E        # seek table frame (zstd seekable format)
+_SEEKABLE_MAGIC = 0x8F92EAB1
+_footer = struct.Struct("<IBI")      # number of frames, descriptor, magic
+_entry = struct.Struct("<II")        # compressed size, decompressed size
+
+
+def codec(path):
+    """"zst", "gz" or None, from the file name."""
+    name = str(path).lower()
+    return "zst" if name.endswith(".zst") else "gz" if name.endswith(".gz") else None
+
+
+def strip_ext(path, ext=".geojsonl"):
+    """Path without its compression suffix and then `ext`: a.geojsonl.zst -> a."""
+    for suffix in COMPRESSED_EXTENSIONS + (ext,):
+        if path.lower().endswith(suffix):
+            path = path[:-len(suffix)]
+    return path
+
+
+def _need_zstd(path):
+    if zstandard is None:
+        raise RuntimeError(f"{path}: reading or writing .zst files needs the zstandard package")
+
+
+def open_read(path):
+    """Binary, line-iterable reader for a plain, .gz or .zst file."""
+    kind = codec(path)
+    if kind == "gz":
+        return gzip.open(path, "rb")
+    if kind == "zst":
+        _need_zstd(path)
+        raw = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader, buffer_size=IO_BUFFER)
+    return open(path, "rb", buffering=IO_BUFFER)
+
+
+def open_write(path, append=False):
+    """Binary writer for a plain, .gz or .zst file (see module notes for .zst)."""
+    kind = codec(path)
+    if kind == "gz":
+        return gzip.open(path, "ab" if append else "wb", compresslevel=GZIP_LEVEL)
+    if kind == "zst":
+        _need_zstd(path)
+        return SeekableZstdWriter(path, append=append)
+    return open(path, "ab" if append else "wb", buffering=IO_BUFFER)
+
+
+def read_seek_table(path):
+    """[(compressed offset, compressed size, uncompressed offset, uncompressed size)] per
+    frame of a seekable .zst file, or None when the file has no seek table."""
+    with open(path, "rb") as f:
+        return _read_seek_table(f)[0]
+
+
+def _read_seek_table(f):
+    """(frames or None, file offset where the seek table frame starts)."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < _footer.size + 8:
+        return None, size
+    f.seek(size - _footer.size)
+    n_frames, descriptor, magic = _footer.unpack(f.read(_footer.size))
+    entry_size = _entry.size + (4 if descriptor & 0x80 else 0)
+    table_start = size - _footer.size - n_frames * entry_size - 8
+    if magic != _SEEKABLE_MAGIC or table_start < 0:
+        return None, size
+    f.seek(table_start)
+    skippable, frame_size = struct.unpack("<II", f.read(8))
+    if skippable != _SKIPPABLE_MAGIC or frame_size != n_frames * entry_size + _footer.size:
+        return None, size
+    table = f.read(n_frames * entry_size)
+    frames = []
+    c_off = d_off = 0
+    for i in range(n_frames):
+        c_size, d_size = _entry.unpack_from(table, i * entry_size)
+        frames.append((c_off, c_size, d_off, d_size))
+        c_off += c_size
+        d_off += d_size
+    return frames, table_start
+
+
+def seekable_ranges(frames, parts):
+    """Group frames into about `parts` (start, end) uncompressed byte ranges."""
+    total = frames[-1][2] + frames[-1][3] if frames else 0
+    bounds = [0]
+    for _, _, d_off, _ in frames[1:]:
+        if d_off >= total * len(bounds) / parts:
+            bounds.append(d_off)
+    bounds.append(total)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range(path, start, end, frames=None):
+    """Uncompressed bytes [start, end) of a seekable .zst file; start and end must be
+    frame boundaries (as produced by seekable_ranges)."""
+    _need_zstd(path)
+    frames = frames if frames is not None else read_seek_table(path)
+    picked = [fr for fr in frames if start <= fr[2] < end]
+    if not picked:
+        return b""
+    dctx = zstandard.ZstdDecompressor()
+    with open(path, "rb") as f:
+        f.seek(picked[0][0])
+        data = f.read(sum(fr[1] for fr in picked))
+    out, pos = [], 0
+    for _, c_size, _, d_size in picked:
+        out.append(dctx.decompress(data[pos:pos + c_size], max_output_size=d_size))
+        pos += c_size
+    return b"".join(out)
+
+
+class SeekableZstdWriter:
+    """Write-only binary stream producing a seekable .zst file.
+
+    Data is cut into frames of about FRAME_SIZE bytes at line boundaries; frames are
+    compressed on a thread pool (zstd releases the GIL) and written in order. The
+    seek table is appended on close(). With append=True an existing seek table is cut
+    off, new frames follow the old ones, and the combined table is written at close.
+    """
+
+    def __init__(self, path, append=False, level=ZSTD_LEVEL, threads=THREADS, frame_size=FRAME_SIZE):
+        self.path = path
+        self.frame_size = frame_size
+        self._level = level
+        self._local = threading.local()
+        self._frames = []
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._window = 2 * threads
+        self._pool = ThreadPoolExecutor(max_workers=threads)
+        self._f = open(path, "r+b" if append and os.path.exists(path) else "wb")
+        if append:
+            frames, table_start = _read_seek_table(self._f)
+            if frames is None and self._f.tell():
+                raise ValueError(f"{path}: cannot append to a .zst file without a seek table")
+            self._frames = [(c, d) for _, c, _, d in frames or []]
+            self._f.seek(table_start if frames else 0)
+            self._f.truncate()
+
+    def _compress(self, data):
+        cctx = getattr(self._local, "cctx", None)
+        if cctx is None:
+            cctx = self._local.cctx = zstandard.ZstdCompressor(level=self._level)
+        return cctx.compress(data), len(data)
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(self._compress, bytes(data)))
+        while len(self._pending) >= self._window:
+            self._write_next()
+
+    def _write_next(self):
+        compressed, size = self._pending.popleft().result()
+        self._f.write(compressed)
+        self._frames.append((len(compressed), size))
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.frame_size:
+            # frames end on whole lines; a line longer than a frame gets a frame of its own
+            cut = (self._buffer.rfind(b"\n", 0, self.frame_size) + 1
+                   or self._buffer.find(b"\n", self.frame_size) + 1)
+            if not cut:
+                break
+            self._submit(self._buffer[:cut])
+            del self._buffer[:cut]
+        return len(data)
+
+    def flush(self):
+        """Compress and write everything buffered so far (ends the current frame)."""
+        if self._buffer:
+            self._submit(self._buffer)
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_next()
+        self._f.flush()
+
+    def close(self):
+        if self._f.closed:
+            return
+        try:
+            self.flush()
+            entries = b"".join(_entry.pack(c, d) for c, d in self._frames)
+            footer = _footer.pack(len(self._frames), 0, _SEEKABLE_MAGIC)
+            self._f.write(struct.pack("<II", _SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer)
+        finally:
+            self._pool.shutdown()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,281 @@
+# delta_refresh.py
+# Purpose: Incremental refresh of a layer that was downloaded before.
+# Instead of downloading the whole layer again, ask the server what changed since the
+# last run (recorded in {basename}_manifest.json) and fetch only that:
+# - editdate: editor tracking is on -> IDs edited since the last run's max edit date,
+#   plus IDs that are new on the server
+# - ids: no edit date to compare -> new IDs only (edits to existing features are not
+#   visible this way; run a full download now and then)
+# - ranges: the server refuses returnIdsOnly -> per-OBJECTID-range feature counts (and
+#   max edit date) are compared with the local file, and ranges that differ are
+#   downloaded again whole
+# IDs that are gone from the server are deleted. The delta is merged into every
+# existing output by OBJECTID: old versions of changed or deleted features are dropped
+# and the fetched versions appended. The manifest only moves forward once everything
+# was fetched, so a partial refresh is simply repeated next time. Changed features are
+# fetched with the query parameters (download profile) the manifest records.
+
+import importlib
+import json
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from arcgis_client import (AdaptiveLimiter, get_edit_date_field, get_layer_info, get_max_edit_date,
+                           get_object_id_field, get_object_id_range, get_object_ids, make_session,
+                           query_params, request_json, run_tasks)
+from compressed_io import open_read
+from feature_sinks import EXTENSIONS, open_sinks
+from oid_index import IO_BUFFER, extract_oid, read_oids
+import json_backend
+
+patcher = importlib.import_module("000_patch_missing_features")
+
+# Config
+CONCURRENCY = 8                  # requests in flight for range checks and fetches
+RANGE_SIZE = 10_000              # OBJECTIDs per range in "ranges" mode (one statistics request each)
+MERGE_BLOCK = 16 * 1024 * 1024   # bytes of the old file filtered per vectorized pass
+
+
+def manifest_path(folder, basename):
+    return os.path.join(folder, f"{basename}_manifest.json")
+
+
+def load_manifest(folder, basename):
+    path = manifest_path(folder, basename)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as mf:
+        return json_backend.loads(mf.read())
+
+
+def write_manifest(folder, basename, **fields):
+    """Record what the outputs hold (api_url, oid_field, edit_field, edit_max, features,
+    formats, mode, query) for the next refresh; written atomically."""
+    path = manifest_path(folder, basename)
+    manifest = {**fields, "updated": datetime.now().isoformat(timespec="seconds")}
+    with open(path + ".tmp", "wb") as mf:
+        mf.write(json_backend.dumps_line(manifest))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def edit_where(edit_field, edit_max):
+    """WHERE clause for features edited at or after edit_max (epoch ms). TIMESTAMP
+    literals are UTC and whole seconds, so features from the boundary second are
+    fetched again (harmless: they replace themselves)."""
+    ts = datetime.fromtimestamp(edit_max // 1000, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{edit_field} >= TIMESTAMP '{ts}'"
+
+
+def _range_changes(session, limiter, api_url, local, oid_field, edit_field, since, range_size=RANGE_SIZE):
+    """Ranges whose server count (or max edit date) differs from the local file.
+    Returns (changed ranges as keyset pages, number of ranges that could not be checked)."""
+    bounds = get_object_id_range(session, api_url, oid_field)
+    lows = [b for b in (bounds and bounds[0], local[0] if len(local) else None) if b is not None]
+    highs = [b for b in (bounds and bounds[1], local[-1] if len(local) else None) if b is not None]
+    if not lows:
+        return [], 0
+    starts = np.arange(min(lows), max(highs) + 1, range_size, dtype=np.int64)
+    local_counts = np.diff(np.searchsorted(local, np.append(starts, starts[-1] + range_size)))
+    ranges = [{"lo": int(a), "hi": int(a) + range_size - 1, "start": int(a), "stop": int(a) + range_size,
+               "count": None, "local": int(n)} for a, n in zip(starts, local_counts)]
+
+    stats = [{"statisticType": "count", "onStatisticField": oid_field, "outStatisticFieldName": "CNT"}]
+    if since is not None:
+        stats.append({"statisticType": "max", "onStatisticField": edit_field, "outStatisticFieldName": "MAXEDIT"})
+
+    def fetch(r):
+        body = request_json(session, limiter, api_url + "/query", label=f"[range {r['lo']}] ", params={
+            "where": f"{oid_field} BETWEEN {r['lo']} AND {r['hi']}", "outStatistics": json.dumps(stats), "f": "json"})
+        feats = body.get("features") or [{}]
+        return {k.upper(): v for k, v in feats[0].get("attributes", {}).items()}
+
+    changed = []
+
+    def on_result(r, attrs):
+        # strictly newer: the range holding the last run's latest edit has MAXEDIT == since
+        # and would otherwise be fetched again on every refresh
+        edited = since is not None and attrs.get("MAXEDIT") is not None and attrs["MAXEDIT"] > since
+        if int(attrs.get("CNT") or 0) != r["local"] or edited:
+            changed.append(r)
+
+    print(f"Comparing {len(ranges):,} {oid_field} ranges of {range_size:,} with the server")
+    failures = run_tasks(ranges, fetch, on_result, CONCURRENCY, label="range check")
+    for r, e in failures:
+        print(f"Range {r['lo']}-{r['hi']} could not be checked: {e}")
+    return sorted(changed, key=lambda r: r["lo"]), len(failures)
+
+
+def find_changes(session, limiter, api_url, geojsonl_path, manifest):
+    """Work out what to fetch and what to delete; see the module notes for the modes.
+
+    Returns a dict: mode, oid_field, edit_field, edit_max (the server's high-water mark
+    to store once the refresh is complete), local (IDs in the file), fetch (IDs),
+    universe (server ID list or None), deleted (IDs), ranges (keyset pages) and
+    unchecked (ranges not compared).
+    """
+    info = get_layer_info(session, api_url)
+    oid_field = manifest.get("oid_field") or get_object_id_field(info)
+    edit_field = get_edit_date_field(info)
+    # Read the high-water mark before anything else: a feature edited while the refresh
+    # runs is newer than it and is picked up by the next refresh
+    edit_max = get_max_edit_date(session, api_url, edit_field) if edit_field else None
+    since = manifest.get("edit_max") if manifest.get("edit_field") == edit_field else None
+    if edit_field and since is None:
+        print(f"Warning: the last run recorded no {edit_field} to compare with; edits to existing "
+              "features are not detected this time")
+    local = read_oids(geojsonl_path, oid_field)
+    changes = {"oid_field": oid_field, "edit_field": edit_field, "edit_max": edit_max, "local": local,
+               "fetch": np.empty(0, dtype=np.int64), "universe": None,
+               "deleted": np.empty(0, dtype=np.int64), "ranges": [], "unchecked": 0}
+
+    server = get_object_ids(session, api_url)
+    if server is None:
+        ranges, unchecked = _range_changes(session, limiter, api_url, local, oid_field, edit_field, since)
+        changes.update(mode="ranges", ranges=ranges, unchecked=unchecked)
+        return changes
+
+    fetch = np.setdiff1d(server, local, assume_unique=True)
+    mode = "ids"
+    if edit_field and since is not None:
+        edited = get_object_ids(session, api_url, where=edit_where(edit_field, since))
+        if edited is None:
+            print("Warning: could not list edited features; only new and deleted features are refreshed")
+            changes["unchecked"] = 1  # keep the old high-water mark so the edits are retried
+        else:
+            fetch = np.union1d(fetch, edited)
+            mode = "editdate"
+    changes.update(mode=mode, fetch=fetch, universe=server,
+                   deleted=np.setdiff1d(local, server, assume_unique=True))
+    return changes
+
+
+def fetch_delta(session, limiter, api_url, changes, delta_path, query=None):
+    """Download the changed features into delta_path (with the download profile's `query`).
+
+    Returns (features fetched, IDs to drop from the old outputs, items not fetched).
+    Only what was actually fetched replaces old features: a failed ID or range keeps
+    its previous version.
+    """
+    oid_field = changes["oid_field"]
+    fetched = []
+    drop = [changes["deleted"]]
+    unfetched = 0
+    with open(delta_path, "wb", buffering=IO_BUFFER) as out:
+        if len(changes["fetch"]):
+            for feats, failed in patcher.fetch_features(api_url, changes["fetch"], changes["universe"], oid_field,
+                                                        concurrency=CONCURRENCY, session=session, limiter=limiter,
+                                                        query=query):
+                for feat in feats:
+                    out.write(json_backend.dumps_line(feat))
+                    fetched.append(feat.get("properties", {}).get(oid_field, feat.get("id")))
+                unfetched += len(failed)
+
+        if changes["ranges"]:
+            # imported here: the downloader imports this module for its refresh option
+            downloader = importlib.import_module("0000_geojsonl_downloader")
+            local = changes["local"]
+
+            def on_result(r, feats):
+                out.write(b"".join(downloader.feature_line(feat) for feat in feats))
+                fetched.extend(downloader.feature_oid(feat, oid_field) for feat in feats)
+                drop.append(local[np.searchsorted(local, r["lo"]):np.searchsorted(local, r["hi"], side="right")])
+
+            fetch = lambda r: downloader.fetch_page(session, limiter, api_url, r, oid_field, query)
+            failures = run_tasks(changes["ranges"], fetch, on_result, CONCURRENCY, label="range")
+            for r, e in failures:
+                print(f"Range {r['lo']}-{r['hi']} failed: {e}")
+            unfetched += len(failures)
+
+    fetched = np.asarray([oid for oid in fetched if oid is not None], dtype=np.int64)
+    return len(fetched), np.union1d(np.concatenate(drop), fetched), unfetched
+
+
+def merge_delta(geojsonl_path, delta_path, formats, drop, oid_field="OBJECTID"):
+    """Rewrite every output format as (old features not in `drop`) + delta features.
+
+    Outputs are written next to the originals and swapped in at the end, so an
+    interrupted merge leaves the previous version intact. Returns (features, features
+    dropped from the old file, paths).
+    """
+    base = os.path.splitext(geojsonl_path)[0]
+    tmp_base = base + "_refresh"
+    written = removed = 0
+    with open_sinks(tmp_base, formats) as sink:
+        for path, filtered in ((geojsonl_path, True), (delta_path, False)):
+            with open_read(path) as fin:
+                while True:
+                    lines = [l if l.endswith(b"\n") else l + b"\n" for l in fin.readlines(MERGE_BLOCK) if l.strip()]
+                    if not lines:
+                        break
+                    if filtered and len(drop):
+                        ids = [extract_oid(l, (oid_field,)) for l in lines]
+                        known = np.array([i is not None for i in ids], dtype=bool)
+                        ids = np.array([i if i is not None else 0 for i in ids], dtype=np.int64)
+                        dropped = known & np.isin(ids, drop)
+                        lines = [l for l, d in zip(lines, dropped) if not d]
+                        removed += int(dropped.sum())
+                    for line in lines:
+                        sink.write(line)
+                    written += len(lines)
+    paths = []
+    for f in formats:
+        os.replace(tmp_base + EXTENSIONS[f], base + EXTENSIONS[f])
+        paths.append(base + EXTENSIONS[f])
+    return written, removed, paths
+
+
+def refresh_layer(api_url, folder, basename, formats=None, session=None, limiter=None):
+    """Refresh {basename}.geojsonl (and its other outputs) in place from the server.
+
+    formats defaults to every output format that already exists next to the GeoJSONL.
+    Returns a summary dict (mode, fetched, removed, unfetched, features, outputs, start_time);
+    removed counts old versions dropped, whether replaced or deleted.
+    """
+    start_time = datetime.now()
+    geojsonl = os.path.join(folder, f"{basename}.geojsonl")
+    manifest = load_manifest(folder, basename)
+    if manifest is None or not os.path.exists(geojsonl):
+        raise FileNotFoundError(f"Nothing to refresh: needs {basename}.geojsonl and "
+                                f"{os.path.basename(manifest_path(folder, basename))} in {folder}")
+    if manifest.get("api_url") not in (None, api_url):
+        raise ValueError(f"{basename} was downloaded from {manifest['api_url']}, not {api_url}")
+    base = os.path.join(folder, basename)
+    if formats is None:
+        formats = [f for f in EXTENSIONS if os.path.exists(base + EXTENSIONS[f])]
+    formats = ["geojsonl"] + [f for f in formats if f != "geojsonl"]
+    print(f"\n>>> Start incremental refresh of {basename} @ {start_time} <<<\n")
+
+    session = session or make_session(CONCURRENCY)
+    limiter = limiter or AdaptiveLimiter(initial=CONCURRENCY, maximum=CONCURRENCY)
+    changes = find_changes(session, limiter, api_url, geojsonl, manifest)
+    if changes["mode"] == "ranges":
+        print(f"Mode: ranges, {len(changes['ranges']):,} changed ranges to download again")
+    else:
+        print(f"Mode: {changes['mode']}, {len(changes['fetch']):,} new or edited features, "
+              f"{len(changes['deleted']):,} deleted")
+
+    delta_path = base + "_delta.geojsonl"
+    query = manifest.get("query") or query_params()
+    fetched, drop, unfetched = fetch_delta(session, limiter, api_url, changes, delta_path, query)
+    if fetched or len(drop):
+        features, removed, outputs = merge_delta(geojsonl, delta_path, formats, drop, changes["oid_field"])
+    else:
+        features, removed, outputs = len(changes["local"]), 0, [base + EXTENSIONS[f] for f in formats]
+        print("No changes since the last run")
+    os.remove(delta_path)
+
+    complete = not unfetched and not changes["unchecked"]
+    if not complete:
+        print(f"Warning: {unfetched + changes['unchecked']} IDs / ranges were not refreshed; "
+              "they keep their previous version and are retried next time")
+    write_manifest(folder, basename, api_url=api_url, oid_field=changes["oid_field"],
+                   edit_field=changes["edit_field"],
+                   edit_max=changes["edit_max"] if complete else manifest.get("edit_max"),
+                   features=features, formats=formats, mode=changes["mode"], query=query)
+    print(f"Refreshed {', '.join(outputs)}: fetched {fetched:,}, removed {removed:,} old versions, "
+          f"{features:,} features in {datetime.now() - start_time}")
+    return {"mode": changes["mode"], "fetched": fetched, "removed": removed, "unfetched": unfetched,
+            "features": features, "outputs": outputs, "start_time": start_time}
@@ -0,0 +1,125 @@
+# feature_sinks.py
+# Purpose: Write one stream of GeoJSONL lines to several output formats in a single pass.
+# The downloader's merge feeds every deduplicated line to a MultiSink, so the
+# .geojsonl, the .geojson FeatureCollection and optional GeoParquet / FlatGeobuf
+# files come out of one read of the shards instead of a second full scan.
+# - GeoJSONLSink / FeatureCollectionSink copy raw line bytes through big buffers;
+#   GeoJSONL can also be written as seekable .geojsonl.zst or .geojsonl.gz (compressed_io.py)
+# - GeoParquet / FlatGeobuf sinks live in columnar_sinks.py and are imported only when
+#   one of those formats is opened, so GeoJSONL-only runs never load pyarrow or shapely
+
+import importlib
+
+from compressed_io import open_read, open_write
+
+IO_BUFFER = 8 * 1024 * 1024     # bytes buffered per text output
+
+# File extension per format name, as accepted by open_sinks
+EXTENSIONS = {"geojsonl": ".geojsonl", "geojsonl.zst": ".geojsonl.zst", "geojsonl.gz": ".geojsonl.gz",
+              "geojson": ".geojson", "parquet": ".parquet", "fgb": ".fgb"}
+GEOJSONL_FORMATS = ("geojsonl", "geojsonl.zst", "geojsonl.gz")
+
+
+class GeoJSONLSink:
+    """Plain, .zst or .gz GeoJSONL, chosen by the path's extension."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._f = open_write(path)
+
+    def write(self, line):
+        self._f.write(line)
+        self.count += 1
+
+    def close(self):
+        self._f.close()
+
+
+class FeatureCollectionSink:
+    """Wraps lines into {"type":"FeatureCollection","features":[...]} as they arrive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._f = open(path, "wb", buffering=IO_BUFFER)
+        self._f.write(b'{"type":"FeatureCollection","features":[\n')
+
+    def write(self, line):
+        if self.count:
+            self._f.write(b",\n")
+        self._f.write(line.rstrip(b"\r\n"))
+        self.count += 1
+
+    def close(self):
+        self._f.write(b"\n]}")
+        self._f.close()
+
+
+SINKS = {"geojsonl": GeoJSONLSink, "geojsonl.zst": GeoJSONLSink, "geojsonl.gz": GeoJSONLSink,
+         "geojson": FeatureCollectionSink,
+         "parquet": "columnar_sinks.GeoParquetSink", "fgb": "columnar_sinks.FlatGeobufSink"}  # loaded on use
+BATCH_FORMATS = ("parquet", "fgb")   # formats that also accept columnar batches (write_table)
+
+
+def sink_class(fmt):
+    """The sink class for a format name, importing columnar_sinks on first use."""
+    cls = SINKS[fmt]
+    if isinstance(cls, str):
+        module, name = cls.rsplit(".", 1)
+        cls = getattr(importlib.import_module(module), name)
+    return cls
+
+
+class MultiSink:
+    """Fan one stream of GeoJSONL lines out to several sinks; use as a context manager."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    @property
+    def paths(self):
+        return [s.path for s in self.sinks]
+
+    def write(self, line):
+        for s in self.sinks:
+            s.write(line)
+
+    def write_table(self, table):
+        """Columnar batch (see columnar_sinks.lines_to_table); only GeoParquet / FlatGeobuf sinks accept it."""
+        for s in self.sinks:
+            s.write_table(table)
+
+    def close(self):
+        for s in self.sinks:
+            s.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sinks(base_path, formats, crs=None, schema=None):
+    """Open one sink per format name (see SINKS) at base_path + extension.
+
+    crs (e.g. "EPSG:4269") is recorded in GeoParquet / FlatGeobuf outputs; GeoJSON
+    outputs are assumed to be EPSG:4326 already. schema is their properties schema
+    when known before the first batch (columnar_sinks.unify_schemas).
+    """
+    unknown = [f for f in formats if f not in SINKS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s) {unknown}; choose from {sorted(SINKS)}")
+    return MultiSink([sink_class(f)(base_path + EXTENSIONS[f], crs=crs, schema=schema) if f in BATCH_FORMATS
+                      else sink_class(f)(base_path + EXTENSIONS[f]) for f in formats])
+
+
+def convert_geojsonl(in_path, base_path, formats, crs=None):
+    """Stream an existing .geojsonl (plain, .zst or .gz) into other formats (one read);
+    returns the output paths."""
+    with open_sinks(base_path, formats, crs=crs) as sink, open_read(in_path) as fin:
+        for line in fin:
+            if line.strip():
+                sink.write(line if line.endswith(b"\n") else line + b"\n")
+    return sink.paths
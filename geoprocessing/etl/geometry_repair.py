@@ -0,0 +1,84 @@
+# geometry_repair.py
+# Purpose: Optional geometry validity / repair stage, applied to whole geometry arrays.
+# Used by the converter and the splitter workers so repair costs one vectorized
+# shapely 2 call per batch instead of Python work per feature.
+# - is_valid / is_valid_reason to find and classify invalid geometries
+# - make_valid, keeping only parts of the input's dimension (a self-intersecting
+#   flood polygon stays polygonal instead of becoming a GeometryCollection)
+# - optional precision snapping (set_precision) and topology-preserving simplify
+
+import re
+from collections import Counter
+
+import numpy as np
+import shapely
+
+GRID_SIZE = None             # e.g. 1e-7 degrees (~1 cm) to snap coordinates; None = off
+SIMPLIFY_TOLERANCE = None    # e.g. 1e-5 degrees (~1 m); None = off
+
+_location = re.compile(r"\[.*\]$")
+
+
+def _keep_dimension(fixed, dims):
+    """Drop lower-dimension debris that make_valid adds (e.g. a polygon's collapsed
+    spike becomes a stray LineString in a GeometryCollection)."""
+    mixed = np.flatnonzero(shapely.get_type_id(fixed) == 7)  # GeometryCollection
+    if len(mixed) == 0:
+        return fixed
+    parts, idx = shapely.get_parts(fixed[mixed], return_index=True)
+    parts, sub = shapely.get_parts(parts, return_index=True)  # explode Multi* members too
+    idx = idx[sub]
+    keep = shapely.get_dimensions(parts) == dims[mixed][idx]
+    parts, idx = parts[keep], idx[keep]
+    out = np.full(len(mixed), None, dtype=object)
+    for dim, build in ((2, shapely.multipolygons), (1, shapely.multilinestrings), (0, shapely.multipoints)):
+        sel = dims[mixed][idx] == dim
+        if sel.any():
+            groups = np.unique(idx[sel])
+            out[groups] = build(parts[sel], indices=np.searchsorted(groups, idx[sel]))
+    empty = np.array([g is None for g in out])
+    out[empty] = shapely.from_wkt("GEOMETRYCOLLECTION EMPTY")
+    fixed = fixed.copy()
+    fixed[mixed] = out
+    return fixed
+
+
+def repair_geometries(geoms, grid_size=GRID_SIZE, simplify_tolerance=SIMPLIFY_TOLERANCE):
+    """Validate and repair a geometry array; returns (new array, Counter of stats).
+
+    Stats count checked / invalid / repaired / still_invalid / empty_after_repair,
+    plus one "reason: <GEOS reason>" entry per invalidity type (location stripped).
+    Missing (None) geometries pass through untouched.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    stats = Counter()
+    present = ~shapely.is_missing(geoms)
+    stats["checked"] = int(present.sum())
+    invalid = present & ~shapely.is_valid(geoms)
+    if invalid.any():
+        stats["invalid"] = int(invalid.sum())
+        for reason in shapely.is_valid_reason(geoms[invalid]):
+            stats["reason: " + _location.sub("", reason)] += 1
+        dims = shapely.get_dimensions(geoms[invalid])
+        fixed = _keep_dimension(shapely.make_valid(geoms[invalid]), dims)
+        geoms = geoms.copy()
+        geoms[invalid] = fixed
+        ok = shapely.is_valid(fixed)
+        stats["repaired"] = int(ok.sum())
+        stats["still_invalid"] = int((~ok).sum())
+        stats["empty_after_repair"] = int(shapely.is_empty(fixed).sum())
+    if grid_size:
+        geoms = geoms.copy()
+        geoms[present] = shapely.set_precision(geoms[present], grid_size)
+        stats["snapped"] = int(present.sum())
+    if simplify_tolerance:
+        geoms = geoms.copy()
+        geoms[present] = shapely.simplify(geoms[present], simplify_tolerance, preserve_topology=True)
+        stats["simplified"] = int(present.sum())
+    return geoms, stats
+
+
+def format_stats(stats):
+    """One summary line per stat, invalidity reasons last."""
+    keys = sorted(stats, key=lambda k: (k.startswith("reason: "), k))
+    return "\n".join(f"  {k}: {stats[k]:,}" for k in keys)
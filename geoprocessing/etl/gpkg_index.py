@@ -0,0 +1,80 @@
+# gpkg_index.py
+# Purpose: Read GeoPackage structure straight from its SQLite tables, without GDAL.
+# Used to plan batch / shard work (FID ranges, R-tree extents) before any features are read.
+
+import sqlite3
+from math import ceil
+
+
+def get_fid_column(gpkg_path, layer_name):
+    """Return the layer table's integer primary key (the OGR FID), usually 'fid'."""
+    con = sqlite3.connect(gpkg_path)
+    try:
+        for _, name, _, _, _, pk in con.execute(f'PRAGMA table_info("{layer_name}")'):
+            if pk:
+                return name
+    finally:
+        con.close()
+    return "fid"
+
+
+def get_geometry_column(gpkg_path, layer_name):
+    con = sqlite3.connect(gpkg_path)
+    try:
+        row = con.execute("SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+                          (layer_name,)).fetchone()
+        return row[0] if row else "geom"
+    finally:
+        con.close()
+
+
+def get_rtree_table(gpkg_path, layer_name, geom_col):
+    """Name of the layer's GPKG R-tree (see 01_create_space_index_for_gpkg.bat), or None."""
+    con = sqlite3.connect(gpkg_path)
+    try:
+        row = con.execute("SELECT 1 FROM gpkg_extensions WHERE extension_name = 'gpkg_rtree_index' "
+                          "AND table_name = ? AND column_name = ?", (layer_name, geom_col)).fetchone()
+        return f"rtree_{layer_name}_{geom_col}" if row else None
+    except sqlite3.OperationalError:
+        return None  # no gpkg_extensions table
+    finally:
+        con.close()
+
+
+def plan_fid_ranges(gpkg_path, layer_name, fid_col, shards):
+    """Split the layer into `shards` contiguous FID ranges holding the same number of rows.
+
+    Only the rowid B-tree is touched, so planning is cheap even on a 40M-row layer.
+    Returns a list of (first_fid, last_fid, row_count).
+    """
+    con = sqlite3.connect(gpkg_path)
+    try:
+        total = con.execute(f'SELECT COUNT(*) FROM "{layer_name}"').fetchone()[0]
+        per = ceil(total / shards) if total else 0
+        nth = f'SELECT "{fid_col}" FROM "{layer_name}" ORDER BY "{fid_col}" LIMIT 1 OFFSET ?'
+        ranges = []
+        for start in range(0, total, per or 1):
+            end = min(start + per, total)
+            lo = con.execute(nth, (start,)).fetchone()[0]
+            hi = con.execute(nth, (end - 1,)).fetchone()[0]
+            ranges.append((lo, hi, end - start))
+        return ranges
+    finally:
+        con.close()
+
+
+def fid_batches(gpkg_path, layer_name, fid_col, batch_rows):
+    """Cover the layer's FID span with consecutive [lo, hi] windows of batch_rows IDs.
+
+    Cheaper than plan_fid_ranges for many small batches (one MIN/MAX query, no OFFSET
+    scans); gaps in the FIDs just make some batches short. Returns (total, [(lo, hi), ...]).
+    """
+    con = sqlite3.connect(gpkg_path)
+    try:
+        lo, hi, total = con.execute(f'SELECT MIN("{fid_col}"), MAX("{fid_col}"), COUNT(*) '
+                                    f'FROM "{layer_name}"').fetchone()
+    finally:
+        con.close()
+    if not total:
+        return 0, []
+    return total, [(a, min(a + batch_rows - 1, hi)) for a in range(lo, hi + 1, batch_rows)]
@@ -0,0 +1,218 @@
+# http_cache.py
+# Purpose: On-disk HTTP response cache for the ArcGIS scripts, so re-runs after a partial
+# failure and audit / patch runs right after a download read identical responses from
+# local disk instead of asking the server again.
+# - CachingAdapter: a requests transport adapter; mount it on a session (see
+#   arcgis_client.make_session) and every GET / form POST through it is cached
+# - keys are the normalized request: parameters sorted, GET query and POST form body
+#   treated alike, tokens ignored, so the same query hits whichever way it was sent
+# - entries are compressed (zstd when the zstandard package is installed, zlib otherwise)
+# - fresh entries (younger than CACHE_TTL) are served without a request; older ones are
+#   revalidated with If-None-Match / If-Modified-Since when the server sent an ETag or
+#   Last-Modified, and fetched again when it did not
+# - total size is bounded; the least recently used entries are evicted first
+# - count / ID list / extent / statistics queries are never cached: audits, patches and
+#   refreshes compare the local file against them, so they must be the server's current answer
+# ArcGIS reports query errors as HTTP 200 with an {"error": ...} body; those are never cached.
+
+import hashlib
+import json
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_zstd_errors = (zstandard.ZstdError,) if zstandard is not None else ()
+
+# Config
+CACHE_MAX_BYTES = 1024 ** 3      # compressed size the cache may grow to before LRU eviction
+CACHE_TTL = 6 * 3600             # seconds an entry is served without asking the server
+EVICT_TO = 0.9                   # eviction stops at this fraction of CACHE_MAX_BYTES
+IGNORED_PARAMS = {"token"}       # parameters that do not change the answer
+UNCACHED_FLAGS = ("returnCountOnly", "returnIdsOnly", "returnExtentOnly")  # =true: never cached
+
+KEPT_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+_error_body = re.compile(rb'^\s*\{\s*"error"\s*:')
+_header = struct.Struct("<I")
+
+
+def request_key(request):
+    """Cache key of a prepared request, or None when it should not be cached."""
+    if request.method not in ("GET", "POST"):
+        return None
+    parts = urlsplit(request.url)
+    params = parse_qsl(parts.query, keep_blank_values=True)
+    if request.body:
+        if "x-www-form-urlencoded" not in request.headers.get("Content-Type", ""):
+            return None
+        body = request.body.decode() if isinstance(request.body, bytes) else request.body
+        params += parse_qsl(body, keep_blank_values=True)
+    if any(k == "outStatistics" or (k in UNCACHED_FLAGS and v.lower() == "true") for k, v in params):
+        return None
+    params = sorted((k, v) for k, v in params if k not in IGNORED_PARAMS)
+    canonical = f"{parts.scheme}://{parts.netloc.lower()}{parts.path.rstrip('/')}?{urlencode(params)}"
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class HttpCache:
+    """Size-bounded on-disk store: one file per entry (metadata header + compressed body).
+
+    File modification times double as LRU clock: a hit touches the file, and eviction
+    removes the oldest files first. Safe to share between threads.
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".entry")
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".entry"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield st.st_mtime, st.st_size, path
+
+    def get(self, key):
+        """(metadata dict, body bytes) or None; marks the entry as recently used."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                blob = f.read()
+            (n,) = _header.unpack_from(blob)
+            meta = json.loads(blob[_header.size:_header.size + n])
+            body = blob[_header.size + n:]
+            if meta["codec"] == "zstd":
+                body = zstandard.ZstdDecompressor().decompress(body)
+            else:
+                body = zlib.decompress(body)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, struct.error, zlib.error, AttributeError, *_zstd_errors):
+            return None  # missing, torn or written with a codec we cannot read: a miss
+        return meta, body
+
+    def put(self, key, meta, body):
+        if zstandard is not None:
+            meta, data = {**meta, "codec": "zstd"}, zstandard.ZstdCompressor(level=3).compress(body)
+        else:
+            meta, data = {**meta, "codec": "zlib"}, zlib.compress(body, 6)
+        header = json.dumps(meta).encode()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(_header.pack(len(header)) + header + data)
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp, path)
+            self._size += os.path.getsize(path)
+            self.stats["stored"] += 1
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # called under the lock
+        target = self.max_bytes * EVICT_TO
+        for _, size, path in sorted(self._entries()):
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.stats["evicted"] += 1
+
+    def count(self, event):
+        """Count a hit / revalidation / miss; adapters call this from many threads."""
+        with self._lock:
+            self.stats[event] += 1
+
+    def summary(self):
+        with self._lock:
+            s = Counter(self.stats)
+        return (f"HTTP cache: {s['hit']:,} hits, {s['revalidated']:,} revalidated, {s['miss']:,} misses, "
+                f"{s['evicted']:,} evicted, {self._size / 1024 ** 2:,.1f} MB in {self.directory}")
+
+
+class CachingAdapter(HTTPAdapter):
+    """HTTPAdapter that answers from an HttpCache when it can (see module notes)."""
+
+    def __init__(self, cache, **kwargs):
+        self.cache = cache
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        key = request_key(request)
+        if key is None:
+            return super().send(request, **kwargs)
+        entry = self.cache.get(key)
+        if entry is not None:
+            meta, body = entry
+            if time.time() - meta["stored"] < self.cache.ttl:
+                self.cache.count("hit")
+                return self._cached_response(request, meta, body)
+            if meta["headers"].get("ETag"):
+                request.headers["If-None-Match"] = meta["headers"]["ETag"]
+            if meta["headers"].get("Last-Modified"):
+                request.headers["If-Modified-Since"] = meta["headers"]["Last-Modified"]
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.count("revalidated")
+            response.close()
+            self.cache.put(key, {**meta, "stored": time.time()}, body)  # fresh again
+            return self._cached_response(request, meta, body)
+        self.cache.count("miss")
+        if response.status_code == 200 and not _error_body.match(response.content[:64]):
+            headers = {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers}
+            self.cache.put(key, {"url": request.url, "headers": headers, "stored": time.time()}, response.content)
+        return response
+
+    def _cached_response(self, request, meta, body):
+        response = Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(meta["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.from_cache = True
+        return response
+
+
+def session_cache(session):
+    """The HttpCache mounted on a session, or None."""
+    adapter = session.get_adapter("https://")
+    return getattr(adapter, "cache", None)
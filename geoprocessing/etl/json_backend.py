@@ -0,0 +1,90 @@
+# json_backend.py
+# Purpose: One place to pick the fastest available JSON encoder/decoder.
+# - orjson or msgspec when installed, stdlib json otherwise (BACKEND says which)
+# - loads / dumps_line: decode a response body, encode one feature as a GeoJSONL line (bytes)
+# - decode_page: split a query response into raw per-feature byte slices without
+#   building dicts (needs msgspec), so the downloader can write them straight through
+
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+elif msgspec is not None:
+    BACKEND = "msgspec"
+else:
+    BACKEND = "json"
+
+# Raw feature passthrough needs msgspec.Raw to slice features out of the page
+PASSTHROUGH_AVAILABLE = msgspec is not None
+
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder()
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    class _RawPage(msgspec.Struct):
+        # f=geojson puts exceededTransferLimit under "properties", f=json at the top level
+        features: "list[msgspec.Raw]" = []
+        exceededTransferLimit: bool = False
+        properties: dict = {}
+        error: Any = None
+
+    _raw_page_decoder = msgspec.json.Decoder(_RawPage)
+
+
+def loads(data):
+    """Decode JSON from bytes or str."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        return _msgspec_decoder.decode(data)
+    return json.loads(data)
+
+
+def dumps_line(obj):
+    """Encode obj as one UTF-8 GeoJSONL line (non-ASCII kept as-is, trailing newline)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+    if msgspec is not None:
+        return _msgspec_encoder.encode(obj) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def raw_line(raw):
+    """Turn a raw feature slice into a GeoJSONL line.
+
+    A raw newline can only be insignificant whitespace (newlines inside JSON strings
+    are always escaped), so replacing it keeps the feature on one line.
+    """
+    raw = bytes(raw)
+    if b"\n" in raw or b"\r" in raw:
+        raw = raw.replace(b"\r", b" ").replace(b"\n", b" ")
+    return raw + b"\n"
+
+
+def decode_page(content, passthrough=False):
+    """Decode a /query response into a dict with features, exceededTransferLimit,
+    properties and error.
+
+    With passthrough (and msgspec installed) each feature is returned as its original
+    bytes instead of a dict, skipping both the parse and the later re-encode.
+    """
+    if passthrough and msgspec is not None:
+        page = _raw_page_decoder.decode(content)
+        return {
+            "features": [bytes(f) for f in page.features],
+            "exceededTransferLimit": page.exceededTransferLimit,
+            "properties": page.properties,
+            "error": page.error,
+        }
+    return loads(content)
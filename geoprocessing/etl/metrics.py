@@ -0,0 +1,359 @@
+# metrics.py
+# Purpose: Shared instrumentation for the download, merge, convert, split and validate
+# stages, so a slow national run can be diagnosed afterwards (network, JSON or disk?)
+# without running it again.
+# - count / gauge / observe: counters, gauges and histograms, optionally labelled
+#   (e.g. layer="nfhl_28"); timed(name) observes the seconds a block takes
+# - stage(name): wall time of one stage; the stage summary adds features/s and MB/s from
+#   the <stage>_features_total and <stage>_bytes_out_total counters
+# - export: JSON lines (one snapshot per line, every EXPORT_INTERVAL seconds and at exit)
+#   or, for a .prom path, a Prometheus textfile (node_exporter textfile collector)
+# - profiling, opt-in: "cprofile" dumps a .prof per stage (snakeviz, pstats);
+#   "sample" samples every thread's stack every SAMPLE_INTERVAL and writes collapsed
+#   stacks (<base>.collapsed), the format py-spy --format raw, flamegraph.pl and
+#   speedscope read; threads waiting on sockets show up as network time
+# Enabled with configure(...) or the --metrics / --profile options of the command lines
+# (which default to the ETL_METRICS / ETL_PROFILE environment variables); importing this
+# module starts no threads and writes no files, so pool workers stay quiet. Worker
+# processes return their metrics with drain() and the parent adds them with merge().
+# Recording is cheap (a dict update under a lock) and is done per page or batch, never
+# per feature; without an output configured nothing is written.
+
+import atexit
+import bisect
+import cProfile
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+# Config
+EXPORT_INTERVAL = 30.0        # seconds between periodic snapshots
+SAMPLE_INTERVAL = 0.01        # seconds between stack samples in "sample" mode
+PREFIX = "etl_"               # Prometheus metric name prefix
+# Histogram bucket upper bounds: seconds for *_seconds metrics, plain values otherwise
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+VALUE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10_000, 100_000, 1_000_000)
+PROFILE_MODES = ("cprofile", "sample")
+
+_lock = threading.Lock()
+_counters = Counter()
+_gauges = {}
+_histograms = {}
+_stages = {}
+_config = {"output": None, "profile": None, "started": False}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+def _split_key(key):
+    name, _, rest = key.partition("{")
+    return name, ("{" + rest) if rest else ""
+
+
+def count(name, value=1, **labels):
+    """Add to a counter (names end in _total by convention)."""
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def gauge(name, value, **labels):
+    """Set a gauge to its current value (queue depth, requests in flight, ...)."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Add one observation to a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            bounds = SECONDS_BUCKETS if name.endswith("_seconds") else VALUE_BUCKETS
+            h = _histograms[key] = {"bounds": bounds, "buckets": [0] * (len(bounds) + 1),
+                                    "count": 0, "sum": 0.0, "max": 0.0}
+        h["buckets"][bisect.bisect_left(h["bounds"], value)] += 1
+        h["count"] += 1
+        h["sum"] += value
+        h["max"] = max(h["max"], value)
+
+
+@contextmanager
+def timed(name, **labels):
+    """Observe the seconds the block takes in histogram `name`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+@contextmanager
+def stage(name, **labels):
+    """Time one stage (and profile it in "cprofile" mode); stages may run concurrently."""
+    _start()
+    profiler = None
+    if _config["profile"] == "cprofile" and threading.current_thread() is threading.main_thread():
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # another stage on this thread is being profiled already
+            profiler = None
+    started = time.perf_counter()
+    key = _key(name, labels)
+    with _lock:
+        _stages.setdefault(key, {"seconds": 0.0, "runs": 0})["running"] = True
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        with _lock:
+            s = _stages[key]
+            s["seconds"] += seconds
+            s["runs"] += 1
+            s["running"] = False
+        if profiler is not None:
+            profiler.disable()
+            safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in key)
+            try:
+                profiler.dump_stats(f"{_output_base()}_{safe}_{os.getpid()}.prof")
+            except OSError as e:
+                print(f"Warning: could not write the profile of {key}: {e}")
+
+
+def _quantile(h, q):
+    """Estimate a quantile from the histogram buckets (linear inside a bucket)."""
+    if not h["count"]:
+        return None
+    rank = q * h["count"]
+    seen = 0
+    lower = 0.0
+    for i, n in enumerate(h["buckets"]):
+        upper = h["bounds"][i] if i < len(h["bounds"]) else h["max"]
+        if n and seen + n >= rank:
+            return min(lower + (upper - lower) * (rank - seen) / n, h["max"])
+        seen += n
+        lower = upper
+    return h["max"]
+
+
+def snapshot():
+    """Everything recorded so far as one JSON-serializable dict."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        histograms = {k: dict(v, buckets=list(v["buckets"])) for k, v in _histograms.items()}
+        stages = {k: dict(v) for k, v in _stages.items()}
+    for key, s in stages.items():
+        name, labels = _split_key(key)
+        seconds = s["seconds"] or 1e-9
+        features = counters.get(f"{name}_features_total{labels}")
+        written = counters.get(f"{name}_bytes_out_total{labels}")
+        if features is not None:
+            s["features_per_s"] = round(features / seconds, 1)
+        if written is not None:
+            s["mb_per_s"] = round(written / 1024 ** 2 / seconds, 2)
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "pid": os.getpid(),
+        "stages": stages,
+        "counters": counters,
+        "gauges": gauges,
+        "histograms": {k: {"count": h["count"], "sum": round(h["sum"], 6), "max": h["max"],
+                           "p50": _quantile(h, 0.5), "p90": _quantile(h, 0.9), "p99": _quantile(h, 0.99)}
+                       for k, h in histograms.items()},
+    }
+
+
+def drain():
+    """Take (and reset) this process's raw metrics, for a worker to return to its parent."""
+    with _lock:
+        data = {"counters": dict(_counters), "histograms": _histograms.copy()}
+        _counters.clear()
+        _histograms.clear()
+    return data
+
+
+def merge(data):
+    """Add metrics drained in another process."""
+    if not data:
+        return
+    with _lock:
+        _counters.update(data["counters"])
+        for key, h in data["histograms"].items():
+            mine = _histograms.get(key)
+            if mine is None:
+                _histograms[key] = h
+                continue
+            mine["buckets"] = [a + b for a, b in zip(mine["buckets"], h["buckets"])]
+            mine["count"] += h["count"]
+            mine["sum"] += h["sum"]
+            mine["max"] = max(mine["max"], h["max"])
+
+
+# --- Export ---
+def _output_base():
+    output = _config["output"]
+    return os.path.splitext(output)[0] if output else os.path.abspath("etl_profile")
+
+
+def _atomic_write(path, text):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def prometheus_text(snap=None):
+    """The metrics in Prometheus text exposition format."""
+    snap = snap or snapshot()
+    with _lock:
+        histograms = {k: dict(v, buckets=list(v["buckets"])) for k, v in _histograms.items()}
+    lines = []
+    typed = set()
+
+    def metric(key, kind):
+        name, labels = _split_key(key)
+        name = PREFIX + name
+        if name not in typed:
+            lines.append(f"# TYPE {name} {kind}")
+            typed.add(name)
+        return name, labels
+
+    for key, value in sorted(snap["counters"].items()):
+        name, labels = metric(key, "counter")
+        lines.append(f"{name}{labels} {value}")
+    for key, value in sorted(snap["gauges"].items()):
+        name, labels = metric(key, "gauge")
+        lines.append(f"{name}{labels} {value}")
+    for key, s in sorted(snap["stages"].items()):
+        name, labels = metric(_split_key(key)[0] + "_stage_seconds" + _split_key(key)[1], "gauge")
+        lines.append(f"{name}{labels} {s['seconds']:.3f}")
+    for key, h in sorted(histograms.items()):
+        name, labels = metric(key, "histogram")
+        inner = labels[1:-1]
+        cumulative = 0
+        for bound, n in zip(list(h["bounds"]) + ["+Inf"], h["buckets"]):
+            cumulative += n
+            le = f'le="{bound}"'
+            lines.append(f"{name}_bucket{{{inner + ',' if inner else ''}{le}}} {cumulative}")
+        lines.append(f"{name}_sum{labels} {h['sum']}")
+        lines.append(f"{name}_count{labels} {h['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def export():
+    """Write the current metrics to the configured output (and the sampled stacks)."""
+    output = _config["output"]
+    if output:
+        snap = snapshot()
+        if output.endswith(".prom"):
+            _atomic_write(output, prometheus_text(snap))
+        else:
+            with open(output, "a", encoding="utf-8") as f:
+                f.write(json.dumps(snap) + "\n")
+    if _sampler is not None:
+        _sampler.write(_output_base() + ".collapsed")
+
+
+class _StackSampler(threading.Thread):
+    """Counts the folded stack of every other thread every `interval` seconds."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name="metrics-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, frame in frames.items():
+                    if names.get(ident, "").startswith("metrics-"):
+                        continue  # the sampler and the exporter
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with self._lock:
+            text = "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+        _atomic_write(path, text)
+
+
+_sampler = None
+
+
+def _start():
+    """Start the periodic exporter (and sampler) once, on first use."""
+    global _sampler
+    if _config["started"] or not (_config["output"] or _config["profile"]):
+        return
+    with _lock:
+        if _config["started"]:
+            return
+        _config["started"] = True
+        pid = os.getpid()
+    if _config["profile"] == "sample":
+        _sampler = _StackSampler()
+        _sampler.start()
+
+    def loop():
+        while True:
+            time.sleep(EXPORT_INTERVAL)
+            export()
+
+    threading.Thread(target=loop, name="metrics-export", daemon=True).start()
+    # forked pool workers inherit the settings but exit without running atexit
+    atexit.register(lambda: os.getpid() == pid and export())
+
+
+def configure(output=None, profile=None):
+    """Set where metrics go (.jsonl / .json -> JSON lines, .prom -> Prometheus textfile)
+    and the profiling mode (None, "cprofile" or "sample")."""
+    if profile not in (None, *PROFILE_MODES):
+        raise ValueError(f"profile must be one of {PROFILE_MODES}")
+    _config["output"] = os.path.abspath(output) if output else None
+    _config["profile"] = profile
+    if output:
+        os.makedirs(os.path.dirname(_config["output"]), exist_ok=True)
+    _start()
+
+
+def add_arguments(parser):
+    """Add --metrics / --profile to a script's argparse parser."""
+    parser.add_argument("--metrics", default=os.environ.get("ETL_METRICS"),
+                        help="write metrics to this .jsonl (snapshots) or .prom (Prometheus textfile)")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=os.environ.get("ETL_PROFILE") or None,
+                        help="cprofile: a .prof per stage; sample: collapsed stacks of all threads")
+
+
+def summary():
+    """One printable line per stage."""
+    snap = snapshot()
+    out = []
+    for key, s in snap["stages"].items():
+        line = f"{key}: {s['seconds']:.1f}s"
+        if "features_per_s" in s:
+            line += f", {s['features_per_s']:,.0f} features/s"
+        if "mb_per_s" in s:
+            line += f", {s['mb_per_s']:,.1f} MB/s"
+        out.append(line)
+    return "\n".join(out)
+
@@ -0,0 +1,302 @@
+# mock_featureserver.py
+# Purpose: Local stand-in for an ArcGIS REST FeatureServer layer that serves synthetic
+# features (synthetic_data.py), for the benchmark (99_benchmark_pipeline.py) and for
+# trying the downloader / patcher / incremental refresh without a real server.
+# - layer metadata (?f=json), service layer list, returnCountOnly, returnIdsOnly,
+#   outStatistics (min / max OBJECTID, count, max EditDate) and f=geojson feature queries
+# - WHERE clauses as the scripts write them: 1=1, OBJECTID BETWEEN / > / >= / IN joined
+#   by OR, and EditDate >= TIMESTAMP '...'; resultOffset / resultRecordCount paging and
+#   exceededTransferLimit when a result is capped at maxRecordCount; outFields and
+#   geometryPrecision shape the features like a download profile asks for
+# - knobs: number of features, page size (maxRecordCount), latency + jitter per request,
+#   error rate (HTTP 503 or an ArcGIS error body with HTTP 200), empty-page rate, ID gaps,
+#   and the largest ID list returnIdsOnly answers (bigger layers get an error, as on
+#   real servers, which sends the downloader to range paging)
+# - the command line can pre-fork several server processes on one socket (POSIX), so
+#   the stand-in is not the bottleneck of the client being measured
+# Selections are kept as OBJECTID ranges, so a 50M feature layer needs no per-ID state.
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+
+from synthetic_data import EDIT_BASE, FIELDS, count_upto, edit_dates, feature_lines, object_ids
+
+# Config
+FEATURES = 1_000_000
+PAGE_SIZE = 2000          # maxRecordCount
+LATENCY = 0.0             # seconds added to every query
+JITTER = 0.0              # up to this many extra seconds, uniformly random
+ERROR_RATE = 0.0          # share of feature queries that fail (half 503, half ArcGIS error body)
+EMPTY_RATE = 0.0          # share of feature queries answered with no features
+GAP_EVERY = 0             # leave out every n-th OBJECTID (0 = contiguous IDs)
+MAX_IDS = 2_000_000       # returnIdsOnly refuses layers with more IDs than this
+GEOMETRY = "polygon"
+SERVICE_PATH = "/arcgis/rest/services/Synthetic/FeatureServer"
+
+_between = re.compile(r"OBJECTID\s+BETWEEN\s+(\d+)\s+AND\s+(\d+)", re.I)
+_greater = re.compile(r"OBJECTID\s*(>=?)\s*(\d+)", re.I)
+_in = re.compile(r"OBJECTID\s+IN\s*\(([\d,\s]*)\)", re.I)
+_since = re.compile(r"\w+\s*>=?\s*TIMESTAMP\s*'([^']+)'", re.I)
+
+
+class Layer:
+    """The synthetic layer: answers queries as lists of OBJECTID selections."""
+
+    def __init__(self, features=FEATURES, gap_every=GAP_EVERY, geometry=GEOMETRY):
+        self.features = features
+        self.gap_every = gap_every
+        self.geometry = geometry
+        self.max_oid = int(object_ids(features - 1, features, gap_every)[0]) if features else 0
+
+    def index_range(self, lo, hi):
+        """[start, stop) positions in the ID sequence of the OBJECTIDs in [lo, hi]."""
+        lo, hi = max(lo, 1), min(hi, self.max_oid)
+        if lo > hi:
+            return 0, 0
+        return count_upto(lo - 1, self.gap_every), count_upto(hi, self.gap_every)
+
+    def select(self, where):
+        """Parse a WHERE clause into [(start, stop)] position ranges and an explicit ID array."""
+        where = (where or "1=1").strip()
+        ranges, ids = [], []
+        for part in re.split(r"\s+OR\s+", where, flags=re.I):
+            part = part.strip()
+            if m := _between.search(part):
+                ranges.append(self.index_range(int(m[1]), int(m[2])))
+            elif m := _in.search(part):
+                ids += [int(v) for v in m[1].split(",") if v.strip()]
+            elif m := _greater.search(part):
+                ranges.append(self.index_range(int(m[2]) + (m[1] == ">"), self.max_oid))
+            elif m := _since.search(part):
+                ts = datetime.strptime(m[1], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+                first = -(-(int(ts.timestamp() * 1000) - EDIT_BASE) // 1000)  # ceil
+                ranges.append(self.index_range(first, self.max_oid))
+            elif part.strip("() ") in ("1=1", ""):
+                ranges.append((0, self.features))
+            else:
+                raise ValueError(f"unsupported where clause: {part}")
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        valid = (ids >= 1) & (ids <= self.max_oid)
+        if self.gap_every:
+            valid &= ids % self.gap_every != 0
+        ids = ids[valid]
+        # IDs already covered by a range are not repeated
+        for start, stop in ranges:
+            if stop > start:
+                first, last = object_ids(start, start + 1, self.gap_every)[0], object_ids(stop - 1, stop, self.gap_every)[0]
+                ids = ids[(ids < first) | (ids > last)]
+        return [r for r in ranges if r[1] > r[0]], ids
+
+    def count(self, selection):
+        ranges, ids = selection
+        return sum(stop - start for start, stop in ranges) + len(ids)
+
+    def oids(self, selection, offset=0, limit=None):
+        """Sorted OBJECTIDs of a selection, from `offset`, at most `limit`."""
+        ranges, ids = selection
+        if len(ranges) == 1 and not len(ids):
+            start, stop = ranges[0]
+            return object_ids(start + offset, stop if limit is None else min(stop, start + offset + limit),
+                              self.gap_every)
+        # only materialize the positions the page can reach
+        end = None if limit is None else offset + limit
+        parts = [object_ids(start, stop if end is None else min(stop, start + end), self.gap_every)
+                 for start, stop in ranges]
+        return np.unique(np.concatenate(parts + [ids]))[offset:end]
+
+
+class MockFeatureServer:
+    """ThreadingHTTPServer serving one synthetic layer at SERVICE_PATH/0.
+
+    start() runs it on a background thread and returns the layer URL; serve_forever()
+    blocks (used by the command line). `stats` counts requests, injected errors and
+    empty pages.
+    """
+
+    def __init__(self, features=FEATURES, page_size=PAGE_SIZE, latency=LATENCY, jitter=JITTER,
+                 error_rate=ERROR_RATE, empty_rate=EMPTY_RATE, gap_every=GAP_EVERY, max_ids=MAX_IDS,
+                 geometry=GEOMETRY, host="127.0.0.1", port=0, seed=0):
+        self.layer = Layer(features, gap_every, geometry)
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.max_ids = max_ids
+        self.stats = {"requests": 0, "errors": 0, "empty": 0, "features": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), _handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{SERVICE_PATH}/0"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _draw(self):
+        with self._lock:
+            return self._random.random()
+
+    def layer_info(self):
+        return {"currentVersion": 11.1, "id": 0, "name": "Synthetic", "type": "Feature Layer",
+                "geometryType": "esriGeometryPoint" if self.layer.geometry == "point" else "esriGeometryPolygon",
+                "objectIdField": "OBJECTID", "maxRecordCount": self.page_size,
+                "editFieldsInfo": {"editDateField": "EditDate"},
+                "fields": [{"name": "OBJECTID", "type": "esriFieldTypeOID"},
+                           {"name": "NAME", "type": "esriFieldTypeString"},
+                           {"name": "CATEGORY", "type": "esriFieldTypeInteger"},
+                           {"name": "VALUE", "type": "esriFieldTypeDouble"},
+                           {"name": "EditDate", "type": "esriFieldTypeDate"}]}
+
+    def query(self, params):
+        """(status, body bytes) for a /query request."""
+        selection = self.layer.select(params.get("where"))
+        if params.get("returnCountOnly") == "true":
+            return 200, json.dumps({"count": self.layer.count(selection)}).encode()
+        if params.get("returnIdsOnly") == "true":
+            if self.layer.count(selection) > self.max_ids:
+                return 200, json.dumps({"error": {"code": 400, "message": "Requested operation exceeds limits"}}).encode()
+            ids = self.layer.oids(selection)
+            return 200, json.dumps({"objectIdFieldName": "OBJECTID", "objectIds": ids.tolist()}).encode()
+        if params.get("outStatistics"):
+            return 200, json.dumps({"features": [{"attributes": self.statistics(selection, params["outStatistics"])}]}).encode()
+
+        draw = self._draw()
+        if draw < self.error_rate:
+            self.stats["errors"] += 1
+            if draw < self.error_rate / 2:
+                return 503, b'{"error":{"code":503,"message":"Service unavailable"}}'
+            return 200, b'{"error":{"code":500,"message":"Error performing query operation"}}'
+        if draw < self.error_rate + self.empty_rate:
+            self.stats["empty"] += 1
+            return 200, b'{"type":"FeatureCollection","features":[]}'
+
+        offset = int(params.get("resultOffset", 0))
+        limit = min(int(params.get("resultRecordCount", self.page_size)), self.page_size)
+        total = self.layer.count(selection)
+        oids = self.layer.oids(selection, offset, limit)
+        self.stats["features"] += len(oids)
+        more = "true" if offset + len(oids) < total else "false"
+        out_fields = params.get("outFields", "*")
+        fields = FIELDS if out_fields.strip() == "*" else [f.strip() for f in out_fields.split(",")]
+        lines = feature_lines(oids, self.layer.geometry, fields, int(params.get("geometryPrecision", 6)))
+        return 200, (b'{"type":"FeatureCollection","features":[' + b",".join(lines)
+                     + b'],"exceededTransferLimit":' + more.encode() + b"}")
+
+    def statistics(self, selection, spec):
+        oids = self.layer.oids(selection, 0, 1)
+        count = self.layer.count(selection)
+        last = self.layer.oids(selection, count - 1, 1) if count else oids
+        values = {"min": int(oids[0]) if count else None, "max": int(last[0]) if count else None, "count": count}
+        attrs = {}
+        for stat in json.loads(spec):
+            kind, field = stat["statisticType"].lower(), stat["onStatisticField"]
+            value = values.get(kind)
+            if field.lower() == "editdate" and value is not None and kind in ("min", "max"):
+                value = int(edit_dates([value])[0])
+            attrs[stat.get("outStatisticFieldName") or f"{kind}_{field}"] = value
+        return attrs
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the pooled sessions expect
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            self.answer(parts.path, dict(parse_qsl(parts.query)))
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            parts = urlsplit(self.path)
+            self.answer(parts.path, {**dict(parse_qsl(parts.query)), **dict(parse_qsl(body))})
+
+        def answer(self, path, params):
+            server.stats["requests"] += 1
+            if server.latency or server.jitter:
+                time.sleep(server.latency + server.jitter * server._draw())
+            path = path.rstrip("/")
+            try:
+                if path.endswith("/query"):
+                    status, body = server.query(params)
+                elif path == SERVICE_PATH:
+                    status, body = 200, json.dumps({"layers": [{"id": 0, "name": "Synthetic"}]}).encode()
+                elif path == SERVICE_PATH + "/0":
+                    status, body = 200, json.dumps(server.layer_info()).encode()
+                else:
+                    status, body = 404, b'{"error":{"code":404,"message":"Not found"}}'
+            except ValueError as e:
+                status, body = 200, json.dumps({"error": {"code": 400, "message": str(e)}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic ArcGIS FeatureServer layer.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--features", type=int, default=FEATURES)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds per request")
+    parser.add_argument("--jitter", type=float, default=JITTER, help="extra random seconds per request")
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE)
+    parser.add_argument("--empty-rate", type=float, default=EMPTY_RATE)
+    parser.add_argument("--gap-every", type=int, default=GAP_EVERY)
+    parser.add_argument("--max-ids", type=int, default=MAX_IDS)
+    parser.add_argument("--geometry", choices=["polygon", "point"], default=GEOMETRY)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1, help="server processes sharing the port (POSIX)")
+    args = parser.parse_args(argv)
+    if args.gap_every == 1:
+        parser.error("--gap-every must be 0 (no gaps) or at least 2")
+    server = MockFeatureServer(args.features, args.page_size, args.latency, args.jitter, args.error_rate,
+                               args.empty_rate, args.gap_every, args.max_ids, args.geometry, port=args.port,
+                               seed=args.seed)
+    print(f"Serving {args.features:,} synthetic features at {server.url}", flush=True)
+    for i in range(1, args.processes if hasattr(os, "fork") else 1):
+        if os.fork() == 0:
+            server._random.seed(args.seed + i)  # each process draws its own errors / empty pages
+            break
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served: {server.stats}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
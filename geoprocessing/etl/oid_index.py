@@ -0,0 +1,304 @@
+# oid_index.py
+# Purpose: Memory-bounded OBJECTID bookkeeping for large .geojsonl files.
+# - extract_oid: pull the OBJECTID out of a raw feature line without json.loads
+# - OidBitmap: growable bit set for integer OIDs (1 bit per possible ID)
+# - HashDedup: disk-spilling sort-merge dedup for lines that carry no OID
+# - dedup_merge: merge shard files into one, copying kept lines through as raw bytes
+# - audit_oids: one vectorized pass -> duplicate OIDs, missing OIDs and missing ID runs
+# - read_oids: the sorted set of OIDs in a file, from the same vectorized scan
+
+import hashlib
+import heapq
+import os
+import re
+import tempfile
+from collections import Counter
+from contextlib import nullcontext
+
+import numpy as np
+
+from compressed_io import open_read, open_write
+
+OID_FIELDS = ("OBJECTID", "FID")
+IO_BUFFER = 8 * 1024 * 1024
+MAX_BITMAP_OID = 2 ** 31      # larger or negative IDs go to an overflow set (256 MB bitmap cap)
+HASH_RUN_SIZE = 2_000_000     # digests held in memory before a sorted run is spilled to disk
+AUDIT_BLOCK = 64 * 1024 * 1024  # bytes scanned per regex pass in audit_oids
+
+_HASH_DTYPE = np.dtype([("h", "S16"), ("i", "<u8")])
+_oid_patterns = {}
+
+
+def _oid_pattern(field):
+    if field not in _oid_patterns:
+        _oid_patterns[field] = re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*(-?\d+)\b')
+    return _oid_patterns[field]
+
+
+def extract_oid(line, fields=OID_FIELDS):
+    """Return the first integer OID found in a raw (bytes) feature line, or None.
+
+    Only the `"FIELD": <int>` token is matched, so the rest of the line is never
+    decoded. A property key inside a string value would be escaped (\\"OBJECTID\\")
+    and does not match.
+    """
+    for field in fields:
+        m = _oid_pattern(field).search(line)
+        if m:
+            return int(m.group(1))
+    return None
+
+
+class OidBitmap:
+    """Growable bit set over non-negative integer OIDs.
+
+    50M contiguous IDs cost ~6 MB instead of the ~2.5 GB a Python set of ints needs.
+    IDs outside [0, MAX_BITMAP_OID) fall back to a small overflow set.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.bits = bytearray(capacity // 8 + 1)
+        self.overflow = set()
+
+    def add(self, oid):
+        """Set oid; return True if it was already present."""
+        if oid < 0 or oid >= MAX_BITMAP_OID:
+            if oid in self.overflow:
+                return True
+            self.overflow.add(oid)
+            return False
+        byte, bit = oid >> 3, 1 << (oid & 7)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(max(byte + 1, 2 * len(self.bits)) - len(self.bits)))
+        seen = self.bits[byte] & bit
+        self.bits[byte] |= bit
+        return bool(seen)
+
+    def to_array(self):
+        """Sorted int64 array of every OID in the set."""
+        ids = np.flatnonzero(np.unpackbits(np.frombuffer(self.bits, dtype=np.uint8), bitorder="little"))
+        if self.overflow:
+            ids = np.union1d(ids, np.fromiter(self.overflow, dtype=np.int64))
+        return ids.astype(np.int64)
+
+
+class HashDedup:
+    """Exact dedup of lines by MD5 digest with bounded memory.
+
+    Digests are buffered with their line index, spilled to disk as sorted runs, then
+    k-way merged; the merge reports every index whose digest was already seen at a
+    smaller index.
+    """
+
+    def __init__(self, tmp_dir=None, run_size=HASH_RUN_SIZE):
+        self.tmp_dir = tmp_dir
+        self.run_size = run_size
+        self.digests = bytearray()
+        self.indexes = []
+        self.runs = []
+
+    def add(self, line, index):
+        self.digests += hashlib.md5(line).digest()
+        self.indexes.append(index)
+        if len(self.indexes) >= self.run_size:
+            self._spill()
+
+    def _sorted_buffer(self):
+        arr = np.empty(len(self.indexes), dtype=_HASH_DTYPE)
+        arr["h"] = np.frombuffer(bytes(self.digests), dtype="S16")
+        arr["i"] = self.indexes
+        self.digests = bytearray()
+        self.indexes = []
+        return np.sort(arr, order=["h", "i"])
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(suffix=".hashrun", dir=self.tmp_dir)
+        with os.fdopen(fd, "wb") as f:
+            self._sorted_buffer().tofile(f)
+        self.runs.append(path)
+
+    @staticmethod
+    def _read_run(path, chunk=65536):
+        run = np.memmap(path, dtype=_HASH_DTYPE, mode="r")
+        for start in range(0, len(run), chunk):
+            for h, i in run[start:start + chunk].tolist():
+                yield h, i
+
+    def duplicate_indexes(self):
+        """Sorted uint64 array of line indexes that repeat an earlier line."""
+        if not self.runs:
+            arr = self._sorted_buffer()
+            dup = arr["h"][1:] == arr["h"][:-1]
+            return np.sort(arr["i"][1:][dup])
+        if self.indexes:
+            self._spill()
+        dupes = []
+        prev = None
+        for h, i in heapq.merge(*(self._read_run(p) for p in self.runs)):
+            if h == prev:
+                dupes.append(i)
+            prev = h
+        for p in self.runs:
+            os.remove(p)
+        self.runs = []
+        return np.sort(np.asarray(dupes, dtype=np.uint64))
+
+
+def dedup_merge(in_paths, out, fields=OID_FIELDS, tmp_dir=None):
+    """Merge .geojsonl shards into `out`, keeping the first line for each OID.
+
+    `out` is a file path or any object with write(line_bytes), e.g. a
+    feature_sinks.MultiSink writing several formats in the same pass. Input and output
+    paths may be .zst / .gz compressed (compressed_io.py).
+    Lines are copied as raw bytes; only the OID token is parsed. Lines without an
+    integer OID are deduplicated by content hash: they are spooled to a temporary
+    file during the pass and appended (first occurrences, in input order) at the end.
+    Returns (kept, dupes, bad_lines).
+    """
+    seen = OidBitmap()
+    hashes = HashDedup(tmp_dir)
+    kept = dupes = bad = 0
+    spool_fd, spool_path = tempfile.mkstemp(suffix=".nooid.geojsonl", dir=tmp_dir)
+    spooled = 0
+
+    fout = open_write(out) if isinstance(out, (str, os.PathLike)) else nullcontext(out)
+    with fout as fout, os.fdopen(spool_fd, "wb", buffering=IO_BUFFER) as spool:
+        for p in in_paths:
+            with open_read(p) as fin:
+                for line in fin:
+                    line = line.rstrip(b"\r\n")
+                    if not line.strip():
+                        continue
+                    if not (line.lstrip().startswith(b"{") and line.rstrip().endswith(b"}")):
+                        print(f"Warning: Skipping malformed line in {p}: {line[:80]!r}")
+                        bad += 1
+                        continue
+                    oid = extract_oid(line, fields)
+                    if oid is None:
+                        hashes.add(line, spooled)
+                        spool.write(line + b"\n")
+                        spooled += 1
+                        continue
+                    if seen.add(oid):
+                        dupes += 1
+                        continue
+                    fout.write(line + b"\n")
+                    kept += 1
+
+        if spooled:
+            spool.flush()
+            drop = hashes.duplicate_indexes()
+            dupes += len(drop)
+            kept += spooled - len(drop)
+            d = 0
+            with open(spool_path, "rb", buffering=IO_BUFFER) as fin:
+                for index, line in enumerate(fin):
+                    if d < len(drop) and drop[d] == index:
+                        d += 1
+                        continue
+                    fout.write(line)
+
+    os.remove(spool_path)
+    return kept, dupes, bad
+
+
+def _scan_oids(path, field, block_size=AUDIT_BLOCK):
+    """Yield (int64 OID array, line count) per block of whole lines.
+
+    One multiline regex per block finds the first OID token of every line in C, and
+    numpy converts the matched digit strings to integers, so no per-line Python runs.
+    """
+    pattern = re.compile(rb'^[^\n]*?"' + re.escape(field.encode()) + rb'"\s*:\s*(-?\d+)\b', re.M)
+    with open_read(path) as f:
+        tail = b""
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            block = tail + block
+            cut = block.rfind(b"\n") + 1
+            block, tail = block[:cut], block[cut:]
+            matches = pattern.findall(block)
+            ids = np.array(matches).astype(np.int64) if matches else np.empty(0, dtype=np.int64)
+            yield ids, block.count(b"\n")
+        if tail.strip():
+            matches = pattern.findall(tail)
+            yield (np.array(matches).astype(np.int64) if matches else np.empty(0, dtype=np.int64)), 1
+
+
+def read_oids(path, field="OBJECTID"):
+    """Every OID in a .geojsonl file as one sorted, de-duplicated int64 array."""
+    blocks = [ids for ids, _ in _scan_oids(path, field)]
+    return np.unique(np.concatenate(blocks)) if blocks else np.empty(0, dtype=np.int64)
+
+
+def id_runs(ids, universe=None):
+    """Compress a sorted ID array into inclusive (starts, ends) runs.
+
+    Without a universe, a run is a block of consecutive integers. With the server's
+    sorted ID list as universe, a run is a block of IDs that are adjacent in that list,
+    so "BETWEEN start AND end" selects exactly the run even across ID gaps.
+    """
+    if len(ids) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    steps = np.searchsorted(universe, ids) if universe is not None else ids
+    breaks = np.flatnonzero(np.diff(steps) != 1)
+    starts = ids[np.concatenate(([0], breaks + 1))]
+    ends = ids[np.concatenate((breaks, [len(ids) - 1]))]
+    return starts, ends
+
+
+def audit_oids(path, expected_ids=None, expected_total=None, field="OBJECTID"):
+    """Single pass over a .geojsonl: per-OID counts -> duplicates and missing IDs.
+
+    expected_ids is the server's sorted ID list (returnIdsOnly); without it the IDs
+    are assumed to run contiguously from 1..expected_total. Counts live in a uint16
+    array indexed by OID (2 bytes per ID); negative or huge IDs go to a Counter.
+    Returns a dict of numpy arrays and totals.
+    """
+    counts = np.zeros(1 << 20, dtype=np.uint16)
+    overflow = Counter()
+    lines = found = 0
+    for ids, n_lines in _scan_oids(path, field):
+        lines += n_lines
+        found += len(ids)
+        inside = (ids >= 0) & (ids < MAX_BITMAP_OID)
+        if not inside.all():
+            overflow.update(ids[~inside].tolist())
+            ids = ids[inside]
+        if len(ids) == 0:
+            continue
+        top = int(ids.max())
+        if top >= len(counts):
+            counts = np.concatenate((counts, np.zeros(max(top + 1, 2 * len(counts)) - len(counts), dtype=np.uint16)))
+        np.add.at(counts, ids, 1)
+
+    dup_ids = np.flatnonzero(counts > 1)
+    dup_counts = counts[dup_ids].astype(np.int64)
+    over_dups = sorted((k, v) for k, v in overflow.items() if v > 1)
+    if over_dups:
+        dup_ids = np.concatenate((dup_ids, [k for k, _ in over_dups]))
+        dup_counts = np.concatenate((dup_counts, [v for _, v in over_dups]))
+
+    if expected_ids is None:
+        expected_ids = np.arange(1, (expected_total or 0) + 1, dtype=np.int64)
+    expected_ids = np.asarray(expected_ids, dtype=np.int64)
+    in_range = (expected_ids >= 0) & (expected_ids < len(counts))
+    present = np.zeros(len(expected_ids), dtype=bool)
+    present[in_range] = counts[expected_ids[in_range]] > 0
+    if overflow:
+        present |= np.isin(expected_ids, np.fromiter(overflow, dtype=np.int64))
+    missing = expected_ids[~present]
+
+    unique = int(np.count_nonzero(counts)) + len(overflow)
+    return {
+        "lines": lines,
+        "without_oid": lines - found,
+        "unique": unique,
+        "duplicate_ids": dup_ids.astype(np.int64),
+        "duplicate_counts": dup_counts,
+        "missing": missing,
+        "missing_runs": id_runs(missing, expected_ids),
+        "expected_ids": expected_ids,
+        "unexpected": unique - int(present.sum()),
+    }
@@ -0,0 +1,66 @@
+# spatial_sort.py
+# Purpose: Vectorized space-filling-curve keys for spatially sorting features.
+# Features are keyed by the centre of their bbox on a 2^order x 2^order grid over the
+# data extent; sorting by the key keeps nearby features together (splitter shards,
+# GeoParquet row groups).
+
+import numpy as np
+
+CURVE_ORDER = 16   # 65536 x 65536 grid cells over the layer extent
+
+
+def bbox_centres(bounds):
+    """Centres of bounds[n, 4] = minx, miny, maxx, maxy (NaN for empty / null geometries)."""
+    return (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2
+
+
+def _grid_coords(bounds, order, extent=None):
+    """Scale bbox centres onto the integer grid.
+
+    The grid spans `extent` = (min cx, min cy, max cx, max cy) of the centres when given,
+    so keys computed batch by batch are comparable; else the centres of this array.
+    """
+    cx, cy = bbox_centres(bounds)
+    if extent is None:
+        extent = (np.nanmin(cx), np.nanmin(cy), np.nanmax(cx), np.nanmax(cy))
+    side = (1 << order) - 1
+    span_x = max(extent[2] - extent[0], 1e-12)
+    span_y = max(extent[3] - extent[1], 1e-12)
+    x = np.nan_to_num(np.clip((cx - extent[0]) / span_x, 0, 1) * side).astype(np.uint64)
+    y = np.nan_to_num(np.clip((cy - extent[1]) / span_y, 0, 1) * side).astype(np.uint64)
+    return x, y
+
+
+def hilbert_keys(bounds, order=CURVE_ORDER, extent=None):
+    """Hilbert curve index of each bbox centre (one numpy pass per bit level)."""
+    x, y = _grid_coords(bounds, order, extent)
+    n = np.uint64(1 << order)
+    d = np.zeros(len(x), dtype=np.uint64)
+    s = np.uint64(1 << (order - 1))
+    while s > 0:
+        rx = ((x & s) > 0).astype(np.uint64)
+        ry = ((y & s) > 0).astype(np.uint64)
+        d += s * s * ((np.uint64(3) * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = (ry == 0) & (rx == 1)
+        x[flip] = n - np.uint64(1) - x[flip]
+        y[flip] = n - np.uint64(1) - y[flip]
+        swap = ry == 0
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= np.uint64(1)
+    return d
+
+
+def _spread_bits(v):
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+    return v
+
+
+def zorder_keys(bounds, order=CURVE_ORDER, extent=None):
+    """Morton (Z-order) index of each bbox centre, i.e. the quadtree visiting order."""
+    x, y = _grid_coords(bounds, order, extent)
+    return _spread_bits(x) | (_spread_bits(y) << np.uint64(1))
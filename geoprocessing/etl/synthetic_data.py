@@ -0,0 +1,146 @@
+# synthetic_data.py
+# Purpose: Deterministic synthetic features for benchmarks and offline testing.
+# Every feature is a pure function of its OBJECTID, so the mock FeatureServer
+# (mock_featureserver.py) and the file generators produce the same bytes for the same ID.
+# - object_ids / count_upto: the ID sequence, optionally with a gap every `gap_every` IDs
+# - feature_lines: GeoJSONL bytes (no newline) for an array of OBJECTIDs, point or polygon
+# - write_geojsonl / write_gpkg: stream N features to a file in chunks, so 1M-50M feature
+#   files are generated in bounded memory (.geojsonl.zst / .gz via compressed_io.py)
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from compressed_io import open_write
+
+# Config
+CHUNK = 200_000                  # features generated per chunk
+CELL = 0.001                     # polygon edge length in degrees
+EDIT_BASE = 1_600_000_000_000    # EditDate of OBJECTID 0 (epoch ms); one second later per ID
+EXTENT = (-125.0, 25.0, -67.0, 49.0)  # lon/lat box the features are scattered over (CONUS)
+GEOMETRIES = ("polygon", "point")
+FIELDS = ("OBJECTID", "NAME", "CATEGORY", "VALUE", "EditDate")
+
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+_PROPERTY_FORMATS = {"OBJECTID": '"OBJECTID":%d', "NAME": '"NAME":"Feature %d"', "CATEGORY": '"CATEGORY":%d',
+                     "VALUE": '"VALUE":%.3f', "EditDate": '"EditDate":%d'}
+
+
+def object_ids(start, stop, gap_every=0):
+    """OBJECTIDs number start..stop-1 of the sequence (0-based). With gap_every=g every
+    multiple of g is missing, like IDs of deleted features."""
+    idx = np.arange(start, stop, dtype=np.int64)
+    return idx + 1 + (idx // (gap_every - 1) if gap_every else 0)
+
+
+def count_upto(oid, gap_every=0):
+    """Number of OBJECTIDs <= oid."""
+    oid = max(int(oid), 0)
+    return oid - oid // gap_every if gap_every else oid
+
+
+def edit_dates(oids):
+    """EditDate (epoch ms) per OBJECTID; grows with the ID, so "edited since" is an ID range."""
+    return EDIT_BASE + np.asarray(oids, dtype=np.int64) * 1000
+
+
+def feature_columns(oids):
+    """Coordinates and attributes per OBJECTID, as numpy arrays."""
+    oids = np.asarray(oids, dtype=np.int64)
+    with np.errstate(over="ignore"):
+        mix = oids.astype(np.uint64) * _MIX
+    minx, miny, maxx, maxy = EXTENT
+    x = minx + (mix % np.uint64(1 << 20)).astype(np.float64) / (1 << 20) * (maxx - minx - CELL)
+    y = miny + ((mix >> np.uint64(20)) % np.uint64(1 << 20)).astype(np.float64) / (1 << 20) * (maxy - miny - CELL)
+    return {
+        "x": np.round(x, 6),
+        "y": np.round(y, 6),
+        "category": ((mix >> np.uint64(40)) % np.uint64(16)).astype(np.int64),
+        "value": ((mix >> np.uint64(44)) % np.uint64(1_000_000)).astype(np.int64) / 1000,
+        "edit": edit_dates(oids),
+    }
+
+
+def feature_lines(oids, geometry="polygon", fields=FIELDS, precision=6):
+    """GeoJSON Feature bytes (without newline) per OBJECTID, as ArcGIS returns them with f=geojson.
+
+    fields and precision mirror the outFields and geometryPrecision query parameters.
+    """
+    c = feature_columns(oids)
+    x, y = c["x"].tolist(), c["y"].tolist()
+    values = {"OBJECTID": np.asarray(oids).tolist(), "CATEGORY": c["category"].tolist(),
+              "VALUE": c["value"].tolist(), "EditDate": c["edit"].tolist()}
+    values["NAME"] = values["OBJECTID"]
+    fields = [f for f in FIELDS if f in fields]
+    props = '"properties":{' + ",".join(_PROPERTY_FORMATS[f] for f in fields) + "}}"
+    xy = f"[%.{precision}f,%.{precision}f]"
+    if geometry == "point":
+        fmt = '{"type":"Feature","id":%d,"geometry":{"type":"Point","coordinates":' + xy + "}," + props
+        coords = [x, y]
+    else:
+        fmt = ('{"type":"Feature","id":%d,"geometry":{"type":"Polygon","coordinates":[['
+               + ",".join([xy] * 5) + "]]}," + props)
+        x2, y2 = (c["x"] + CELL).tolist(), (c["y"] + CELL).tolist()
+        coords = [x, y, x2, y, x2, y2, x, y2, x, y]
+    rows = zip(values["OBJECTID"], *coords, *(values[f] for f in fields))
+    return [(fmt % row).encode() for row in rows]
+
+
+def write_geojsonl(path, features, geometry="polygon", gap_every=0, chunk=CHUNK):
+    """Write `features` synthetic features to a .geojsonl (.zst / .gz); returns uncompressed bytes."""
+    written = 0
+    with open_write(path) as f:
+        for start in range(0, features, chunk):
+            data = b"\n".join(feature_lines(object_ids(start, min(start + chunk, features), gap_every),
+                                            geometry)) + b"\n"
+            f.write(data)
+            written += len(data)
+    return written
+
+
+def write_gpkg(path, features, geometry="polygon", gap_every=0, layer=None, chunk=CHUNK * 2):
+    """Write `features` synthetic features to a single-layer GeoPackage (with spatial index)."""
+    import geopandas as gpd
+    import pyogrio
+    import shapely
+
+    layer = layer or os.path.splitext(os.path.basename(path))[0]
+    if os.path.exists(path):
+        os.remove(path)
+    for start in range(0, features, chunk):
+        oids = object_ids(start, min(start + chunk, features), gap_every)
+        c = feature_columns(oids)
+        if geometry == "point":
+            geoms = shapely.points(c["x"], c["y"])
+        else:
+            geoms = shapely.box(c["x"], c["y"], c["x"] + CELL, c["y"] + CELL)
+        gdf = gpd.GeoDataFrame({"OBJECTID": oids, "NAME": [f"Feature {i}" for i in oids.tolist()],
+                                "CATEGORY": c["category"], "VALUE": c["value"], "EditDate": c["edit"]},
+                               geometry=geoms, crs="EPSG:4326")
+        pyogrio.write_dataframe(gdf, path, layer=layer, driver="GPKG", append=start > 0)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic .geojsonl[.zst|.gz] or .gpkg files.")
+    parser.add_argument("output", help="output path; the format follows the extension")
+    parser.add_argument("--features", type=int, default=1_000_000)
+    parser.add_argument("--geometry", choices=GEOMETRIES, default="polygon")
+    parser.add_argument("--gap-every", type=int, default=0, help="leave out every n-th OBJECTID")
+    args = parser.parse_args(argv)
+    if args.gap_every == 1:
+        parser.error("--gap-every must be 0 (no gaps) or at least 2")
+    start_time = time.time()
+    if args.output.lower().endswith(".gpkg"):
+        write_gpkg(args.output, args.features, args.geometry, args.gap_every)
+    else:
+        write_geojsonl(args.output, args.features, args.geometry, args.gap_every)
+    print(f"Wrote {args.features:,} features to {args.output} in {time.time() - start_time:.1f} seconds")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())